@@ -0,0 +1,205 @@
+"""
+Offline batch-API export and ingest for the two generation stages.
+
+Instead of synchronous chat calls, every prompt of a stage is written to a
+batch-request JSONL file in the format accepted by the OpenAI Batch API and
+vLLM's ``run_batch`` entrypoint. The result files those jobs produce are
+ingested to build the next stage's requests and finally merged into dialogues.
+No API calls are made here.
+
+Every request carries a ``custom_id`` of the form ``<stage>:<scenario hash>:<sample>``
+derived from category, scenario and sample index, so the query and response
+stages of the same dialogue join on everything after the stage prefix.
+"""
+
+import hashlib
+import json
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import GENERATION_CONFIG, OUTPUT_CONFIG
+from extraction import ExtractionError, turns_from
+from output_writer import DialogueWriter, finalize_to_json, stream_path_for
+from scenario_loader import flow_definitions_of
+from work_items import WorkItem, iter_work_items
+
+QUERY_STAGE = "query"
+RESPONSE_STAGE = "response"
+
+
+def dialogue_id(item: WorkItem) -> str:
+    """Stable identifier of a dialogue, derived from category, scenario and sample"""
+    digest = hashlib.sha1(f"{item.category}\x1f{item.scenario}".encode("utf-8")).hexdigest()
+    return f"{digest[:16]}:{item.sample_id}"
+
+
+def custom_id(stage: str, item: WorkItem) -> str:
+    """Batch request id for one stage of a dialogue"""
+    return f"{stage}:{dialogue_id(item)}"
+
+
+def split_custom_id(value: str) -> Tuple[str, str]:
+    """Split a custom_id into its stage and dialogue id"""
+    stage, _, rest = value.partition(":")
+    return stage, rest
+
+
+def batch_request(request_id: str, model: str, prompt: str, max_tokens: int,
+                  temperature: float) -> Dict:
+    """One /v1/chat/completions batch request line"""
+    return {
+        "custom_id": request_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        },
+    }
+
+
+def read_batch_results(path: str) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """Yield (custom_id, completion text, error) for each line of a batch result file"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            result = json.loads(line)
+            request_id = result.get("custom_id", "")
+            if result.get("error"):
+                yield request_id, None, json.dumps(result["error"])
+                continue
+            response = result.get("response") or {}
+            status = response.get("status_code", 200)
+            body = response.get("body") or {}
+            if status != 200:
+                yield request_id, None, f"status {status}: {json.dumps(body)[:200]}"
+                continue
+            try:
+                content = body["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                yield request_id, None, "response has no completion"
+                continue
+            yield request_id, (content or "").strip(), None
+
+
+def _index_items(generator, data: Dict) -> Dict[str, WorkItem]:
+    """Map dialogue ids back to work items"""
+    return {dialogue_id(item): item for item in iter_work_items(data, generator.samples_per_scenario)}
+
+
+def export_query_batch(generator, data: Dict, query_prompt_template: str,
+                       output_path: str) -> int:
+    """
+    Write a query-stage batch request for every work item; returns the count.
+
+    Each sample of a scenario gets its own request line, since batch results
+    are joined per custom_id.
+    """
+    flow_definitions = flow_definitions_of(data)
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for item in iter_work_items(data, generator.samples_per_scenario):
+            flow_steps = generator.format_flow_steps(item.flow_type, flow_definitions)
+            prompt = generator.render_query_prompt(item.category, item.scenario,
+                                                   query_prompt_template, flow_steps)
+            request = batch_request(
+                custom_id(QUERY_STAGE, item),
+                generator.model,
+                prompt,
+                GENERATION_CONFIG["max_tokens_query"],
+                GENERATION_CONFIG["temperature_query"],
+            )
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def load_stage_results(generator, data: Dict, results_path: str,
+                       stage: str) -> Tuple[Dict[str, List[str]], List[str]]:
+    """
+    Parse a stage's batch results into ``{dialogue_id: turns}``.
+
+    Returns the parsed turns and a list of human-readable failures (API
+    errors, unknown ids, unparseable completions).
+    """
+    items = _index_items(generator, data)
+    parsed: Dict[str, List[str]] = {}
+    failures: List[str] = []
+    for request_id, content, error in read_batch_results(results_path):
+        request_stage, key = split_custom_id(request_id)
+        if request_stage != stage or key not in items:
+            failures.append(f"{request_id}: not a {stage}-stage request for this data file")
+            continue
+        if error is not None:
+            failures.append(f"{request_id}: {error}")
+            continue
+        try:
+            parsed[key] = turns_from(generator.extract_json_from_response(content))
+        except ExtractionError as e:
+            failures.append(f"{request_id}: could not parse completion ({e})")
+    return parsed, failures
+
+
+def ingest_query_results(generator, data: Dict, response_prompt_template: str,
+                         query_results_path: str, output_path: str) -> Tuple[int, List[str]]:
+    """
+    Turn query-stage batch results into response-stage batch requests.
+
+    Returns the number of requests written and the query-stage failures.
+    """
+    items = _index_items(generator, data)
+    queries_by_id, failures = load_stage_results(generator, data, query_results_path,
+                                                 QUERY_STAGE)
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for key, queries in queries_by_id.items():
+            item = items[key]
+            prompt = generator.render_response_prompt(item.category, item.scenario, queries,
+                                                      response_prompt_template)
+            request = batch_request(
+                custom_id(RESPONSE_STAGE, item),
+                generator.model,
+                prompt,
+                GENERATION_CONFIG["max_tokens_response"],
+                GENERATION_CONFIG["temperature_response"],
+            )
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    return count, failures
+
+
+def merge_batch_results(generator, data: Dict, query_results_path: str,
+                        response_results_path: str, output_file: str) -> Tuple[int, List[str]]:
+    """
+    Join both stages' batch results into dialogues written to output_file.
+
+    Returns the number of dialogues written and all failures.
+    """
+    items = _index_items(generator, data)
+    queries_by_id, failures = load_stage_results(generator, data, query_results_path,
+                                                 QUERY_STAGE)
+    responses_by_id, response_failures = load_stage_results(generator, data,
+                                                            response_results_path,
+                                                            RESPONSE_STAGE)
+    failures.extend(response_failures)
+
+    stream_file = stream_path_for(output_file, OUTPUT_CONFIG.get("compress", False))
+    with DialogueWriter(stream_file, fsync_interval=OUTPUT_CONFIG.get("fsync_interval", 50),
+                        ensure_ascii=OUTPUT_CONFIG["ensure_ascii"]) as writer:
+        for key, responses in responses_by_id.items():
+            queries = queries_by_id.get(key)
+            if queries is None:
+                failures.append(f"{custom_id(RESPONSE_STAGE, items[key])}: no matching queries")
+                continue
+            item = items[key]
+            sample_id = item.sample_id if generator.samples_per_scenario > 1 else None
+            writer.write(generator.build_dialogue(item.category, item.scenario, queries,
+                                                  responses, sample_id))
+
+    if stream_file != output_file and OUTPUT_CONFIG.get("finalize_json", True):
+        finalize_to_json(stream_file, output_file, ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                         indent=OUTPUT_CONFIG["indent"])
+    return writer.count, failures
@@ -0,0 +1,318 @@
+"""
+State of one batch generation run.
+
+``DialogueGenerator.batch_generate`` creates a ``BatchRun``, opens it as a
+context manager and hands its stage methods to one of the generator's
+engines (sequential, concurrent or pipelined). The run owns everything that
+lives for one call: the output and reject writers, the checkpoint, the
+near-duplicate index, the validation pool and the quota scheduler.
+
+The engines call the methods from different threads:
+
+- ``is_pending`` runs on the thread that pulls scenario groups: the caller's
+  thread, or the feeder thread of the pipeline.
+- ``query_stage`` and ``response_stage`` run on engine worker threads,
+  several at once. They only touch the checkpoint and the dedup index, which
+  lock themselves, and ``rejected``, which gets one key per item.
+- ``save`` and ``fail`` run on one thread at a time: the caller's thread for
+  the sequential and concurrent engines, the thread that called
+  ``TwoStagePipeline.run`` for the pipeline.
+- ``validated`` runs on the validation pool's callback thread, one call at a
+  time. With validation on it is the only caller of ``write``; without it,
+  ``save`` calls ``write`` directly, so writes never overlap. When
+  ``validated`` raises, the same thread calls ``fail`` for the item, which is
+  safe next to the engine's own ``fail`` calls because the checkpoint and the
+  scheduler lock themselves.
+- ``requeued`` is filled by ``validated`` and emptied by ``with_requeued`` on
+  the thread that pulls groups; deque appends and pops are thread-safe.
+"""
+
+import contextlib
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import config
+from config import OUTPUT_CONFIG
+from checkpoint import Checkpoint, checkpoint_path_for, output_labels
+from dedup import DuplicateQueries, MinHashIndex, dedup_index_path_for
+from extraction import ExtractionError
+from output_writer import DialogueWriter, repair_stream, stream_path_for
+from scenario_loader import ScenarioStream, flow_definitions_of
+from scheduler import QuotaScheduler
+from sharding import select_shard, shard_output_path
+from validators import VALIDATORS, ValidationPool, reject_path_for
+from work_items import WorkItem, iter_work_items
+
+DEDUP_CONFIG = getattr(config, "DEDUP_CONFIG", {})
+SCHEDULER_CONFIG = getattr(config, "SCHEDULER_CONFIG", {})
+VALIDATION_CONFIG = getattr(config, "VALIDATION_CONFIG", {})
+
+
+class BatchRun:
+    """Output, checkpoint, validation and scheduling state of one batch_generate call"""
+
+    def __init__(self, generator, data: Union[Dict, ScenarioStream], query_prompt_template: str,
+                 response_prompt_template: str, output_file: str, resume: bool = False,
+                 shard_index: int = 0, num_shards: int = 1):
+        """Open the output stream and checkpoint and set up the configured extras"""
+        self.generator = generator
+        self.data = data
+        self.query_prompt_template = query_prompt_template
+        self.response_prompt_template = response_prompt_template
+        self.resume = resume
+        self.flow_definitions = flow_definitions_of(data)
+        self.work_items = select_shard(iter_work_items(data, generator.samples_per_scenario),
+                                       shard_index, num_shards)
+        # In-memory data is listed up front for exact progress totals; scenario
+        # streams are consumed lazily so memory stays flat
+        self.materialize = isinstance(data, dict)
+        if self.materialize:
+            self.work_items = list(self.work_items)
+        if num_shards > 1:
+            print(f"\nShard {shard_index}/{num_shards}"
+                  + (f": {len(self.work_items)} dialogues" if self.materialize else ""))
+
+        self.stream_file = stream_path_for(output_file, OUTPUT_CONFIG.get("compress", False))
+        self.checkpoint = Checkpoint(checkpoint_path_for(self.stream_file), resume=resume)
+        self.done_labels = set()
+        if resume:
+            repair_stream(self.stream_file)
+            self.done_labels = output_labels(self.stream_file)
+        self.already_done = 0
+
+        self.scheduler = None
+        if SCHEDULER_CONFIG.get("enabled", False):
+            self.scheduler = QuotaScheduler(
+                category_quotas=SCHEDULER_CONFIG.get("category_quotas"),
+                flow_type_quotas=SCHEDULER_CONFIG.get("flow_type_quotas"),
+                default_category_quota=SCHEDULER_CONFIG.get("default_category_quota"),
+                category_weights=SCHEDULER_CONFIG.get("category_weights"),
+                strategy=SCHEDULER_CONFIG.get("strategy", "round_robin"),
+                window=SCHEDULER_CONFIG.get("window", 1024),
+                num_shards=num_shards
+            )
+
+        # Written items are only checkpointed as done once the writer has
+        # synced them, so resume never skips a dialogue that was lost in a crash
+        self.unsynced: List[WorkItem] = []
+        self.writer = DialogueWriter(
+            self.stream_file,
+            fsync_interval=OUTPUT_CONFIG.get("fsync_interval", 50),
+            ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+            append=resume,
+            on_sync=self.synced
+        )
+        self.dedup_index = None
+        if DEDUP_CONFIG.get("enabled", False):
+            self.dedup_index = MinHashIndex(
+                threshold=DEDUP_CONFIG.get("threshold", 0.8),
+                num_perm=DEDUP_CONFIG.get("num_perm", 128),
+                shingle_size=DEDUP_CONFIG.get("shingle_size", 5),
+                path=dedup_index_path_for(self.stream_file),
+                resume=resume
+            )
+        # Items whose queries were rejected as near-duplicates, with the reason
+        self.rejected: Dict[Tuple, Exception] = {}
+
+        self.validation_pool = None
+        self.reject_writer = None
+        if VALIDATION_CONFIG.get("enabled", False):
+            self.validation_pool = ValidationPool(
+                VALIDATION_CONFIG.get("validators", list(VALIDATORS)),
+                VALIDATION_CONFIG,
+                workers=VALIDATION_CONFIG.get("workers", 2),
+                max_pending=VALIDATION_CONFIG.get("max_pending", 256)
+            )
+            self.reject_writer = DialogueWriter(
+                shard_output_path(VALIDATION_CONFIG["reject_file"], shard_index, num_shards)
+                if VALIDATION_CONFIG.get("reject_file") else reject_path_for(self.stream_file),
+                fsync_interval=OUTPUT_CONFIG.get("fsync_interval", 50),
+                ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                append=resume
+            )
+        self.requeue = self.validation_pool is not None and VALIDATION_CONFIG.get("requeue", False)
+        self.max_requeues = VALIDATION_CONFIG.get("max_requeues", 1)
+        # Rejected items waiting to be regenerated in this run
+        self.requeued: Deque[WorkItem] = deque()
+
+    def is_pending(self, item: WorkItem) -> bool:
+        """Whether an item still needs generating; counts the ones an earlier run wrote"""
+        self.generator.metrics.flow_types.setdefault(item.category, item.flow_type)
+        if item.key in self.checkpoint.completed or (item.context, item.sample_id) in self.done_labels:
+            self.already_done += 1
+            if self.scheduler is not None:
+                # Dialogues from earlier runs count towards the quotas
+                self.scheduler.record_done(item)
+            return False
+        return True
+
+    def pending(self) -> Tuple[Iterable[WorkItem], Optional[int]]:
+        """The work items left to generate and their number, if the data is in memory"""
+        pending = filter(self.is_pending, self.work_items)
+        total = None
+        if self.materialize:
+            pending = list(pending)
+            total = len(pending)
+            if self.resume:
+                print(f"\nResuming: {self.already_done} dialogues already completed, "
+                      f"{len(pending)} remaining ({len(self.checkpoint.queries)} with checkpointed queries)")
+        elif self.resume:
+            print(f"\nResuming: {len(self.done_labels)} dialogues in the output, "
+                  f"{len(self.checkpoint.queries)} with checkpointed queries")
+        return pending, total
+
+    def query_stage(self, group: List[WorkItem]) -> List[Tuple[WorkItem, Optional[List[str]]]]:
+        """Queries for every sample of a scenario, from the checkpoint or one shared call"""
+        generator = self.generator
+        queries_by_item = {}
+        for item in group:
+            queries = self.checkpoint.queries.get(item.key)
+            if queries is not None:
+                print(f"\nResuming {item.context} from {len(queries)} checkpointed questions")
+                queries_by_item[item] = queries
+        missing = [item for item in group if item not in queries_by_item]
+        if missing:
+            first = missing[0]
+            print(f"\nStarting dialogue generation: {first.context}")
+            query_sets = generator.run_query_stage_samples(
+                first.category, first.scenario, first.flow_type, self.query_prompt_template,
+                self.flow_definitions,
+                [generator.regeneration_id(item, self.checkpoint.rejected.get(item.key, 0))
+                 for item in missing]
+            )
+            for item, queries in zip(missing, query_sets):
+                if queries is not None and self.dedup_index is not None:
+                    try:
+                        queries = generator.dedupe_queries(self.dedup_index, item, queries,
+                                                           self.query_prompt_template,
+                                                           self.flow_definitions)
+                    except (DuplicateQueries, ExtractionError) as e:
+                        self.rejected[item.key] = e
+                        queries = None
+                # Unusable query sets are not checkpointed so resume retries them
+                if queries is not None:
+                    self.checkpoint.record_queries(item.key, queries)
+                queries_by_item[item] = queries
+        return [(item, queries_by_item[item]) for item in group]
+
+    def response_stage(self, item: WorkItem, queries: Optional[List[str]]) -> Dict:
+        """The finished dialogue of an item whose query stage succeeded"""
+        if queries is None:
+            raise (self.rejected.get(item.key)
+                   or ExtractionError("query stage produced no usable questions"))
+        generator = self.generator
+        # Single-sample runs keep the original record layout
+        sample_id = item.sample_id if generator.samples_per_scenario > 1 else None
+        return generator.run_response_stage(
+            item.category, item.scenario, queries, self.response_prompt_template, sample_id,
+            generator.regeneration_id(item, self.checkpoint.rejected.get(item.key, 0))
+        )
+
+    def write(self, item: WorkItem, dialogue: Dict):
+        """Append a finished dialogue to the output; it is checkpointed once synced"""
+        self.unsynced.append(item)
+        try:
+            self.writer.write(dialogue)
+        except Exception:
+            if item in self.unsynced:
+                self.unsynced.remove(item)
+            raise
+        if self.scheduler is not None:
+            self.scheduler.record_saved(item)
+        print(f"✓ Saved {self.already_done + self.writer.count} dialogues")
+
+    def synced(self):
+        """Checkpoint the dialogues the writer has just synced to disk"""
+        for item in self.unsynced:
+            self.checkpoint.record_done(item.key)
+        self.unsynced = []
+
+    def validated(self, item: WorkItem, dialogue: Dict, reasons: List[str]):
+        """Write a dialogue that passed validation; reject, and maybe requeue, one that did not"""
+        if not reasons:
+            self.write(item, dialogue)
+            return
+        attempts = self.checkpoint.record_rejected(item.key, reasons)
+        self.reject_writer.write({"key": list(item.key), "attempt": attempts,
+                                  "reasons": reasons, "dialogue": dialogue})
+        if self.requeue and attempts <= self.max_requeues:
+            # A requeued item keeps its share of the quota
+            print(f"⚠ Rejected {item.context} ({'; '.join(reasons)}), regenerating")
+            self.requeued.append(item)
+        else:
+            print(f"⚠ Rejected {item.context}: {'; '.join(reasons)}")
+            if self.scheduler is not None:
+                self.scheduler.release(item)
+
+    def save(self, item: WorkItem, dialogue: Dict):
+        """Hand a finished dialogue to validation, or write it right away"""
+        if self.validation_pool is None:
+            self.write(item, dialogue)
+        else:
+            # Checks run off the generation threads; the callback writes the result,
+            # and a dialogue it cannot write is failed like one that was not generated
+            self.validation_pool.submit(dialogue, lambda reasons: self.validated(item, dialogue, reasons),
+                                        lambda error: self.fail([item], error))
+
+    def fail(self, items: List[WorkItem], error: Exception):
+        """Note dialogues that could not be generated; they are never written"""
+        print(f"Failed to generate dialogue {items[0].context}: {error}")
+        for item in items:
+            self.checkpoint.record_failed(item.key, str(error))
+            if self.scheduler is not None:
+                self.scheduler.release(item)
+
+    def with_requeued(self, groups: Iterable[List[WorkItem]]) -> Iterator[List[WorkItem]]:
+        """Hand rejected items out again, each as its own group, ahead of new scenarios"""
+        for group in groups:
+            while self.requeued:
+                yield [self.requeued.popleft()]
+            yield group
+        while self.requeued:
+            yield [self.requeued.popleft()]
+
+    @property
+    def total(self) -> int:
+        """Dialogues in the output: written by earlier runs and by this one"""
+        return self.already_done + self.writer.count
+
+    def __enter__(self):
+        with contextlib.ExitStack() as stack:
+            # Closed in reverse: the writer's final sync still checkpoints into an open sidecar
+            for resource in (self.checkpoint, self.writer, self.dedup_index, self.reject_writer,
+                             self.validation_pool):
+                if resource is not None:
+                    stack.enter_context(resource)
+            self._resources = stack.pop_all()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._resources.__exit__(exc_type, exc_value, traceback)
+
+    def report(self):
+        """Print the outcome of the run"""
+        generator = self.generator
+        print(f"\nBatch generation completed, total generated: {self.total} dialogues")
+        if isinstance(self.data, ScenarioStream) and self.data.skipped:
+            print(f"⚠ Skipped {self.data.skipped} invalid scenario records in {self.data.path}")
+        failed = [key for key in self.checkpoint.failed if key not in self.rejected]
+        if failed:
+            print(f"⚠ {len(failed)} dialogues failed and were not written "
+                  f"({generator.stage_retry_count} stage retries); run resume to retry them")
+        if generator.token_budget.limit is not None:
+            print(f"✓ Token budget: {generator.token_budget.used} of "
+                  f"{generator.token_budget.limit} tokens used")
+        if self.validation_pool is not None:
+            pool = self.validation_pool
+            reasons = ", ".join(f"{name} {count}" for name, count in pool.reasons.most_common())
+            print(f"✓ Validation: {pool.passed} passed, {pool.rejected} rejected"
+                  + (f" ({reasons}), rejects written to {self.reject_writer.path}" if reasons else ""))
+            if self.requeued:
+                print(f"⚠ {len(self.requeued)} rejected dialogues were not regenerated before the run ended; "
+                      f"run resume to regenerate them")
+        if self.scheduler is not None and self.scheduler.has_quotas:
+            print(f"✓ Quotas: {', '.join(self.scheduler.summary())}")
+        if self.dedup_index is not None:
+            print(f"✓ Near-duplicate queries: {generator.dedup_stats['resampled']} resampled, "
+                  f"{generator.dedup_stats['rejected']} rejected "
+                  f"({len(self.dedup_index)} query lists indexed)")
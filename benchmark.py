@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Throughput Benchmark for Multi-turn Dialogue Generation
+
+Runs DialogueGenerator.batch_generate against local mock OpenAI-compatible
+servers (see mock_server.py) at several max_concurrency levels and reports
+dialogues/sec, p50/p99 latency per stage, retries and peak RSS for each. Every
+run executes in a fresh child process so peak RSS is measured per run.
+
+Usage:
+    python benchmark.py --latency 0.2 --concurrency 1 2 4 8 16
+    python benchmark.py --latency 0.2 --concurrency 1 2 4 8 --pipeline
+    python benchmark.py --replicas 4 --server-slots 4 --concurrency 4 8 16
+    python benchmark.py --latency-dist lognormal --error-rate 0.02 --rate-limit-rate 0.05
+    python benchmark.py --compress --fsync-interval 1 --json results.json
+    python benchmark.py --templates 5000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from dialogue_generator import DialogueGenerator
+from config import FILE_PATHS, OUTPUT_CONFIG
+from mock_server import add_server_arguments, config_from_args, start_mock_server
+from pipeline import percentile
+
+
+class TimedGenerator(DialogueGenerator):
+    """DialogueGenerator that records the latency of every query and response stage"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_latencies: Dict[str, List[float]] = {"query": [], "response": []}
+        self._latency_lock = threading.Lock()
+
+    def _record(self, stage: str, start: float):
+        with self._latency_lock:
+            self.stage_latencies[stage].append(time.perf_counter() - start)
+
+    def run_query_stage_samples(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().run_query_stage_samples(*args, **kwargs)
+        finally:
+            self._record("query", start)
+
+    def run_response_stage(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().run_response_stage(*args, **kwargs)
+        finally:
+            self._record("response", start)
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MiB (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_once(endpoints: list, concurrency: int, data: dict, query_template: str,
+             response_template: str, pipeline: bool = False, samples: int = 1,
+             output_settings: Optional[Dict] = None) -> Dict:
+    """Run one batch generation and return its throughput, latency and resource figures"""
+    OUTPUT_CONFIG.update(output_settings or {})
+    generator = TimedGenerator(base_url=endpoints[0]["base_url"], api_key="sk-mock",
+                               model="mock", endpoints=endpoints)
+    generator.max_concurrency = concurrency
+    generator.pipeline = pipeline
+    generator.query_concurrency = concurrency
+    generator.response_concurrency = concurrency
+    generator.samples_per_scenario = samples
+    generator.cache = None  # every run must hit the mock server
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, "benchmark_dialogues.json")
+        OUTPUT_CONFIG["metrics_file"] = os.path.join(tmp_dir, "benchmark_metrics.json")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            count = generator.batch_generate(
+                data=data,
+                query_prompt_template=query_template,
+                response_prompt_template=response_template,
+                output_file=output_file
+            )
+        elapsed = time.perf_counter() - start
+
+    result = {
+        "concurrency": concurrency,
+        "dialogues": count,
+        "seconds": elapsed,
+        "dialogues_per_sec": count / elapsed,
+        "retries": generator.retries,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    for stage, latencies in generator.stage_latencies.items():
+        latencies = sorted(latencies)
+        result[f"{stage}_p50"] = percentile(latencies, 0.50)
+        result[f"{stage}_p99"] = percentile(latencies, 0.99)
+    generator.endpoints.close()
+    return result
+
+
+def run_isolated(*args, **kwargs) -> Dict:
+    """run_once in a fresh child process, so peak RSS is not shared between runs"""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_once, args, kwargs)
+
+
+def benchmark_templates(renders: int):
+    """Compare per-call Template() compilation with the shared template registry"""
+    from jinja2 import Template
+    from template_registry import TemplateRegistry
+
+    path = FILE_PATHS["query_prompt"]
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    context = {"context": "Problem-solving Interaction - Technical Support",
+               "info_flows_steps": "problem_diagnosis_to_solution: A --> B --> C"}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        registry = TemplateRegistry(os.path.join(tmp_dir, "jinja2"))
+        variants = [
+            ("per-call Template()", lambda: Template(source).render(**context)),
+            ("registry.from_string", lambda: registry.from_string(source).render(**context)),
+            ("registry.get (mtime)", lambda: registry.get(path).render(**context)),
+        ]
+        print(f"Rendering {renders} query prompts")
+        print(f"{'variant':>22} {'renders/sec':>12} {'speedup':>8}")
+        baseline = None
+        for name, render in variants:
+            start = time.perf_counter()
+            for _ in range(renders):
+                render()
+            rate = renders / (time.perf_counter() - start)
+            baseline = baseline or rate
+            print(f"{name:>22} {rate:>12.0f} {rate / baseline:>7.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch generation throughput")
+    add_server_arguments(parser)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                        help="max_concurrency levels to benchmark")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Use the two-stage pipeline with this concurrency per stage")
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="Number of mock servers to balance requests across")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="samples_per_scenario for every run")
+    parser.add_argument("--compress", action="store_true",
+                        help="Write a gzip-compressed output stream")
+    parser.add_argument("--fsync-interval", type=int, default=None,
+                        help="Override OUTPUT_CONFIG['fsync_interval']")
+    parser.add_argument("--json", metavar="PATH",
+                        help="Also write the results to a JSON file for later comparison")
+    parser.add_argument("--templates", type=int, default=0, metavar="N",
+                        help="Benchmark N prompt template renders instead of generation")
+    args = parser.parse_args()
+
+    if args.templates:
+        benchmark_templates(args.templates)
+        return
+
+    servers = [start_mock_server(config=config_from_args(args)) for _ in range(args.replicas)]
+    endpoints = [
+        {"base_url": f"http://127.0.0.1:{server.server_address[1]}/v1", "api_key": "sk-mock"}
+        for server in servers
+    ]
+    base_url = endpoints[0]["base_url"]
+
+    loader = DialogueGenerator(base_url=base_url, api_key="sk-mock", model="mock", offline=True)
+    data = loader.load_data(FILE_PATHS["data"])
+    query_template = loader.load_prompt_template(FILE_PATHS["query_prompt"])
+    response_template = loader.load_prompt_template(FILE_PATHS["response_prompt"])
+
+    output_settings = {"compress": args.compress}
+    if args.fsync_interval is not None:
+        output_settings["fsync_interval"] = args.fsync_interval
+
+    print(f"{len(servers)} mock server(s) starting at {base_url} "
+          f"(latency {args.latency}s {args.latency_dist}, "
+          f"slots {args.server_slots or 'unlimited'})")
+    print(f"{'concurrency':>12} {'dialogues/sec':>14} {'speedup':>8} {'query p50/p99':>15} "
+          f"{'response p50/p99':>17} {'retries':>8} {'peak RSS':>9}")
+    results = []
+    baseline = None
+    for concurrency in args.concurrency:
+        result = run_isolated(endpoints, concurrency, data, query_template, response_template,
+                              pipeline=args.pipeline, samples=args.samples,
+                              output_settings=output_settings)
+        results.append(result)
+        rate = result["dialogues_per_sec"]
+        baseline = baseline or rate
+        rss = f"{result['peak_rss_mb']:.0f}MB" if result["peak_rss_mb"] is not None else "n/a"
+        print(f"{concurrency:>12} {rate:>14.2f} {rate / baseline:>7.1f}x "
+              f"{result['query_p50']:>7.2f}/{result['query_p99']:<7.2f} "
+              f"{result['response_p50']:>8.2f}/{result['response_p99']:<8.2f} "
+              f"{result['retries']:>8} {rss:>9}")
+
+    served = [server.stats.snapshot() for server in servers]
+    totals = {key: sum(stats[key] for stats in served) for key in served[0]}
+    print(f"Mock servers: {totals['requests']} requests, {totals['errors']} errors, "
+          f"{totals['rate_limited']} rate limited, {totals['malformed']} malformed completions")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"arguments": vars(args), "runs": results, "servers": totals}, f, indent=2)
+        print(f"✓ Results written to {args.json}")
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
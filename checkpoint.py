@@ -0,0 +1,140 @@
+"""
+Checkpoint sidecar for resuming interrupted batch runs.
+
+The checkpoint is a JSONL file next to the output stream. Each line records a
+finished stage for one work item: ``"queries"`` once the query stage
+succeeded (with the generated queries) and ``"done"`` once the dialogue was
+written to the output stream and synced to disk. ``"failed"`` lines note items whose output
+stayed unusable; they are informational only, so resume simply retries them.
+``"rejected"`` lines note dialogues that failed validation; they drop the
+item's checkpointed queries and count its regeneration attempts. On resume,
+completed keys are skipped and items with checkpointed queries restart at the
+response stage.
+"""
+
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from output_writer import read_records
+from work_items import WorkItem
+
+Key = Tuple[str, str, int]
+
+
+def checkpoint_path_for(stream_file: str) -> str:
+    """Return the checkpoint sidecar path for an output stream"""
+    root = stream_file
+    for suffix in (".gz", ".jsonl"):
+        if root.endswith(suffix):
+            root = root[:-len(suffix)]
+    return f"{root}.checkpoint.jsonl"
+
+
+class Checkpoint:
+    """Append-only record of per-item stage completion"""
+
+    def __init__(self, path: str, resume: bool = False):
+        """Open the sidecar, loading previous state when resuming"""
+        self.path = path
+        self.completed: Set[Key] = set()
+        self.queries: Dict[Key, List[str]] = {}
+        self.failed: Dict[Key, str] = {}
+        self.rejected: Dict[Key, int] = {}
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self._load()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self):
+        """Replay the sidecar into completed keys and checkpointed queries"""
+        for event in read_records(self.path):
+            key = tuple(event["key"])
+            if event["stage"] == "queries":
+                self.queries[key] = event["queries"]
+            elif event["stage"] == "done":
+                self.completed.add(key)
+                self.queries.pop(key, None)
+                self.failed.pop(key, None)
+            elif event["stage"] == "failed":
+                self.failed[key] = event["reason"]
+            elif event["stage"] == "rejected":
+                self.rejected[key] = self.rejected.get(key, 0) + 1
+                self.queries.pop(key, None)
+
+    def _append(self, event: Dict):
+        with self._lock:
+            self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def record_queries(self, key: Key, queries: List[str]):
+        """Record a finished query stage"""
+        self._append({"key": list(key), "stage": "queries", "queries": queries})
+
+    def record_done(self, key: Key):
+        """Record a dialogue that has been written and synced to the output stream"""
+        self._append({"key": list(key), "stage": "done"})
+        self.completed.add(key)
+        self.failed.pop(key, None)
+
+    def record_failed(self, key: Key, reason: str):
+        """Record a dialogue that was not written because generation failed"""
+        self._append({"key": list(key), "stage": "failed", "reason": reason})
+        self.failed[key] = reason
+
+    def record_rejected(self, key: Key, reasons: List[str]) -> int:
+        """Record a dialogue that failed validation; returns its number of rejections"""
+        self._append({"key": list(key), "stage": "rejected", "reasons": reasons})
+        with self._lock:
+            self.queries.pop(key, None)
+            self.rejected[key] = self.rejected.get(key, 0) + 1
+            return self.rejected[key]
+
+    def close(self):
+        """Flush and close the sidecar"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def output_labels(stream_file: str) -> Set[Tuple[str, int]]:
+    """
+    The ``(label, sample_id)`` pairs of dialogues already in an output stream.
+
+    Records carry the "category - scenario" label and, for multi-sample
+    runs, a "sample_id"; records without one are numbered by order of
+    appearance among records with the same label.
+    """
+    labels: Set[Tuple[str, int]] = set()
+    if not os.path.exists(stream_file):
+        return labels
+
+    seen: Dict[str, int] = {}
+    for record in read_records(stream_file):
+        context = record.get("category", "")
+        if "sample_id" in record:
+            labels.add((context, record["sample_id"]))
+            continue
+        index = seen.get(context, 0)
+        labels.add((context, index))
+        seen[context] = index + 1
+    return labels
+
+
+def index_output(stream_file: str, items: Iterable[WorkItem]) -> Set[Key]:
+    """Index the keys of dialogues already present in an output stream"""
+    labels = output_labels(stream_file)
+    return {item.key for item in items if (item.context, item.sample_id) in labels}
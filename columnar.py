@@ -0,0 +1,368 @@
+"""
+Columnar export of generated dialogues.
+
+Dialogues are stored as compact records (see records.py) in four columns:
+``label`` (the record's "category - scenario" label), ``sample_id`` (-1 when
+the record has none), and ``queries`` and ``responses`` as lists of strings.
+Files are partitioned Hive-style by top-level category and flow type, so
+``pyarrow.dataset`` can read an export with ``partitioning="hive"``::
+
+    export/
+        _manifest.json
+        category=Educational%20Interaction/flow_type=theory_to_scene/part-00000.arrow
+        ...
+
+With pyarrow installed the files are Arrow IPC (``.arrow``) or Parquet
+(``.parquet``). Without it, a small built-in format (``.dlgcol``) uses the
+same layout as Arrow: little-endian int64 offset buffers into UTF-8 data
+buffers, 8-byte aligned behind a JSON header. Arrow and ``.dlgcol`` files are
+memory-mapped on read, so a training-side reader touches only the rows it
+uses and never parses a JSON array.
+"""
+
+import json
+import mmap
+import os
+import shutil
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from records import COLUMNAR_SUFFIXES, compact_record
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+FORMATS = ("auto", "arrow", "parquet", "fallback")
+SUFFIXES = dict(zip(("arrow", "parquet", "fallback"), COLUMNAR_SUFFIXES))
+MANIFEST = "_manifest.json"
+MAGIC = b"DLGCOL1\0"
+# Hive's name for an empty partition value
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+PARTITION_KEYS = ("category", "flow_type")
+LIST_COLUMNS = ("queries", "responses")
+
+
+def columnar_path_for(path: str) -> str:
+    """Default export directory for an output file, e.g. out.json -> out.columnar"""
+    for suffix in (".jsonl.gz", ".jsonl", ".json"):
+        if path.endswith(suffix):
+            return f"{path[:-len(suffix)]}.columnar"
+    return f"{path}.columnar"
+
+
+def resolve_format(format: str = "auto") -> str:
+    """The file format to write, falling back to the built-in one without pyarrow"""
+    if format not in FORMATS:
+        raise ValueError(f"unknown columnar format {format!r} (use one of {', '.join(FORMATS)})")
+    if format == "auto":
+        return "arrow" if pa is not None else "fallback"
+    if format != "fallback" and pa is None:
+        print(f"⚠ pyarrow is not installed; writing the built-in columnar format instead of {format}")
+        return "fallback"
+    return format
+
+
+def partition_dir(category: str, flow_type: str) -> str:
+    """Relative Hive-style directory of a partition"""
+    return os.path.join(*(f"{key}={quote(value, safe='') if value else DEFAULT_PARTITION}"
+                          for key, value in zip(PARTITION_KEYS, (category, flow_type))))
+
+
+def _le(values: array) -> bytes:
+    """Little-endian bytes of an int64 array"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _string_buffers(strings: List[str]) -> Tuple[array, bytes]:
+    """Arrow-style offsets and UTF-8 data of a string column"""
+    offsets = array("q", [0])
+    data = bytearray()
+    for value in strings:
+        data += value.encode("utf-8")
+        offsets.append(len(data))
+    return offsets, bytes(data)
+
+
+def write_fallback(path: str, records: List[Dict]):
+    """Write compact records to a built-in columnar file"""
+    buffers: Dict[str, bytes] = {}
+    offsets, data = _string_buffers([record.get("category", "") for record in records])
+    buffers["label.offsets"], buffers["label.data"] = _le(offsets), data
+    buffers["sample_id.values"] = _le(array("q", (record.get("sample_id", -1) for record in records)))
+    for column in LIST_COLUMNS:
+        lists = array("q", [0])
+        strings: List[str] = []
+        for record in records:
+            strings.extend(record.get(column) or [])
+            lists.append(len(strings))
+        offsets, data = _string_buffers(strings)
+        buffers[f"{column}.lists"] = _le(lists)
+        buffers[f"{column}.offsets"], buffers[f"{column}.data"] = _le(offsets), data
+
+    layout = {}
+    position = 0
+    for name, buffer in buffers.items():
+        layout[name] = [position, len(buffer)]
+        position += len(buffer) + (-len(buffer) % 8)
+    header = json.dumps({"rows": len(records), "buffers": layout}).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_le(array("q", [len(header)])))
+        f.write(header)
+        for buffer in buffers.values():
+            f.write(buffer)
+            f.write(b"\0" * (-len(buffer) % 8))
+    os.replace(tmp_path, path)
+
+
+def _arrow_table(records: List[Dict]):
+    return pa.table({
+        "label": pa.array([record.get("category", "") for record in records], pa.string()),
+        "sample_id": pa.array([record.get("sample_id", -1) for record in records], pa.int64()),
+        **{column: pa.array([record.get(column) or [] for record in records], pa.list_(pa.string()))
+           for column in LIST_COLUMNS},
+    })
+
+
+def write_file(path: str, records: List[Dict], format: str):
+    """Write compact records to one columnar file of a resolved format"""
+    if format == "fallback":
+        write_fallback(path, records)
+        return
+    table = _arrow_table(records)
+    tmp_path = f"{path}.tmp"
+    if format == "parquet":
+        pq.write_table(table, tmp_path)
+    else:
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+class ColumnarWriter:
+    """Partition compact records by category and flow type into columnar files"""
+
+    def __init__(self, directory: str, format: str = "auto", rows_per_file: int = 100000,
+                 flow_types: Optional[Dict[str, str]] = None, overwrite: bool = False):
+        """
+        Create the export directory.
+
+        flow_types maps top-level category names to flow types (see
+        scenario_loader.category_flow_types); without it, the category is
+        the part of a record's label before " - " and the flow type is empty.
+        An existing export is only replaced with overwrite set.
+        """
+        self.directory = directory
+        self.format = resolve_format(format)
+        self.rows_per_file = max(1, rows_per_file)
+        self.flow_types = flow_types or {}
+        # Longest names first, so "A - B" wins over "A" for a label "A - B - C"
+        self._categories = sorted(self.flow_types, key=len, reverse=True)
+        self._buffers: Dict[Tuple[str, str], List[Dict]] = {}
+        self._parts: Dict[Tuple[str, str], int] = {}
+        self.files: List[Dict] = []
+        self.count = 0
+
+        if os.path.exists(directory) and os.listdir(directory):
+            if not overwrite or not os.path.exists(os.path.join(directory, MANIFEST)):
+                raise FileExistsError(f"{directory} is not empty (overwrite replaces an earlier export)")
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+
+    def partition_of(self, record: Dict) -> Tuple[str, str]:
+        """(category, flow_type) partition of a record"""
+        label = record.get("category", "")
+        for category in self._categories:
+            if label == category or label.startswith(f"{category} - "):
+                return category, record.get("flow_type") or self.flow_types[category]
+        return label.split(" - ", 1)[0], record.get("flow_type", "")
+
+    def write(self, record: Dict):
+        """Add one record, writing its partition's file once it holds rows_per_file records"""
+        partition = self.partition_of(record)
+        buffer = self._buffers.setdefault(partition, [])
+        buffer.append(compact_record(record))
+        self.count += 1
+        if len(buffer) >= self.rows_per_file:
+            self._flush(partition)
+
+    def _flush(self, partition: Tuple[str, str]):
+        records = self._buffers.pop(partition, [])
+        if not records:
+            return
+        part = self._parts.get(partition, 0)
+        self._parts[partition] = part + 1
+        relative = os.path.join(partition_dir(*partition), f"part-{part:05d}{SUFFIXES[self.format]}")
+        path = os.path.join(self.directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, records, self.format)
+        self.files.append({"path": relative.replace(os.sep, "/"), "rows": len(records),
+                           "category": partition[0], "flow_type": partition[1]})
+
+    def close(self):
+        """Write the remaining partitions and the manifest"""
+        for partition in list(self._buffers):
+            self._flush(partition)
+        manifest = {"format": self.format, "rows": self.count, "files": self.files}
+        with open(os.path.join(self.directory, MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class ColumnarFile:
+    """One memory-mapped columnar file, indexable by row"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mmap = None
+        self._views: Dict = {}
+        self._table = None
+        if path.endswith(SUFFIXES["fallback"]):
+            self._open_fallback()
+        elif pa is None:
+            raise ImportError(f"reading {path} requires pyarrow")
+        elif path.endswith(SUFFIXES["parquet"]):
+            self._table = pq.read_table(path, memory_map=True)
+        else:
+            self._table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        self.rows = self._table.num_rows if self._table is not None else self._rows
+
+    def _open_fallback(self):
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if view[:len(MAGIC)] != MAGIC:
+            view.release()
+            self._mmap.close()
+            raise ValueError(f"{self.path} is not a columnar dialogue file")
+        header_length = int.from_bytes(view[8:16], "little")
+        header = json.loads(bytes(view[16:16 + header_length]))
+        start = 16 + header_length
+        self._rows = header["rows"]
+        for name, (offset, length) in header["buffers"].items():
+            buffer = view[start + offset:start + offset + length]
+            if name.endswith(".data"):
+                self._views[name] = buffer
+            elif sys.byteorder == "little":
+                self._views[name] = buffer.cast("q")
+            else:
+                values = array("q", bytes(buffer))
+                values.byteswap()
+                self._views[name] = values
+        self._view = view
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def _string(self, column: str, index: int) -> str:
+        offsets = self._views[f"{column}.offsets"]
+        return str(self._views[f"{column}.data"][offsets[index]:offsets[index + 1]], "utf-8")
+
+    def _record(self, label: str, sample_id: int, queries: List[str], responses: List[str]) -> Dict:
+        record = {"category": label, "queries": queries, "responses": responses}
+        if sample_id >= 0:
+            record["sample_id"] = sample_id
+        return record
+
+    def __getitem__(self, index: int) -> Dict:
+        """Compact record of a row"""
+        if index < 0:
+            index += self.rows
+        if not 0 <= index < self.rows:
+            raise IndexError(index)
+        if self._table is not None:
+            return next(self._arrow_records(self._table.slice(index, 1)))
+        lists = {column: self._views[f"{column}.lists"] for column in LIST_COLUMNS}
+        return self._record(
+            self._string("label", index),
+            self._views["sample_id.values"][index],
+            *([self._string(column, i) for i in range(lists[column][index], lists[column][index + 1])]
+              for column in LIST_COLUMNS)
+        )
+
+    def _arrow_records(self, table) -> Iterator[Dict]:
+        for batch in table.to_batches():
+            for row in batch.to_pylist():
+                yield self._record(row["label"], row["sample_id"], row["queries"], row["responses"])
+
+    def __iter__(self) -> Iterator[Dict]:
+        if self._table is not None:
+            return self._arrow_records(self._table)
+        return (self[index] for index in range(self.rows))
+
+    def close(self):
+        """Release the memory mapping"""
+        for view in self._views.values():
+            if isinstance(view, memoryview):
+                view.release()
+        self._views = {}
+        if self._mmap is not None:
+            self._view.release()
+            self._mmap.close()
+            self._mmap = None
+        self._table = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_partitions(directory: str) -> Iterator[Tuple[Dict[str, str], str]]:
+    """Yield the partition values and path of every columnar file in an export, in manifest order"""
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            for entry in json.load(f)["files"]:
+                yield ({key: entry[key] for key in PARTITION_KEYS},
+                       os.path.join(directory, *entry["path"].split("/")))
+        return
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        partition = {}
+        for part in os.path.relpath(root, directory).split(os.sep):
+            key, _, value = part.partition("=")
+            if key in PARTITION_KEYS:
+                partition[key] = "" if value == DEFAULT_PARTITION else unquote(value)
+        for name in sorted(files):
+            if name.endswith(COLUMNAR_SUFFIXES):
+                yield dict(partition), os.path.join(root, name)
+
+
+def read_columnar(path: str, category: Optional[str] = None, flow_type: Optional[str] = None,
+                  shard_index: int = 0, num_shards: int = 1) -> Iterator[Dict]:
+    """
+    Stream compact records from a columnar file or export directory.
+
+    category and flow_type select partitions. With num_shards > 1 only every
+    num_shards-th file, starting at shard_index, is read, so data-parallel
+    readers can split an export without coordination.
+    """
+    if os.path.isdir(path):
+        files = [file_path for partition, file_path in iter_partitions(path)
+                 if (category is None or partition.get("category") == category)
+                 and (flow_type is None or partition.get("flow_type") == flow_type)]
+    else:
+        files = [path]
+    for file_path in files[shard_index::max(1, num_shards)]:
+        with ColumnarFile(file_path) as columnar_file:
+            yield from columnar_file
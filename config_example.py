@@ -20,15 +20,27 @@ API_CONFIG = {
     "base_url": "http://localhost:7813/v1",  # Your local endpoint
     "api_key": "sk-xxx",  # Usually not needed for local servers, put non-empty string
     "model": "Qwen-2.5-72B-Instruct",  # Your local model name
+    # Optional: balance requests across several replicas serving the same model.
+    # When set, base_url/api_key above are ignored.
+    # "endpoints": [
+    #     {"base_url": "http://localhost:7813/v1", "api_key": "sk-xxx", "weight": 1},
+    #     {"base_url": "http://localhost:7814/v1", "api_key": "sk-xxx", "weight": 1},
+    # ],
+    "failure_threshold": 3,  # Consecutive failures before an endpoint is ejected
+    "ejection_seconds": 30,  # How long an ejected endpoint is kept out of rotation
+    "health_check_interval": 10,  # Seconds between health checks (multi-endpoint only)
 }
 
 # File path configuration
 FILE_PATHS = {
-    "data": "data/dummy_data.json",  # Main data file with categories and flow definitions
+    "data": "data/dummy_data.json",  # Data file (.json), or a streamed JSONL scenario catalog (.jsonl[.gz])
+    "flow_definitions": None,  # JSON file with the flow_definitions a JSONL catalog references (optional)
     "query_prompt": "prompt/query_template_en.txt",  # Query generation template
     "response_prompt": "prompt/response_template_en.txt",  # Response generation template
     "output_file": "generated_dialogues.json",  # Output file for batch generation
-    "test_output": "test_dialogue.json"  # Output file for test generation
+    "test_output": "test_dialogue.json",  # Output file for test generation
+    "query_batch": "batch/query_requests.jsonl",  # Offline batch mode: query-stage requests
+    "response_batch": "batch/response_requests.jsonl"  # Offline batch mode: response-stage requests
 }
 
 # Generation configuration
@@ -38,11 +50,115 @@ GENERATION_CONFIG = {
     "temperature_query": 0.8,  # Temperature for query generation (0.0-2.0)
     "temperature_response": 0.7,  # Temperature for response generation (0.0-2.0)
     "max_retries": 3,  # Maximum number of retry attempts for API calls
-    "retry_delay": 1  # Delay between retries in seconds
+    "retry_delay": 1,  # Base delay for exponential backoff between retries in seconds
+    "max_backoff": 60,  # Upper bound on a single backoff delay in seconds
+    "requests_per_minute": None,  # Request budget per minute (None = unlimited)
+    "tokens_per_minute": None,  # Prompt + completion token budget per minute (None = unlimited)
+    "token_budget": None,  # Hard cap on prompt + completion tokens per run; stops scheduling once spent (None = unlimited)
+    "max_in_flight_requests": 256,  # Ceiling for the adaptive (AIMD) concurrent request limit
+    "scenario_read_ahead": 1024,  # Work items read ahead of the scheduler from a JSONL catalog
+    "max_concurrency": 1,  # Maximum number of dialogues generated in parallel (1 = sequential)
+    "samples_per_scenario": 1,  # Dialogues generated per scenario, sharing one query-stage prompt
+    "use_n_parameter": True,  # Request all samples in one call with `n`; False = parallel single calls
+    "stream": False,  # Stream completions, aborting early on malformed JSON or truncation
+    "truncation_retry_factor": 1.5,  # Scale max_tokens by this after a streamed completion hits it
+    "stage_retries": 2,  # Re-request a stage whose completion has no usable turns this many times
+    "structured_output": "json_object",  # On stage retries: "json_object", "json_schema", "guided_json" or None
+    "prefix_order": False,  # Sort pending query requests by rendered prompt for prefix-cache reuse
+    "prefix_order_window": 256,  # Scenario groups sorted together per batch when prefix_order is on
+    "pipeline": False,  # Overlap query and response stages on separate worker pools
+    "query_concurrency": 4,  # Pipeline: concurrent query-stage requests
+    "response_concurrency": 8,  # Pipeline: concurrent response-stage requests
+    "pipeline_queue_size": 16  # Pipeline: bounded queue size in front of each stage
+}
+
+# Response cache configuration
+# Completions are cached on disk keyed by model, rendered messages and sampling
+# parameters, so unchanged prompts are not sent to the API again.
+CACHE_CONFIG = {
+    "enabled": False,  # Serve repeated requests from the on-disk cache (identical prompts return identical completions)
+    "path": ".cache/responses.sqlite",  # SQLite database holding cached completions
+    "max_size_mb": 512,  # Evict least recently used entries beyond this size
+    "bypass": False,  # Skip cache lookups (fresh completions are still stored)
+    "template_bytecode_dir": ".cache/jinja2"  # Compiled prompt template cache (None = disabled)
+}
+
+# Near-duplicate detection
+# Query lists are MinHash-ed as they are generated; one too similar to a query
+# list already accepted is resampled, then rejected before the response stage.
+DEDUP_CONFIG = {
+    "enabled": False,  # Check query lists against a MinHash-LSH index during batch runs
+    "threshold": 0.8,  # Estimated Jaccard similarity at which query lists count as duplicates
+    "num_perm": 128,  # MinHash permutations (signature length)
+    "shingle_size": 5,  # Characters per shingle
+    "max_resamples": 1  # Extra query-stage attempts for a duplicate before it is rejected
+}
+
+# Post-generation validation
+# Finished dialogues are checked on a process pool before they are written;
+# rejected ones go to the reject file with their reasons instead of the output.
+VALIDATION_CONFIG = {
+    "enabled": False,  # Validate dialogues during batch runs
+    "validators": ["alignment", "placeholders", "turn_count", "follow_up_questions"],  # Built-in names or "module:function"
+    "min_turns": 6,  # Fewest turns a dialogue may have
+    "max_turns": 8,  # Most turns a dialogue may have
+    "max_follow_up_questions": 0,  # Responses per dialogue allowed to end with a question to the user
+    "workers": 2,  # Validation processes (0 = validate inline)
+    "max_pending": 256,  # Dialogues queued for validation before generation waits
+    "reject_file": None,  # Rejected dialogues with reasons (None = <output>.rejects.jsonl)
+    "requeue": False,  # Regenerate rejected dialogues in the same run
+    "max_requeues": 1  # Regenerations per dialogue before it stays rejected
+}
+
+# Category scheduling
+# Batch runs interleave scenarios across categories instead of walking the
+# data file in order, so a run cut short stays balanced. Only written
+# (validated) dialogues count towards the quotas; filled categories drop out.
+SCHEDULER_CONFIG = {
+    "enabled": False,  # Interleave categories and enforce quotas during batch runs
+    "strategy": "round_robin",  # "round_robin" or "weighted" (by category_weights, else by quota)
+    "category_quotas": {},  # Dialogues to generate per category, e.g. {"Health Consultation": 500}
+    "default_category_quota": None,  # Quota of categories missing from category_quotas (None = unlimited)
+    "flow_type_quotas": {},  # Dialogues to generate per flow type, across its categories
+    "category_weights": {},  # Relative share per category with the weighted strategy
+    "window": 1024  # Scenario groups read ahead of the scheduler from streamed data
+}
+
+# Dry-run planning (python main.py plan)
+# Prompt tokens are counted from the rendered templates; completion tokens and
+# latency per call come from these estimates, or from metrics_file when it
+# holds the JSON metrics of an earlier run.
+PLANNER_CONFIG = {
+    "tokenizer": "heuristic",  # "heuristic", "tiktoken:<encoding or model>" or "hf:<model name or path>"
+    "completion_tokens_query": 400,  # Expected completion tokens per query-stage dialogue
+    "completion_tokens_response": 1000,  # Expected completion tokens per response-stage call
+    "metrics_file": None,  # Metrics JSON of an earlier run to take completion tokens and latency from
+    "time_to_first_token": 0.5,  # Seconds before the first completion token, without metrics
+    "decode_tokens_per_second": 40,  # Completion tokens per second per request, without metrics
+    "prompt_price_per_million": 0.0,  # Price per million prompt tokens
+    "completion_price_per_million": 0.0  # Price per million completion tokens
+}
+
+# Generation service (python main.py serve)
+# A resident process keeps the generator, its connections and the compiled
+# templates warm and runs jobs from many clients on one shared worker pool.
+SERVICE_CONFIG = {
+    "host": "127.0.0.1",  # Interface the HTTP API listens on
+    "port": 8765,  # HTTP port
+    "socket": None,  # Listen on this Unix socket path instead of host/port
+    "max_concurrency": 8,  # Workers shared by all jobs (one API call in flight each)
+    "max_dialogues_per_job": 10000  # Larger jobs are refused
 }
 
 # Output configuration
 OUTPUT_CONFIG = {
     "ensure_ascii": False,  # Whether to ensure ASCII encoding in JSON output
-    "indent": 2  # JSON indentation level
+    "indent": 2,  # JSON indentation level
+    "compress": False,  # Gzip the JSONL stream written during batch generation
+    "fsync_interval": 50,  # Fsync the JSONL stream every N dialogues (0 = only on close)
+    "finalize_json": True,  # Convert the JSONL stream into a JSON array at the end of a run
+    "metrics_file": "generated_dialogues.metrics.json",  # Per-call API metrics (.prom for Prometheus text; None disables)
+    "record_format": "full",  # "full" or "compact" (queries/responses only; turns are derived on read)
+    "columnar_format": "auto",  # export-columnar: "arrow", "parquet", "fallback" or "auto" (arrow if pyarrow is installed)
+    "columnar_rows_per_file": 100000  # export-columnar: rows per file within a category/flow type partition
 }
@@ -0,0 +1,277 @@
+"""
+Near-duplicate detection over generated query lists with MinHash-LSH.
+
+Each query list is normalized (lowercased, whitespace collapsed) and cut into
+overlapping character shingles. A MinHash signature of the shingle set
+estimates Jaccard similarity, and locality-sensitive hashing over bands of the
+signature finds candidate matches without comparing against every earlier
+dialogue. Candidates are confirmed against the similarity threshold before a
+query list counts as a duplicate.
+
+Shingling and hashing are vectorized with numpy when it is installed; a
+pure-Python fallback produces identical signatures, so an index written by
+one can be read by the other. The index can be persisted as an append-only
+JSONL sidecar so resumed runs keep deduplicating against earlier dialogues.
+"""
+
+import base64
+import json
+import os
+import random
+import re
+import sys
+import threading
+from array import array
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_MASK32 = (1 << 32) - 1
+_MASK64 = (1 << 64) - 1
+_MERSENNE = (1 << 61) - 1
+_BASE = 257
+_WHITESPACE = re.compile(r"\s+")
+
+Match = Tuple[Hashable, float]
+
+
+class DuplicateQueries(ValueError):
+    """A generated query list is a near-duplicate of one already accepted"""
+
+
+def dedup_index_path_for(stream_file: str) -> str:
+    """Return the dedup index sidecar path for an output stream"""
+    root = stream_file
+    for suffix in (".gz", ".jsonl"):
+        if root.endswith(suffix):
+            root = root[:-len(suffix)]
+    return f"{root}.dedup.jsonl"
+
+
+def deduped_output_path(path: str) -> str:
+    """Default output of the dedup command, e.g. out.json -> out.deduped.json"""
+    for suffix in (".jsonl.gz", ".jsonl", ".json"):
+        if path.endswith(suffix):
+            return f"{path[:-len(suffix)]}.deduped{suffix}"
+    return f"{path}.deduped"
+
+
+def normalize(queries: List[str]) -> str:
+    """Lowercase the joined queries and collapse whitespace"""
+    return _WHITESPACE.sub(" ", " ".join(queries).lower()).strip()
+
+
+def choose_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Split num_perm into (bands, rows) for LSH.
+
+    Picks the split whose LSH threshold (1/bands)^(1/rows) is the highest one
+    not above the similarity threshold, favouring recall; false candidates are
+    filtered out by the exact signature comparison afterwards.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+class MinHasher:
+    """Character-shingle MinHash signatures with a fixed, seeded permutation family"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self.a = [rng.randrange(1, 1 << 32) for _ in range(num_perm)]
+        self.b = [rng.randrange(0, 1 << 32) for _ in range(num_perm)]
+        if np is not None:
+            self._a = np.array(self.a, dtype=np.uint64)[:, None]
+            self._b = np.array(self.b, dtype=np.uint64)[:, None]
+            self._powers = np.array(
+                [pow(_BASE, shingle_size - 1 - j, 1 << 64) for j in range(shingle_size)],
+                dtype=np.uint64
+            )
+
+    def signature(self, text: str) -> bytes:
+        """MinHash signature of text as little-endian uint32 bytes"""
+        data = text.encode("utf-8")
+        if len(data) < self.shingle_size:
+            data = data.ljust(self.shingle_size, b"\0")
+        if np is not None:
+            return self._signature_numpy(data)
+        return self._signature_python(data)
+
+    def _signature_numpy(self, data: bytes) -> bytes:
+        values = np.frombuffer(data, dtype=np.uint8).astype(np.uint64)
+        windows = np.lib.stride_tricks.sliding_window_view(values, self.shingle_size)
+        # Polynomial rolling hash of every shingle (uint64 arithmetic wraps mod 2^64)
+        hashes = (windows * self._powers).sum(axis=1, dtype=np.uint64)
+        hashes = np.unique((hashes ^ (hashes >> np.uint64(32))) & np.uint64(_MASK32))
+        permuted = (self._a * hashes[None, :] + self._b) % np.uint64(_MERSENNE)
+        permuted &= np.uint64(_MASK32)
+        return permuted.min(axis=1).astype("<u4").tobytes()
+
+    def _signature_python(self, data: bytes) -> bytes:
+        k = self.shingle_size
+        hashes = set()
+        for start in range(len(data) - k + 1):
+            value = 0
+            for byte in data[start:start + k]:
+                value = (value * _BASE + byte) & _MASK64
+            hashes.add((value ^ (value >> 32)) & _MASK32)
+        signature = array("I", (
+            min((((a * value + b) & _MASK64) % _MERSENNE) & _MASK32 for value in hashes)
+            for a, b in zip(self.a, self.b)
+        ))
+        if sys.byteorder == "big":
+            signature.byteswap()
+        return signature.tobytes()
+
+    def similarity(self, first: bytes, second: bytes) -> float:
+        """Estimated Jaccard similarity of two signatures"""
+        if np is not None:
+            equal = np.count_nonzero(np.frombuffer(first, dtype="<u4") == np.frombuffer(second, dtype="<u4"))
+        else:
+            equal = sum(1 for i in range(0, len(first), 4) if first[i:i + 4] == second[i:i + 4])
+        return float(equal) / self.num_perm
+
+
+class MinHashIndex:
+    """Incremental, thread-safe MinHash-LSH index of query lists"""
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5,
+                 seed: int = 1, path: Optional[str] = None, resume: bool = False):
+        """
+        Create an empty index, or one loaded from path when resuming.
+
+        With path given, every insertion is appended to that JSONL sidecar.
+        """
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size, seed)
+        self.bands, self.rows = choose_bands(threshold, num_perm)
+        self.keys: List[Hashable] = []
+        self.signatures: List[bytes] = []
+        self._ids: Dict[Hashable, int] = {}
+        # Band hash -> id of the first entry, or a list of ids once buckets collide
+        self._buckets: List[Dict[int, Union[int, List[int]]]] = [{} for _ in range(self.bands)]
+        self._lock = threading.Lock()
+        self._file = None
+
+        if path:
+            if resume and os.path.exists(path):
+                self._load(path)
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _load(self, path: str):
+        """Replay a persisted index"""
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write can leave a partial last line behind
+                    continue
+                key = entry["key"]
+                self._insert(tuple(key) if isinstance(key, list) else key,
+                             base64.b64decode(entry["signature"]))
+
+    def _band_hashes(self, signature: bytes) -> Iterator[Tuple[int, int]]:
+        width = self.rows * 4
+        for band in range(self.bands):
+            yield band, hash(signature[band * width:(band + 1) * width])
+
+    def _insert(self, key: Hashable, signature: bytes):
+        entry_id = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        self._ids[key] = entry_id
+        for band, band_hash in self._band_hashes(signature):
+            bucket = self._buckets[band]
+            existing = bucket.get(band_hash)
+            if existing is None:
+                bucket[band_hash] = entry_id
+            elif isinstance(existing, list):
+                existing.append(entry_id)
+            else:
+                bucket[band_hash] = [existing, entry_id]
+
+    def _query(self, signature: bytes) -> Optional[Match]:
+        candidates = set()
+        for band, band_hash in self._band_hashes(signature):
+            found = self._buckets[band].get(band_hash)
+            if found is None:
+                continue
+            candidates.update(found if isinstance(found, list) else (found,))
+        best = None
+        for entry_id in candidates:
+            similarity = self.hasher.similarity(signature, self.signatures[entry_id])
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (self.keys[entry_id], similarity)
+        return best
+
+    def query(self, queries: List[str]) -> Optional[Match]:
+        """The most similar indexed key and its similarity, if any reaches the threshold"""
+        signature = self.hasher.signature(normalize(queries))
+        with self._lock:
+            return self._query(signature)
+
+    def add(self, key: Hashable, queries: List[str]) -> Optional[Match]:
+        """
+        Index queries under key unless they duplicate an indexed entry.
+
+        Returns the matching (key, similarity) for a duplicate, which is not
+        indexed, or None once the queries have been added. Keys that are
+        already indexed (e.g. re-generated on resume) are accepted as they are.
+        """
+        signature = self.hasher.signature(normalize(queries))
+        with self._lock:
+            if key in self._ids:
+                return None
+            match = self._query(signature)
+            if match is not None:
+                return match
+            self._insert(key, signature)
+            if self._file is not None:
+                entry = {"key": list(key) if isinstance(key, tuple) else key,
+                         "signature": base64.b64encode(signature).decode("ascii")}
+                self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self._file.flush()
+        return None
+
+    def close(self):
+        """Flush and close the sidecar"""
+        with self._lock:
+            if self._file is not None and not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def dedup_records(records: Iterable[Dict], index: MinHashIndex) -> Iterator[Tuple[Dict, Optional[Match]]]:
+    """
+    Check dialogue records against the index in order.
+
+    Yields each record with None when it was kept (and indexed under its
+    position) or the (position, similarity) of the earlier record it duplicates.
+    """
+    for position, record in enumerate(records):
+        yield record, index.add(position, record.get("queries") or [])
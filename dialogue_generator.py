@@ -1,11 +1,40 @@
 import json
 import os
-from typing import List, Dict, Optional
-from openai import OpenAI
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import groupby
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 from jinja2 import Template
 from tqdm import tqdm
 
+import config
 from config import API_CONFIG, GENERATION_CONFIG, OUTPUT_CONFIG
+from batch_run import BatchRun
+from dedup import DuplicateQueries, MinHashIndex
+from endpoints import EndpointPool
+from extraction import TURNS_SCHEMA, ExtractionError, extract_json, turns_from
+from json_stream import COMPLETE, MALFORMED, JSONPrefixValidator, StreamAborted
+from metrics import MetricsRecorder
+from output_writer import finalize_to_json
+from pipeline import TwoStagePipeline
+from prefix_order import order_by_prefix
+from records import build_turns, turn_count
+from rate_control import (
+    FATAL, OVERLOADED, AdaptiveConcurrency, BudgetExceeded, RateLimiter, TokenBudget, backoff_delay,
+    classify_error, rejects_parameter, retry_after_seconds
+)
+from response_cache import ResponseCache
+from scenario_loader import ScenarioStream
+from sharding import shard_output_path
+from template_registry import TemplateRegistry
+from work_items import WorkItem
+
+# Sections newer than the original config_example.py are optional, so a
+# config.py copied from an older version keeps working with the defaults
+CACHE_CONFIG = getattr(config, "CACHE_CONFIG", {})
+DEDUP_CONFIG = getattr(config, "DEDUP_CONFIG", {})
 
 
 class DialogueGenerator:
@@ -16,12 +45,71 @@ class DialogueGenerator:
     with a simplified data structure and original prompt template compatibility.
     """
     
-    def __init__(self, base_url: str, api_key: str, model: str):
-        """Initialize the generator with API configuration"""
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+    def __init__(self, base_url: str, api_key: str, model: str,
+                 endpoints: Optional[List[Dict]] = None, offline: bool = False):
+        """
+        Initialize the generator with API configuration.
+        
+        endpoints optionally lists several OpenAI-compatible servers
+        (``base_url``, ``api_key``, ``weight``) to balance requests across;
+        otherwise base_url/api_key are the only endpoint. An offline
+        generator only renders prompts and builds records: it has no API
+        clients and no response cache, and raises if asked to call the API.
+        """
+        self.offline = offline
+        self.endpoints = None
+        self.client = None
+        if not offline:
+            self.endpoints = EndpointPool(
+                endpoints or [{"base_url": base_url, "api_key": api_key}],
+                failure_threshold=API_CONFIG.get("failure_threshold", 3),
+                ejection_seconds=API_CONFIG.get("ejection_seconds", 30),
+                health_check_interval=API_CONFIG.get("health_check_interval", 10),
+                # Retries are handled by call_api_with_retry, not inside the client
+                client_options={"max_retries": 0}
+            )
+            self.client = self.endpoints.endpoints[0].client
         self.model = model
         self.max_retries = GENERATION_CONFIG["max_retries"]
         self.retry_delay = GENERATION_CONFIG["retry_delay"]
+        self.max_backoff = GENERATION_CONFIG.get("max_backoff", 60)
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=GENERATION_CONFIG.get("requests_per_minute"),
+            tokens_per_minute=GENERATION_CONFIG.get("tokens_per_minute")
+        )
+        self.token_budget = TokenBudget(GENERATION_CONFIG.get("token_budget"))
+        self.concurrency_limit = AdaptiveConcurrency(
+            GENERATION_CONFIG.get("max_in_flight_requests", 256)
+        )
+        self.retries = 0
+        self._retries_lock = threading.Lock()
+        self.metrics = MetricsRecorder()
+        self.max_concurrency = max(1, GENERATION_CONFIG.get("max_concurrency", 1))
+        self.samples_per_scenario = max(1, GENERATION_CONFIG.get("samples_per_scenario", 1))
+        self.supports_n = GENERATION_CONFIG.get("use_n_parameter", True)
+        self.stream = GENERATION_CONFIG.get("stream", False)
+        self.truncation_retry_factor = GENERATION_CONFIG.get("truncation_retry_factor", 1.5)
+        self.stage_retries = max(0, GENERATION_CONFIG.get("stage_retries", 2))
+        self.structured_output = GENERATION_CONFIG.get("structured_output", "json_object")
+        self.stage_retry_count = 0
+        self.prefix_order = GENERATION_CONFIG.get("prefix_order", False)
+        self.prefix_order_window = GENERATION_CONFIG.get("prefix_order_window", 256)
+        self.prefix_stats: List[Dict] = []
+        self.pipeline = GENERATION_CONFIG.get("pipeline", False)
+        self.query_concurrency = GENERATION_CONFIG.get("query_concurrency", 4)
+        self.response_concurrency = GENERATION_CONFIG.get("response_concurrency", 8)
+        self.pipeline_queue_size = GENERATION_CONFIG.get("pipeline_queue_size", 16)
+        self.pipeline_stats: Dict[str, Dict] = {}
+        self.dedup_stats = {"resampled": 0, "rejected": 0}
+        self.record_format = OUTPUT_CONFIG.get("record_format", "full")
+        self.templates = TemplateRegistry(CACHE_CONFIG.get("template_bytecode_dir"))
+        self.cache = None
+        if CACHE_CONFIG.get("enabled", False) and not offline:
+            self.cache = ResponseCache(
+                CACHE_CONFIG["path"],
+                max_size_mb=CACHE_CONFIG.get("max_size_mb", 512),
+                bypass=CACHE_CONFIG.get("bypass", False)
+            )
     
     def load_data(self, data_path: str) -> Dict:
         """Load simplified data file"""
@@ -41,93 +129,475 @@ class DialogueGenerator:
         steps = flow_definitions[flow_type]["steps"]
         return f"{flow_type}: {' --> '.join(steps)}"
     
-    def call_api_with_retry(self, messages: List[Dict], max_tokens: int = 1024, temperature: float = 0.7) -> str:
-        """Call API with retry mechanism"""
+    def call_api_with_retry(self, messages: List[Dict], max_tokens: int = 1024, temperature: float = 0.7,
+                            stage: str = "", category: str = "") -> str:
+        """
+        Call API with retry mechanism, serving repeated requests from the cache.
+        
+        Requests wait for the rate limits, fatal errors (bad request, auth)
+        are raised at once, and retryable ones back off exponentially with
+        jitter or for as long as the server's Retry-After asks. stage and
+        category label the call in self.metrics.
+        """
+        return self.call_api_samples(messages, [0], max_tokens=max_tokens, temperature=temperature,
+                                     stage=stage, category=category)[0]
+    
+    def call_api_samples(self, messages: List[Dict], sample_ids: List[int], max_tokens: int = 1024,
+                         temperature: float = 0.7, stage: str = "", category: str = "",
+                         request_params: Optional[Dict] = None,
+                         validate: Optional[Callable[[str], bool]] = None) -> List[str]:
+        """
+        Get one completion per sample id for the same messages.
+        
+        Samples are cached individually. Missing samples are requested in a
+        single call with ``n`` so the prompt prefill is shared; if the server
+        rejects or ignores ``n``, the remaining samples fall back to parallel
+        single-completion calls. request_params are passed on to the API
+        (e.g. response_format). With validate given, only completions it
+        accepts are cached or served from the cache.
+        """
+        completions: Dict[int, str] = {}
+        cache_keys: Dict[int, str] = {}
+        if self.cache is not None:
+            for sample_id in sample_ids:
+                params = {"max_tokens": max_tokens, "temperature": temperature}
+                if sample_id:
+                    # Sample 0 keeps the single-completion key
+                    params["sample"] = sample_id
+                if request_params:
+                    params["request_params"] = request_params
+                cache_keys[sample_id] = ResponseCache.make_key(self.model, messages, **params)
+                cached = self.cache.get(cache_keys[sample_id])
+                if cached is not None and (validate is None or validate(cached)):
+                    completions[sample_id] = cached
+        
+        missing = [sample_id for sample_id in sample_ids if sample_id not in completions]
+        fresh: Dict[int, str] = {}
+        if len(missing) > 1 and self.supports_n:
+            try:
+                choices = self._create_completion(messages, max_tokens, temperature, n=len(missing),
+                                                  stage=stage, category=category,
+                                                  request_params=request_params)
+            except Exception as e:
+                # Budget, auth and other request errors would fail the single calls too
+                if not rejects_parameter(e, "n"):
+                    raise
+                print(f"Server rejected n={len(missing)}, falling back to single completions: {e}")
+                choices = []
+            if len(choices) < len(missing):
+                if choices:
+                    print(f"Server returned {len(choices)} of {len(missing)} requested "
+                          "completions, falling back to single completions")
+                self.supports_n = False
+            fresh.update(zip(missing, choices))
+            missing = missing[len(choices):]
+        
+        if len(missing) == 1:
+            fresh[missing[0]] = self._create_completion(messages, max_tokens, temperature,
+                                                        stage=stage, category=category,
+                                                        request_params=request_params)[0]
+        elif missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                futures = {
+                    sample_id: executor.submit(self._create_completion, messages, max_tokens,
+                                               temperature, stage=stage, category=category,
+                                               request_params=request_params)
+                    for sample_id in missing
+                }
+                for sample_id, future in futures.items():
+                    fresh[sample_id] = future.result()[0]
+        
+        for sample_id, content in fresh.items():
+            if sample_id in cache_keys and (validate is None or validate(content)):
+                self.cache.put(cache_keys[sample_id], content)
+        completions.update(fresh)
+        return [completions[sample_id] for sample_id in sample_ids]
+    
+    def _create_completion(self, messages: List[Dict], max_tokens: int, temperature: float,
+                           n: int = 1, stage: str = "", category: str = "",
+                           request_params: Optional[Dict] = None) -> List[str]:
+        """One chat completion request (with retries) returning the text of every choice"""
+        if self.endpoints is None:
+            raise RuntimeError("this generator was created offline and cannot call the API")
+        prompt_tokens_estimate = len(json.dumps(messages, ensure_ascii=False)) // 4
+        params = dict(request_params or {})
+        if n > 1:
+            params["n"] = n
+        stream = self.stream and n == 1
+        endpoint_url = ""
         for attempt in range(self.max_retries):
+            # Truncation retries raise max_tokens, so re-estimate every attempt
+            estimated_tokens = prompt_tokens_estimate + max_tokens * n
+            self.token_budget.reserve(estimated_tokens)
+            self.rate_limiter.acquire(estimated_tokens)
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature
+                with self.concurrency_limit, self.endpoints.lease() as endpoint:
+                    endpoint_url = endpoint.base_url
+                    start = time.perf_counter()
+                    ttft = None
+                    if stream:
+                        contents, finish_reasons, usage, ttft = self._stream_completion(
+                            endpoint.client, messages, max_tokens, temperature, start, params
+                        )
+                    else:
+                        response = endpoint.client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            **params
+                        )
+                        usage = getattr(response, "usage", None)
+                        contents = [choice.message.content for choice in response.choices]
+                        finish_reasons = [choice.finish_reason for choice in response.choices]
+                    latency = time.perf_counter() - start
+                self.concurrency_limit.on_success()
+                self.rate_limiter.settle(estimated_tokens, getattr(usage, "total_tokens", None))
+                self.token_budget.settle(estimated_tokens, getattr(usage, "total_tokens", None))
+                self.metrics.record(
+                    stage=stage,
+                    category=category,
+                    endpoint=endpoint_url,
+                    prompt_tokens=getattr(usage, "prompt_tokens", None) or 0,
+                    completion_tokens=getattr(usage, "completion_tokens", None) or 0,
+                    latency=latency,
+                    ttft=ttft,
+                    retries=attempt,
+                    truncated="length" in finish_reasons
                 )
-                return response.choices[0].message.content.strip()
+                return [(content or "").strip() for content in contents]
+            except StreamAborted as e:
+                self.token_budget.settle(estimated_tokens, prompt_tokens_estimate + len(e.content) // 4)
+                print(f"API call attempt {attempt + 1} aborted: {e.reason}")
+                if attempt == self.max_retries - 1:
+                    # Out of attempts: hand the partial text to the caller to extract or retry
+                    self.metrics.record(stage=stage, category=category, endpoint=endpoint_url,
+                                        retries=attempt, truncated=e.reason == "truncated")
+                    return [e.content.strip()]
+                with self._retries_lock:
+                    self.retries += 1
+                if e.reason == "truncated":
+                    max_tokens = int(max_tokens * self.truncation_retry_factor)
+                # Nothing is wrong with the server, so retry straight away
+                continue
             except Exception as e:
-                print(f"API call attempt {attempt + 1} failed: {e}")
-                if attempt < self.max_retries - 1:
-                    import time
-                    time.sleep(self.retry_delay)
-                else:
+                self.token_budget.settle(estimated_tokens, 0)
+                kind = classify_error(e)
+                print(f"API call attempt {attempt + 1} failed ({kind}): {e}")
+                if kind == FATAL or attempt == self.max_retries - 1:
+                    self.metrics.record(stage=stage, category=category, endpoint=endpoint_url,
+                                        retries=attempt, ok=False)
                     raise e
+                with self._retries_lock:
+                    self.retries += 1
+                if kind == OVERLOADED:
+                    self.concurrency_limit.on_overload()
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = backoff_delay(attempt, self.retry_delay, self.max_backoff)
+                time.sleep(delay)
+    
+    def _stream_completion(self, client, messages: List[Dict], max_tokens: int, temperature: float,
+                           start: float, params: Optional[Dict] = None):
+        """
+        Stream one completion, validating its JSON as it arrives.
+        
+        Returns ([content], [finish_reason], usage, time to first token).
+        Raises StreamAborted, after closing the connection so the server stops
+        decoding, once the output is clearly malformed; a completion cut off
+        at max_tokens is reported the same way once it ends.
+        """
+        stream = client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            **(params or {})
+        )
+        validator = JSONPrefixValidator()
+        parts = []
+        finish_reason = None
+        usage = None
+        ttft = None
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                text = choice.delta.content if choice.delta is not None else None
+                if text:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    parts.append(text)
+                    if validator.feed(text) == MALFORMED:
+                        raise StreamAborted(f"malformed JSON ({validator.error})", "".join(parts))
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        finally:
+            stream.close()
+        
+        content = "".join(parts)
+        if finish_reason == "length" and validator.state != COMPLETE:
+            raise StreamAborted("truncated", content)
+        return [content], [finish_reason], usage, ttft
     
     def extract_json_from_response(self, response: str) -> Dict:
-        """Extract JSON from API response"""
-        # Remove code block markers if present
-        if response.startswith("```json") and response.endswith("```"):
-            response = response[len("```json"):-len("```")].strip()
-        elif response.startswith("```") and response.endswith("```"):
-            response = response[len("```"):-len("```")].strip()
+        """Extract JSON from API response, tolerating preambles, fences and small defects"""
+        return extract_json(response)
+    
+    def structured_output_params(self) -> Dict:
+        """Extra request parameters constraining a completion to the turns schema"""
+        if self.structured_output == "json_object":
+            return {"response_format": {"type": "json_object"}}
+        if self.structured_output == "json_schema":
+            return {"response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "turns", "schema": TURNS_SCHEMA}
+            }}
+        if self.structured_output == "guided_json":
+            # vLLM / SGLang guided decoding
+            return {"extra_body": {"guided_json": TURNS_SCHEMA}}
+        return {}
+    
+    def generate_turns(self, messages: List[Dict], sample_ids: List[int], max_tokens: int,
+                       temperature: float, stage: str, category: str,
+                       expected: int = 0) -> List[Optional[List[str]]]:
+        """
+        One list of turns per sample id, or None for samples that stay unusable.
+        
+        Completions whose turns cannot be extracted are re-requested (only
+        those samples) up to stage_retries times, with structured output
+        enabled on the retries when the server supports it.
+        """
+        def parse(completion: str) -> List[str]:
+            return turns_from(self.extract_json_from_response(completion), expected)
+        
+        def usable(completion: str) -> bool:
+            try:
+                parse(completion)
+                return True
+            except ExtractionError:
+                return False
         
-        return json.loads(response)
+        results: Dict[int, List[str]] = {}
+        pending = list(sample_ids)
+        attempt = 0
+        while pending and attempt <= self.stage_retries:
+            request_params = self.structured_output_params() if attempt else {}
+            try:
+                completions = self.call_api_samples(
+                    messages, pending, max_tokens=max_tokens, temperature=temperature,
+                    stage=stage, category=category, request_params=request_params,
+                    validate=usable
+                )
+            except Exception as e:
+                if not request_params or classify_error(e) != FATAL or isinstance(e, BudgetExceeded):
+                    raise
+                print(f"⚠ Server rejected structured output ({self.structured_output}), "
+                      f"retrying without it: {e}")
+                self.structured_output = None
+                continue
+            failed = []
+            for sample_id, completion in zip(pending, completions):
+                try:
+                    results[sample_id] = parse(completion)
+                except ExtractionError as e:
+                    print(f"⚠ Unusable {stage} completion: {e}")
+                    failed.append(sample_id)
+            pending = failed
+            attempt += 1
+            if pending and attempt <= self.stage_retries:
+                with self._retries_lock:
+                    self.stage_retry_count += len(pending)
+                print(f"Retrying {stage} stage for {len(pending)} sample(s) "
+                      f"({attempt}/{self.stage_retries})")
+        return [results.get(sample_id) for sample_id in sample_ids]
     
-    def generate_queries(self, category: str, scenario: str, query_prompt_template: str, 
-                        flow_steps: str = "") -> List[str]:
-        """Generate query questions using original prompt format"""
+    def get_template(self, template: Union[str, Template]) -> Template:
+        """
+        Compiled template for a template file path or template source.
+        
+        Template files go through the registry's loader, so they use the
+        bytecode cache and are recompiled when the file changes; sources
+        (e.g. from load_prompt_template) are compiled once per distinct text.
+        """
+        if isinstance(template, Template):
+            return template
+        if "\n" not in template and os.path.isfile(template):
+            return self.templates.get(template)
+        return self.templates.from_string(template)
+    
+    def render_query_prompt(self, category: str, scenario: str,
+                            query_prompt_template: Union[str, Template],
+                            flow_steps: str = "") -> str:
+        """Render the query-stage prompt"""
         context = f"{category} - {scenario}"
         
         # Generate prompt using Jinja2 template
-        template = Template(query_prompt_template)
-        prompt = template.render(
+        return self.get_template(query_prompt_template).render(
             context=context,
             info_flows_steps=flow_steps
         )
+    
+    def render_response_prompt(self, category: str, scenario: str, queries: List[str],
+                               response_prompt_template: Union[str, Template]) -> str:
+        """Render the response-stage prompt"""
+        context = f"{category} - {scenario}\n\nQuestions:\n" + "\n".join([f"Question {i+1}: {q}" for i, q in enumerate(queries)])
         
+        # Generate prompt using Jinja2 template
+        return self.get_template(response_prompt_template).render(context=context)
+    
+    def generate_queries(self, category: str, scenario: str, query_prompt_template: str, 
+                        flow_steps: str = "") -> List[str]:
+        """Generate query questions using original prompt format"""
+        queries = self.generate_query_samples(category, scenario, query_prompt_template, flow_steps)[0]
+        if queries is None:
+            raise ExtractionError(f"no usable queries for {category} - {scenario}")
+        return queries
+    
+    def generate_query_samples(self, category: str, scenario: str, query_prompt_template: str,
+                               flow_steps: str = "",
+                               sample_ids: Optional[List[int]] = None) -> List[Optional[List[str]]]:
+        """Generate one query set per sample id from a single shared prompt, None where it failed"""
+        sample_ids = sample_ids or [0]
+        context = f"{category} - {scenario}"
+        prompt = self.render_query_prompt(category, scenario, query_prompt_template, flow_steps)
         messages = [{"role": "user", "content": prompt}]
         
-        print(f"Generating query questions: {context}")
-        response = self.call_api_with_retry(
+        print(f"Generating query questions: {context}"
+              + (f" ({len(sample_ids)} samples)" if len(sample_ids) > 1 else ""))
+        return self.generate_turns(
             messages, 
+            sample_ids,
             max_tokens=GENERATION_CONFIG["max_tokens_query"], 
-            temperature=GENERATION_CONFIG["temperature_query"]
+            temperature=GENERATION_CONFIG["temperature_query"],
+            stage="query",
+            category=category
         )
-        
-        try:
-            result = self.extract_json_from_response(response)
-            queries = result.get("turns", [])
-            return queries
-            
-        except Exception as e:
-            print(f"Failed to generate queries: {e}")
-            # Return default queries
-            return [f"Question {i+1} about {scenario}" for i in range(4)]
     
     def generate_responses(self, category: str, scenario: str, queries: List[str], 
-                          response_prompt_template: str) -> List[str]:
-        """Generate responses using original prompt format"""
-        context = f"{category} - {scenario}\n\nQuestions:\n" + "\n".join([f"Question {i+1}: {q}" for i, q in enumerate(queries)])
-        
-        # Generate prompt using Jinja2 template
-        template = Template(response_prompt_template)
-        prompt = template.render(context=context)
-        
+                          response_prompt_template: str, sample_id: int = 0) -> List[str]:
+        """Generate responses using original prompt format, one per query (sample_id keys the cache entry)"""
+        prompt = self.render_response_prompt(category, scenario, queries, response_prompt_template)
         messages = [{"role": "user", "content": prompt}]
         
         print(f"Generating responses: {category} - {scenario}")
-        response = self.call_api_with_retry(
+        responses = self.generate_turns(
             messages, 
+            [sample_id],
             max_tokens=GENERATION_CONFIG["max_tokens_response"], 
-            temperature=GENERATION_CONFIG["temperature_response"]
-        )
+            temperature=GENERATION_CONFIG["temperature_response"],
+            stage="response",
+            category=category,
+            expected=len(queries)
+        )[0]
+        if responses is None:
+            raise ExtractionError(f"no usable responses for {category} - {scenario}")
+        return responses
+    
+    def run_query_stage(self, category: str, scenario: str, flow_type: str,
+                        query_prompt_template: str, flow_definitions: Dict) -> List[str]:
+        """Format flow steps and generate query questions"""
+        queries = self.run_query_stage_samples(category, scenario, flow_type,
+                                               query_prompt_template, flow_definitions)[0]
+        if queries is None:
+            raise ExtractionError(f"no usable queries for {category} - {scenario}")
+        return queries
+    
+    def run_query_stage_samples(self, category: str, scenario: str, flow_type: str,
+                                query_prompt_template: str, flow_definitions: Dict,
+                                sample_ids: Optional[List[int]] = None) -> List[Optional[List[str]]]:
+        """Format flow steps and generate one query set per sample id (None where it failed)"""
+        # Format flow steps
+        flow_steps = self.format_flow_steps(flow_type, flow_definitions)
+        if flow_steps:
+            print(f"✓ Using flow type: {flow_type}")
         
-        try:
-            result = self.extract_json_from_response(response)
-            responses = result.get("turns", [])
-            return responses
-            
-        except Exception as e:
-            print(f"Failed to generate responses: {e}")
-            # Return default responses
-            return [f"Response {i+1} about {scenario}" for i in range(len(queries))]
+        query_sets = self.generate_query_samples(category, scenario, query_prompt_template,
+                                                 flow_steps, sample_ids)
+        for queries in query_sets:
+            if queries is None:
+                print(f"❌ Query generation failed: {category} - {scenario}")
+            else:
+                print(f"✓ Query generation completed: {len(queries)} questions")
+        return query_sets
+    
+    def run_response_stage(self, category: str, scenario: str, queries: List[str],
+                           response_prompt_template: str, sample_id: Optional[int] = None,
+                           resample_id: int = 0) -> Dict:
+        """Generate responses and merge them with the queries into a dialogue"""
+        responses = self.generate_responses(category, scenario, queries, response_prompt_template,
+                                            resample_id)
+        print(f"✓ Response generation completed: {len(responses)} responses")
+        
+        dialogue_data = self.build_dialogue(category, scenario, queries, responses, sample_id)
+        print(f"✓ Dialogue generation completed: {turn_count(dialogue_data)} turns")
+        return dialogue_data
+    
+    def dedupe_queries(self, index: MinHashIndex, item: WorkItem, queries: List[str],
+                       query_prompt_template: str, flow_definitions: Dict) -> List[str]:
+        """
+        Add an item's queries to the dedup index, resampling near-duplicates.
+        
+        Resamples use sample ids past samples_per_scenario so they get their
+        own cache entries. Raises DuplicateQueries when every attempt is a
+        near-duplicate.
+        """
+        max_resamples = max(0, DEDUP_CONFIG.get("max_resamples", 1))
+        for attempt in range(max_resamples + 1):
+            match = index.add(item.key, queries)
+            if match is None:
+                return queries
+            duplicate_of, similarity = match
+            if attempt == max_resamples:
+                break
+            print(f"⚠ Queries for {item.context} duplicate {duplicate_of} "
+                  f"(similarity {similarity:.2f}), resampling")
+            with self._retries_lock:
+                self.dedup_stats["resampled"] += 1
+            resample_id = item.sample_id + self.samples_per_scenario * (attempt + 1)
+            queries = self.run_query_stage_samples(item.category, item.scenario, item.flow_type,
+                                                   query_prompt_template, flow_definitions,
+                                                   [resample_id])[0]
+            if queries is None:
+                raise ExtractionError(f"no usable queries when resampling {item.context}")
+        with self._retries_lock:
+            self.dedup_stats["rejected"] += 1
+        raise DuplicateQueries(f"queries duplicate {duplicate_of} (similarity {similarity:.2f})")
+    
+    def regeneration_id(self, item: WorkItem, attempt: int) -> int:
+        """
+        Sample id for the calls of an item's attempt-th regeneration (0 = first generation).
+        
+        Regenerations get sample ids past the ones dedupe_queries resamples
+        with, so they never reuse a cached completion.
+        """
+        if not attempt:
+            return item.sample_id
+        resamples = max(0, DEDUP_CONFIG.get("max_resamples", 1))
+        return item.sample_id + self.samples_per_scenario * (resamples + attempt)
+    
+    def build_dialogue(self, category: str, scenario: str, queries: List[str],
+                       responses: List[str], sample_id: Optional[int] = None) -> Dict:
+        """
+        Merge queries and responses into a dialogue record, tagged with sample_id if given.
+        
+        Compact records (OUTPUT_CONFIG["record_format"]) leave out the turns,
+        which repeat every query and response; see records.py.
+        """
+        dialogue_data = {"category": f"{category} - {scenario}"}
+        if self.record_format != "compact":
+            # Construct dialogue turns
+            dialogue_data["turns"] = build_turns(queries, responses)
+        dialogue_data["queries"] = queries
+        dialogue_data["responses"] = responses
+        if sample_id is not None:
+            dialogue_data["sample_id"] = sample_id
+        return dialogue_data
     
     def generate_dialogue(self, category: str, scenario: str, flow_type: str, 
                          query_prompt_template: str, response_prompt_template: str, 
@@ -135,77 +605,303 @@ class DialogueGenerator:
         """Generate complete multi-turn dialogue"""
         print(f"\nStarting dialogue generation: {category} - {scenario}")
         
-        # Format flow steps
-        flow_steps = self.format_flow_steps(flow_type, flow_definitions)
-        if flow_steps:
-            print(f"✓ Using flow type: {flow_type}")
-        
         # Step 1: Generate query questions
-        queries = self.generate_queries(category, scenario, query_prompt_template, flow_steps)
-        print(f"✓ Query generation completed: {len(queries)} questions")
+        queries = self.run_query_stage(category, scenario, flow_type,
+                                       query_prompt_template, flow_definitions)
         
-        # Step 2: Generate responses
-        responses = self.generate_responses(category, scenario, queries, response_prompt_template)
-        print(f"✓ Response generation completed: {len(responses)} responses")
+        # Step 2: Generate responses and construct dialogue turns
+        return self.run_response_stage(category, scenario, queries, response_prompt_template)
+    
+    def batch_generate(self, data: Union[Dict, ScenarioStream], query_prompt_template: str, response_prompt_template: str, 
+                       output_file: str, resume: bool = False, shard_index: int = 0,
+                       num_shards: int = 1) -> int:
+        """
+        Batch generate dialogue data using simplified structure.
         
-        # Step 3: Construct dialogue turns
-        turns = []
-        for i in range(min(len(queries), len(responses))):
-            turns.append({
-                "human": queries[i],
-                "assistant": responses[i]
-            })
-        
-        dialogue_data = {
-            "category": f"{category} - {scenario}",
-            "turns": turns,
-            "queries": queries,
-            "responses": responses
-        }
+        Each dialogue is appended to a JSONL stream as soon as it is generated.
+        When output_file is a .json path, the stream is converted into a JSON
+        array at the end of the run (see OUTPUT_CONFIG["finalize_json"]).
+        With resume set, dialogues already in the stream or checkpoint are
+        skipped and items with checkpointed queries restart at the response
+        stage. With num_shards > 1 only the work items hashed to shard_index
+        are generated (see sharding.py); pass each shard its own output_file.
+        data may be a ScenarioStream (see scenario_loader.py), which is read
+        lazily instead of being held in memory.
+        Returns the number of dialogues in the output.
+        """
+        # Run state shared by the engine threads; see batch_run.py for who calls what
+        run = BatchRun(self, data, query_prompt_template, response_prompt_template, output_file,
+                       resume=resume, shard_index=shard_index, num_shards=num_shards)
+        pending, total = run.pending()
+        groups = (list(items) for _, items in
+                  groupby(pending, key=lambda item: (item.category, item.scenario)))
+        if self.prefix_order:
+            groups = order_by_prefix(
+                groups,
+                lambda item: self.render_query_prompt(
+                    item.category, item.scenario, query_prompt_template,
+                    self.format_flow_steps(item.flow_type, run.flow_definitions)
+                ),
+                window=self.prefix_order_window,
+                report=self._report_prefix_batch
+            )
+        if run.materialize:
+            groups = list(groups)
+        scheduler = run.scheduler
+        if scheduler is not None:
+            scheduler.feed(groups)
+            groups = scheduler.groups()
+            if scheduler.has_quotas:
+                # Quotas decide how much of the pending work runs
+                total = None
         
-        print(f"✓ Dialogue generation completed: {len(turns)} turns")
-        return dialogue_data
-    
-    def batch_generate(self, data: Dict, query_prompt_template: str, response_prompt_template: str, 
-                       output_file: str):
-        """Batch generate dialogue data using simplified structure"""
-        all_dialogues = []
+        with run:
+            self._run_batch_round(run, groups, total)
+            # Dialogues still being validated when the engine ran out of
+            # scenarios can be rejected afterwards, and quota capacity held by
+            # dialogues that failed frees up; both get extra rounds
+            while not self.token_budget.exceeded:
+                if run.validation_pool is not None:
+                    run.validation_pool.drain()
+                if run.requeue and run.requeued:
+                    print(f"\nRegenerating {len(run.requeued)} rejected dialogues")
+                    self._run_batch_round(run, (), len(run.requeued))
+                elif scheduler is not None and scheduler.pending():
+                    print("\nScheduling more dialogues for unfilled quotas")
+                    self._run_batch_round(run, scheduler.groups(), None)
+                else:
+                    break
+        
+        total = run.total
+        run.report()
+        if self.endpoints is not None and len(self.endpoints.endpoints) > 1:
+            for stats in self.endpoints.stats():
+                print(f"✓ Endpoint {stats['base_url']}: {stats['requests']} requests, "
+                      f"{stats['failures']} failures, healthy={stats['healthy']}")
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"✓ Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+                  f"{stats['entries']} entries")
+        self._report_metrics(shard_output_path(OUTPUT_CONFIG["metrics_file"], shard_index, num_shards)
+                             if OUTPUT_CONFIG.get("metrics_file") else None)
         
-        categories = data.get("categories", {})
-        flow_definitions = data.get("flow_definitions", {})
+        if run.stream_file != output_file and OUTPUT_CONFIG.get("finalize_json", True):
+            finalize_to_json(
+                run.stream_file,
+                output_file,
+                ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                indent=OUTPUT_CONFIG["indent"]
+            )
+            print(f"✓ Finalized {run.stream_file} into {output_file}")
         
-        for category_name, category_data in categories.items():
+        return total
+    
+    def _within_budget(self, groups: Iterable[List[WorkItem]]) -> Iterator[List[WorkItem]]:
+        """Stop handing out scenario groups once the token budget has been hit"""
+        for group in groups:
+            if self.token_budget.exceeded:
+                print(f"\n⚠ Token budget of {self.token_budget.limit} tokens reached; "
+                      f"remaining dialogues are not started (resume to continue)")
+                return
+            yield group
+    
+    def _run_batch_round(self, run: BatchRun, groups: Iterable[List[WorkItem]], total: Optional[int]):
+        """Generate groups, and items requeued after validation, on the configured engine"""
+        if run.requeue:
+            groups = run.with_requeued(groups)
+        if self.token_budget.limit is not None:
+            groups = self._within_budget(groups)
+        stages = (run.query_stage, run.response_stage, run.save, run.fail)
+        if self.pipeline:
+            self._batch_generate_pipelined(groups, total, *stages)
+        elif self.max_concurrency > 1 or run.scheduler is not None:
+            # The sequential engine groups by category, which would undo the interleaving
+            self._batch_generate_concurrent(groups, total, *stages)
+        else:
+            self._batch_generate_sequential(groups, total, *stages)
+    
+    def _batch_generate_sequential(self, groups: Iterable[List[WorkItem]], total: Optional[int],
+                                   query_stage: Callable[[List[WorkItem]], List[Tuple[WorkItem, List[str]]]],
+                                   response_stage: Callable[[WorkItem, List[str]], Dict],
+                                   save: Callable[[WorkItem, Dict], None],
+                                   fail: Callable[[List[WorkItem], Exception], None]):
+        """Generate dialogues one scenario at a time in category order (total None if unknown)"""
+        for category_name, category_groups in groupby(groups, key=lambda group: group[0].category):
             print(f"\nProcessing category: {category_name}")
             
-            scenarios = category_data.get("scenarios", [])
-            flow_type = category_data.get("flow_type", "")
+            category_total = None
+            if total is not None:
+                category_groups = list(category_groups)
+                category_total = sum(len(group) for group in category_groups)
+            with tqdm(total=category_total, desc=f"Processing {category_name}") as progress:
+                for group in category_groups:
+                    try:
+                        pairs = query_stage(group)
+                    except Exception as e:
+                        fail(group, e)
+                        progress.update(len(group))
+                        continue
+                    for item, queries in pairs:
+                        try:
+                            save(item, response_stage(item, queries))
+                        except Exception as e:
+                            fail([item], e)
+                        progress.update(1)
+    
+    def _batch_generate_concurrent(self, groups: Iterable[List[WorkItem]], total: Optional[int],
+                                   query_stage: Callable[[List[WorkItem]], List[Tuple[WorkItem, List[str]]]],
+                                   response_stage: Callable[[WorkItem, List[str]], Dict],
+                                   save: Callable[[WorkItem, Dict], None],
+                                   fail: Callable[[List[WorkItem], Exception], None]):
+        """
+        Generate dialogues on a thread pool with at most max_concurrency in flight.
+        
+        Finished dialogues are held in a reorder buffer and saved in the order
+        their items were handed in, so the output matches a sequential run.
+        """
+        print(f"\nGenerating {total if total is not None else 'streamed'} dialogues "
+              f"with max_concurrency={self.max_concurrency}")
+        
+        def finish(item: WorkItem, dialogue: Optional[Dict]):
+            # None marks an item that failed; it only advances the save position
+            nonlocal next_save
+            finished[order.pop(item)] = (item, dialogue)
+            while next_save in finished:
+                item, dialogue = finished.pop(next_save)
+                next_save += 1
+                if dialogue is not None:
+                    # Records are saved in input order, from this thread only
+                    save(item, dialogue)
+                    progress.update(1)
+                    progress.set_postfix({"tok/s": int(self.metrics.tokens_per_second())})
+        
+        def handle(future):
+            stage, work = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                items = work if stage == "query" else [work]
+                fail(items, e)
+                progress.update(len(items))
+                for item in items:
+                    finish(item, None)
+                return
+            if stage == "query":
+                # Every sample's query set fans out to its own response call
+                ready.extend(result)
+                returned = {item for item, _ in result}
+                for item in work:
+                    if item not in returned:
+                        finish(item, None)
+                return
+            finish(work, result)
+        
+        futures = {}
+        ready = deque()
+        # Input position of every item handed in and not yet saved, and the
+        # finished dialogues waiting for an earlier item to complete
+        order: Dict[WorkItem, int] = {}
+        finished: Dict[int, Tuple[WorkItem, Optional[Dict]]] = {}
+        next_index = next_save = 0
+        # A slow early item holds back later results; stop pulling new
+        # scenarios rather than buffer without limit
+        max_buffered = self.max_concurrency * 4
+        pending_groups = iter(groups)
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor, \
+                tqdm(total=total, desc="Generating dialogues") as progress:
+            while True:
+                # Only submit when a worker is free so the number of in-flight
+                # requests never exceeds max_concurrency. Pending responses go
+                # first so finished query sets do not pile up.
+                while len(futures) < self.max_concurrency:
+                    if ready:
+                        item, queries = ready.popleft()
+                        futures[executor.submit(response_stage, item, queries)] = ("response", item)
+                        continue
+                    if exhausted or len(finished) >= max_buffered:
+                        break
+                    group = next(pending_groups, None)
+                    if group is None:
+                        exhausted = True
+                        break
+                    for item in group:
+                        order[item] = next_index
+                        next_index += 1
+                    futures[executor.submit(query_stage, group)] = ("query", group)
+                
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future)
+    
+    def _batch_generate_pipelined(self, groups: Iterable[List[WorkItem]], total: Optional[int],
+                                  query_stage: Callable[[List[WorkItem]], List[Tuple[WorkItem, List[str]]]],
+                                  response_stage: Callable[[WorkItem, List[str]], Dict],
+                                  save: Callable[[WorkItem, Dict], None],
+                                  fail: Callable[[List[WorkItem], Exception], None]):
+        """Overlap query and response stages on separate bounded worker pools"""
+        pipeline = TwoStagePipeline(
+            query_stage,
+            response_stage,
+            query_concurrency=self.query_concurrency,
+            response_concurrency=self.response_concurrency,
+            queue_size=self.pipeline_queue_size
+        )
+        print(f"\nGenerating {total if total is not None else 'streamed'} dialogues "
+              f"with a two-stage pipeline "
+              f"(query_concurrency={pipeline.query_concurrency}, "
+              f"response_concurrency={pipeline.response_concurrency})")
+        
+        with tqdm(total=total, desc="Generating dialogues") as progress:
+            postfix_due = 0.0
+            
+            def on_result(item: WorkItem, dialogue: Dict):
+                nonlocal postfix_due
+                save(item, dialogue)
+                progress.update(1)
+                # The postfix is refreshed at most once a second, off the per-result path
+                if time.monotonic() >= postfix_due:
+                    progress.set_postfix(self._pipeline_postfix(pipeline.queue_depths()))
+                    postfix_due = time.monotonic() + 1.0
             
-            for i, scenario in enumerate(tqdm(scenarios, desc=f"Processing {category_name}")):
-                try:
-                    dialogue = self.generate_dialogue(
-                        category=category_name,
-                        scenario=scenario,
-                        flow_type=flow_type,
-                        query_prompt_template=query_prompt_template,
-                        response_prompt_template=response_prompt_template,
-                        flow_definitions=flow_definitions
-                    )
-                    all_dialogues.append(dialogue)
-                    
-                    # Save to file in real-time
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(
-                            all_dialogues, 
-                            f, 
-                            ensure_ascii=OUTPUT_CONFIG["ensure_ascii"], 
-                            indent=OUTPUT_CONFIG["indent"]
-                        )
-                    
-                    print(f"✓ Saved {len(all_dialogues)} dialogues")
-                    
-                except Exception as e:
-                    print(f"Failed to generate dialogue {category_name} - {scenario}: {e}")
-                    continue
+            def on_error(item: WorkItem, error: Exception):
+                fail([item], error)
+                progress.update(1)
+            
+            pipeline.run(groups, on_result, on_error)
         
-        print(f"\nBatch generation completed, total generated: {len(all_dialogues)} dialogues")
-        return all_dialogues
+        self.pipeline_stats = pipeline.stats()
+        for stage, stats in self.pipeline_stats.items():
+            print(f"✓ {stage} stage: {stats['completed']} completed, {stats['failed']} failed, "
+                  f"max queue depth {stats['max_queue_depth']}, "
+                  f"latency p50 {stats['latency_p50']:.2f}s / p99 {stats['latency_p99']:.2f}s")
+    
+    def _report_prefix_batch(self, stats: Dict):
+        """Print and keep the shared-prefix statistics of one ordered batch"""
+        self.prefix_stats.append(stats)
+        print(f"✓ Prefix-ordered batch {stats['batch']}: {stats['requests']} query requests, "
+              f"shared prefix {stats['shared_prefix_ratio']:.1%} "
+              f"(arrival order {stats['arrival_shared_prefix_ratio']:.1%})")
+    
+    def _pipeline_postfix(self, queue_depths: Dict[str, int]) -> Dict[str, int]:
+        """Compact per-stage queue depth and token throughput for the progress bar"""
+        return {
+            "query_queue": queue_depths["query"],
+            "response_queue": queue_depths["response"],
+            "tok/s": int(self.metrics.tokens_per_second()),
+        }
+    
+    def _report_metrics(self, metrics_file: Optional[str] = None):
+        """Print per-stage token usage and latency, and write them to metrics_file if given"""
+        snapshot = self.metrics.snapshot()
+        for stage, stats in snapshot["by_stage"].items():
+            print(f"✓ {stage} calls: {stats['calls']} ({stats['failures']} failed, "
+                  f"{stats['retries']} retries, {stats['truncated']} hit max_tokens), "
+                  f"{stats['prompt_tokens']} prompt / {stats['completion_tokens']} completion tokens, "
+                  f"{stats['completion_tokens_per_sec']:.1f} tok/s, "
+                  f"latency p50 {stats['latency_p50']:.2f}s / p99 {stats['latency_p99']:.2f}s")
+        if metrics_file:
+            self.metrics.write(metrics_file)
+            print(f"✓ Metrics written to {metrics_file}")
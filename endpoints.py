@@ -0,0 +1,180 @@
+"""
+Load balancing across several OpenAI-compatible endpoints.
+
+Requests go to the healthy endpoint with the fewest outstanding requests
+relative to its weight. Endpoints that keep failing are ejected for a cooldown
+period and a background health check puts them back once they answer again.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, OpenAI
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """Whether an error says something about the endpoint rather than the request"""
+    return isinstance(error, (APIConnectionError, APITimeoutError, InternalServerError))
+
+
+class Endpoint:
+    """One OpenAI-compatible server and its load/health state"""
+
+    def __init__(self, base_url: str, api_key: str, weight: float = 1.0,
+                 client_options: Optional[Dict] = None):
+        self.base_url = base_url
+        self.weight = max(float(weight), 1e-6)
+        self.client = OpenAI(base_url=base_url, api_key=api_key, **(client_options or {}))
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+
+    def load(self) -> float:
+        """Weighted load if one more request were sent here"""
+        return (self.outstanding + 1) / self.weight
+
+
+class EndpointPool:
+    """Least-outstanding-requests dispatcher with ejection and health checks"""
+
+    def __init__(self, endpoints: List[Dict], failure_threshold: int = 3,
+                 ejection_seconds: float = 30.0, health_check_interval: float = 10.0,
+                 client_options: Optional[Dict] = None):
+        """
+        Build clients for each endpoint config.
+
+        Each config has ``base_url``, ``api_key`` and an optional ``weight``.
+        An endpoint is ejected after ``failure_threshold`` consecutive
+        failures and probed again after ``ejection_seconds``. With more than
+        one endpoint, every endpoint is probed every ``health_check_interval``
+        seconds (0 disables background checks), starting with the first
+        lease, so pools that never send a request start no thread.
+        """
+        if not endpoints:
+            raise ValueError("At least one endpoint is required")
+        self.endpoints = [
+            Endpoint(config["base_url"], config.get("api_key", ""), config.get("weight", 1.0),
+                     client_options)
+            for config in endpoints
+        ]
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def _start_health_checks(self):
+        """Start the background health loop once; call with self._lock held"""
+        if (self._health_thread is None and len(self.endpoints) > 1
+                and self.health_check_interval > 0 and not self._stop.is_set()):
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    def acquire(self) -> Endpoint:
+        """Pick the healthy endpoint with the lowest weighted outstanding load"""
+        with self._lock:
+            self._start_health_checks()
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e.healthy or e.ejected_until <= now]
+            if not candidates:
+                # Everything is ejected: try whichever comes back first
+                candidates = [min(self.endpoints, key=lambda e: e.ejected_until)]
+            # Ties go to the endpoint that has served the fewest requests for its
+            # weight, so sequential callers rotate instead of pinning the first one
+            endpoint = min(candidates, key=lambda e: (e.load(), e.requests / e.weight))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, error: Optional[Exception] = None):
+        """Return an endpoint, updating its health from the request outcome"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+                if not endpoint.healthy:
+                    self._reinstate(endpoint)
+            elif is_endpoint_failure(error):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.failure_threshold:
+                    self._eject(endpoint)
+
+    @contextmanager
+    def lease(self) -> Iterator[Endpoint]:
+        """Acquire an endpoint for the duration of one request"""
+        endpoint = self.acquire()
+        try:
+            yield endpoint
+        except Exception as e:
+            self.release(endpoint, e)
+            raise
+        else:
+            self.release(endpoint)
+
+    def _eject(self, endpoint: Endpoint):
+        if endpoint.healthy and len(self.endpoints) > 1:
+            print(f"Ejecting endpoint {endpoint.base_url} after "
+                  f"{endpoint.consecutive_failures} consecutive failures")
+        endpoint.healthy = False
+        endpoint.ejected_until = time.monotonic() + self.ejection_seconds
+        self._start_health_checks()
+
+    def _reinstate(self, endpoint: Endpoint):
+        if len(self.endpoints) > 1:
+            print(f"Endpoint {endpoint.base_url} is healthy again")
+        endpoint.healthy = True
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = 0.0
+
+    def check_health(self):
+        """
+        Probe every endpoint once via the models listing.
+
+        A failed probe counts as a consecutive failure, so a healthy endpoint
+        is only ejected at failure_threshold; an ejected one stays out for
+        another cooldown.
+        """
+        for endpoint in self.endpoints:
+            if not endpoint.healthy and endpoint.ejected_until > time.monotonic():
+                continue
+            try:
+                endpoint.client.with_options(timeout=5.0, max_retries=0).models.list()
+            except Exception:
+                with self._lock:
+                    endpoint.consecutive_failures += 1
+                    if not endpoint.healthy or endpoint.consecutive_failures >= self.failure_threshold:
+                        self._eject(endpoint)
+            else:
+                with self._lock:
+                    if not endpoint.healthy:
+                        self._reinstate(endpoint)
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_check_interval):
+            self.check_health()
+
+    def stats(self) -> List[Dict]:
+        """Per-endpoint request counts and health"""
+        with self._lock:
+            return [
+                {
+                    "base_url": e.base_url,
+                    "weight": e.weight,
+                    "healthy": e.healthy,
+                    "outstanding": e.outstanding,
+                    "requests": e.requests,
+                    "failures": e.failures,
+                }
+                for e in self.endpoints
+            ]
+
+    def close(self):
+        """Stop background health checks"""
+        self._stop.set()
@@ -0,0 +1,151 @@
+"""
+Structured-output extraction from model completions.
+
+Completions often wrap the requested JSON in a chain-of-thought preamble, code
+fences or closing remarks, and sometimes contain small defects. ``extract_json``
+finds the last balanced JSON object in the text, preferring one with a
+``"turns"`` key, and repairs common defects (trailing commas, smart quotes,
+raw control characters, Python-style literals) before giving up.
+"""
+
+import ast
+import json
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_DECODER = json.JSONDecoder()
+_LENIENT_DECODER = json.JSONDecoder(strict=False)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "„": '"', "‘": "'", "’": "'"})
+# Python spellings of true/false/null that _repair accepts via ast.literal_eval
+PYTHON_KEYWORDS = ("True", "False", "None")
+
+# JSON schema of a stage's output, for response_format / guided decoding
+TURNS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "turns": {"type": "array", "items": {"type": "string"}, "minItems": 1},
+    },
+    "required": ["turns"],
+}
+
+
+class ExtractionError(ValueError):
+    """A completion (or a whole stage) did not yield usable structured output"""
+
+
+def extract_json(text: str) -> Dict:
+    """
+    Parse the JSON object a completion contains.
+
+    Raises ExtractionError if no object can be recovered.
+    """
+    text = text.strip()
+    # Fast path: the completion is exactly one JSON object
+    if text.startswith("{"):
+        try:
+            result = _DECODER.decode(text)
+            if isinstance(result, dict):
+                return result
+        except json.JSONDecodeError:
+            pass
+
+    objects = [obj for _, obj in _iter_objects(text)]
+    if not objects:
+        for segment in reversed(list(_balanced_segments(text))):
+            repaired = _repair(segment)
+            if repaired is not None:
+                objects.append(repaired)
+                if "turns" in repaired:
+                    break
+        objects.reverse()
+    if not objects:
+        raise ExtractionError("no JSON object found in completion")
+
+    for obj in reversed(objects):
+        if "turns" in obj:
+            return obj
+    return objects[-1]
+
+
+def _iter_objects(text: str) -> Iterator[Tuple[int, Dict]]:
+    """Yield the outermost JSON objects in text that parse as they are, in order"""
+    position = text.find("{")
+    while position != -1:
+        try:
+            obj, end = _LENIENT_DECODER.raw_decode(text, position)
+        except json.JSONDecodeError:
+            position = text.find("{", position + 1)
+            continue
+        if isinstance(obj, dict):
+            yield position, obj
+        position = text.find("{", end)
+
+
+def _balanced_segments(text: str) -> Iterator[str]:
+    """Yield outermost brace-balanced spans, tracking double-quoted strings inside them"""
+    position = text.find("{")
+    while position != -1:
+        depth = 0
+        in_string = False
+        escape = False
+        end = -1
+        for index in range(position, len(text)):
+            char = text[index]
+            if in_string:
+                if escape:
+                    escape = False
+                elif char == "\\":
+                    escape = True
+                elif char in '"“”':
+                    in_string = False
+            elif char in '"“”':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    end = index + 1
+                    break
+        if end == -1:
+            # A stray brace in free text or a truncated object: try the next one
+            position = text.find("{", position + 1)
+            continue
+        yield text[position:end]
+        position = text.find("{", end)
+
+
+def _repair(segment: str) -> Optional[Dict]:
+    """Try increasingly lenient parses of a balanced segment"""
+    candidate = _TRAILING_COMMA.sub(r"\1", segment.translate(SMART_QUOTES))
+    try:
+        result = _LENIENT_DECODER.decode(candidate)
+        return result if isinstance(result, dict) else None
+    except json.JSONDecodeError:
+        pass
+    # Single-quoted strings and True/False/None, as Python-minded models write them
+    try:
+        result = ast.literal_eval(candidate)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return result if isinstance(result, dict) else None
+
+
+def turns_from(result: Dict, expected: int = 0) -> List[str]:
+    """
+    The non-empty string turns of an extracted object.
+
+    Raises ExtractionError when there are none, or fewer than ``expected``.
+    """
+    turns = result.get("turns")
+    if not isinstance(turns, list):
+        raise ExtractionError('completion has no "turns" list')
+    if not all(isinstance(turn, str) for turn in turns):
+        raise ExtractionError("completion has turns that are not strings")
+    turns = [turn.strip() for turn in turns if turn.strip()]
+    if not turns:
+        raise ExtractionError("completion has no turns")
+    if len(turns) < expected:
+        raise ExtractionError(f"completion has {len(turns)} turns, expected {expected}")
+    return turns
@@ -0,0 +1,173 @@
+"""
+Incremental validation of streamed JSON completions.
+
+``JSONPrefixValidator`` is fed completion text as it arrives and tracks whether
+it is still a valid prefix of a JSON object. The object may follow a code
+fence (```json); text that merely mentions braces in a free-form preamble is
+ignored, so the validator only reports ``MALFORMED`` once an output is clearly
+broken. Streams can then be cancelled early instead of decoding to the end.
+
+Defects that ``extraction.extract_json`` repairs are accepted as they stream:
+trailing commas, smart quotes, single-quoted strings and ``True``/``False``/
+``None``. Aborting on them would only pay for a retry of usable output.
+"""
+
+import re
+from typing import List
+
+from extraction import PYTHON_KEYWORDS, SMART_QUOTES
+
+SEARCHING = "searching"
+OPEN = "open"
+COMPLETE = "complete"
+MALFORMED = "malformed"
+
+_KEYWORDS = ("true", "false", "null") + PYTHON_KEYWORDS
+_LITERAL_CHARS = set("0123456789+-.eE") | set("".join(_KEYWORDS))
+_NUMBER = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?$")
+_NUMBER_PREFIX = re.compile(r"-?(0|[1-9]\d*)?(\.\d*)?([eE][+-]?\d*)?$")
+_QUOTES = "\"'"
+_FENCES = ("```json", "```JSON", "```")
+
+
+class StreamAborted(Exception):
+    """A streamed completion was cancelled before it finished"""
+
+    def __init__(self, reason: str, content: str):
+        super().__init__(f"stream aborted: {reason}")
+        self.reason = reason
+        self.content = content
+
+
+class JSONPrefixValidator:
+    """Character-level JSON syntax checker for a growing completion"""
+
+    def __init__(self):
+        self.state = SEARCHING
+        self.error = ""
+        self._preamble = ""
+        self._seen_text = False
+        self._stack: List[str] = []
+        self._expect = ""
+        self._in_string = False
+        self._quote = ""
+        self._quote_raw = ""
+        self._string_is_key = False
+        self._escape = False
+        self._literal = ""
+        self._position = 0
+
+    def feed(self, text: str) -> str:
+        """Consume the next piece of the completion and return the new state"""
+        for char in text:
+            if self.state in (COMPLETE, MALFORMED):
+                break
+            self._position += 1
+            if self.state == SEARCHING:
+                self._search(char)
+            else:
+                self._consume(char)
+        return self.state
+
+    def _search(self, char: str):
+        if char != "{":
+            # Only the tail matters for recognising a code fence
+            self._preamble = (self._preamble + char)[-32:]
+            if not char.isspace():
+                self._seen_text = True
+            return
+        if not self._seen_text or self._preamble.rstrip().endswith(_FENCES):
+            self.state = OPEN
+            self._stack = ["{"]
+            self._expect = "key_or_end"
+        # Anything else is a brace inside free text: keep looking
+
+    def _fail(self, message: str):
+        self.state = MALFORMED
+        self.error = f"{message} at character {self._position}"
+
+    def _consume(self, raw: str):
+        char = raw.translate(SMART_QUOTES)
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            # Smart quotes are plain text inside a standard JSON string
+            elif char == self._quote and (raw == char or self._quote_raw != '"'):
+                self._in_string = False
+                self._expect = "colon" if self._string_is_key else "comma_or_end"
+            return
+
+        if self._literal:
+            if char in _LITERAL_CHARS:
+                self._literal += char
+                if not self._literal_prefix_ok():
+                    self._fail(f"invalid literal {self._literal!r}")
+                return
+            if not self._finish_literal():
+                return
+
+        if char.isspace():
+            return
+        expect = self._expect
+        if char in _QUOTES:
+            if expect in ("key", "key_or_end"):
+                self._in_string, self._string_is_key = True, True
+            elif expect in ("value", "value_or_end"):
+                self._in_string, self._string_is_key = True, False
+            else:
+                self._fail("unexpected string")
+                return
+            self._quote, self._quote_raw = char, raw
+        elif char == ":":
+            if expect != "colon":
+                self._fail("unexpected ':'")
+            else:
+                self._expect = "value"
+        elif char == ",":
+            if expect != "comma_or_end":
+                self._fail("unexpected ','")
+            else:
+                self._expect = "key" if self._stack[-1] == "{" else "value"
+        elif char in "{[":
+            if expect not in ("value", "value_or_end"):
+                self._fail(f"unexpected {char!r}")
+            else:
+                self._stack.append(char)
+                self._expect = "key_or_end" if char == "{" else "value_or_end"
+        elif char in "}]":
+            opener = "{" if char == "}" else "["
+            # Trailing commas ("key"/"value") are tolerated: extraction repairs them
+            if char == "}":
+                allowed = ("key_or_end", "key", "comma_or_end")
+            else:
+                allowed = ("value_or_end", "value", "comma_or_end")
+            if self._stack[-1] != opener or expect not in allowed:
+                self._fail(f"unexpected {char!r}")
+                return
+            self._stack.pop()
+            if not self._stack:
+                self.state = COMPLETE
+            else:
+                self._expect = "comma_or_end"
+        elif expect in ("value", "value_or_end") and char in _LITERAL_CHARS:
+            self._literal = char
+            if not self._literal_prefix_ok():
+                self._fail(f"invalid literal {self._literal!r}")
+        else:
+            self._fail(f"unexpected {char!r}")
+
+    def _literal_prefix_ok(self) -> bool:
+        literal = self._literal
+        if any(keyword.startswith(literal) for keyword in _KEYWORDS):
+            return True
+        return bool(_NUMBER_PREFIX.match(literal))
+
+    def _finish_literal(self) -> bool:
+        literal, self._literal = self._literal, ""
+        if literal in _KEYWORDS or _NUMBER.match(literal):
+            self._expect = "comma_or_end"
+            return True
+        self._fail(f"invalid literal {literal!r}")
+        return False
@@ -1,70 +1,112 @@
+import argparse
 import json
+import os
+import signal
 import sys
-from dialogue_generator import DialogueGenerator
-from config import API_CONFIG, FILE_PATHS, GENERATION_CONFIG
+import threading
+import config
+from config import API_CONFIG, FILE_PATHS, GENERATION_CONFIG, OUTPUT_CONFIG
+from output_writer import finalize_to_json, stream_path_for
+from scenario_loader import ScenarioStream, flow_definitions_of, load_scenarios
+from sharding import merge_shards as merge_shard_streams, shard_output_path, validate_shard
 
+# Optional sections: a config.py from before they were added uses the defaults
+DEDUP_CONFIG = getattr(config, "DEDUP_CONFIG", {})
+PLANNER_CONFIG = getattr(config, "PLANNER_CONFIG", {})
+SERVICE_CONFIG = getattr(config, "SERVICE_CONFIG", {})
+VALIDATION_CONFIG = getattr(config, "VALIDATION_CONFIG", {})
 
-def main():
+
+def create_generator(offline: bool = False):
+    """Build a generator from API_CONFIG; offline ones only render prompts and records"""
+    # Imported here: openai dominates startup, and commands without a generator skip it
+    from dialogue_generator import DialogueGenerator
+    
+    return DialogueGenerator(
+        base_url=API_CONFIG.get("base_url", ""),
+        api_key=API_CONFIG.get("api_key", ""),
+        model=API_CONFIG["model"],
+        endpoints=API_CONFIG.get("endpoints"),
+        offline=offline
+    )
+
+
+def load_data():
+    """FILE_PATHS["data"] as a JSON data dict, or a ScenarioStream for a JSONL catalog"""
+    return load_scenarios(
+        FILE_PATHS["data"],
+        flow_definitions_path=FILE_PATHS.get("flow_definitions"),
+        read_ahead=GENERATION_CONFIG.get("scenario_read_ahead", 1024)
+    )
+
+
+def main(resume: bool = False, shard_index: int = 0, num_shards: int = 1):
     print("=== Skeleton-Guided Multi-turn Dialogue Generation ===")
     
     try:
         # Initialize generator
-        generator = DialogueGenerator(
-            base_url=API_CONFIG["base_url"],
-            api_key=API_CONFIG["api_key"],
-            model=API_CONFIG["model"]
-        )
+        generator = create_generator()
         
         # Load data
         print("Loading data...")
-        data = generator.load_data(FILE_PATHS["data"])
-        categories = data.get("categories", {})
-        print(f"✓ Successfully loaded {len(categories)} categories")
+        data = load_data()
+        if isinstance(data, ScenarioStream):
+            print(f"✓ Streaming scenarios from {data.path} "
+                  f"({len(data.flow_definitions)} flow definitions)")
+        else:
+            categories = data.get("categories", {})
+            print(f"✓ Successfully loaded {len(categories)} categories")
         
         # Load prompt templates
+        # Templates are rendered by path so the registry's bytecode cache and reload apply
         print("Loading prompt templates...")
-        query_prompt_template = generator.load_prompt_template(FILE_PATHS["query_prompt"])
-        response_prompt_template = generator.load_prompt_template(FILE_PATHS["response_prompt"])
+        query_prompt_template = FILE_PATHS["query_prompt"]
+        response_prompt_template = FILE_PATHS["response_prompt"]
+        generator.get_template(query_prompt_template)
+        generator.get_template(response_prompt_template)
         print("✓ Successfully loaded prompt templates")
         
         # Start batch generation
         print("\nStarting batch dialogue generation...")
-        all_dialogues = generator.batch_generate(
+        output_file = shard_output_path(FILE_PATHS["output_file"], shard_index, num_shards)
+        total = generator.batch_generate(
             data=data,
             query_prompt_template=query_prompt_template,
             response_prompt_template=response_prompt_template,
-            output_file=FILE_PATHS["output_file"]
+            output_file=output_file,
+            resume=resume,
+            shard_index=shard_index,
+            num_shards=num_shards
         )
         
         print(f"\n🎉 Generation completed!")
-        print(f"Total generated: {len(all_dialogues)} dialogues")
-        print(f"Output file: {FILE_PATHS['output_file']}")
+        print(f"Total generated: {total} dialogues")
+        print(f"Output file: {output_file}")
         
     except Exception as e:
         print(f"Error during generation: {e}")
         sys.exit(1)
 
 
-def test_single():
-    """Test function for single dialogue generation"""
+def test_single(service: str = None):
+    """Test function for single dialogue generation, optionally on a running service"""
     print("=== Test Single Dialogue Generation (Simplified) ===")
     
+    if service:
+        test_on_service(service)
+        return
+    
     try:
         # Initialize generator
-        generator = DialogueGenerator(
-            base_url=API_CONFIG["base_url"],
-            api_key=API_CONFIG["api_key"],
-            model=API_CONFIG["model"]
-        )
+        generator = create_generator()
         
         # Load data
-        data = generator.load_data(FILE_PATHS["data"])
-        categories = data.get("categories", {})
-        flow_definitions = data.get("flow_definitions", {})
+        data = load_data()
+        flow_definitions = flow_definitions_of(data)
         
         # Load prompt templates
-        query_prompt_template = generator.load_prompt_template(FILE_PATHS["query_prompt"])
-        response_prompt_template = generator.load_prompt_template(FILE_PATHS["response_prompt"])
+        query_prompt_template = FILE_PATHS["query_prompt"]
+        response_prompt_template = FILE_PATHS["response_prompt"]
         
         # Test generating a dialogue
         test_category = "Problem-solving Interaction"
@@ -93,8 +135,623 @@ def test_single():
         sys.exit(1)
 
 
+def test_on_service(address: str):
+    """Generate the test dialogue on a running service instead of starting a generator"""
+    from service import ServiceError, submit_job
+    
+    try:
+        job = {"scenarios": [{"category": "Problem-solving Interaction", "scenario": "Technical Support",
+                              "flow_type": "problem_diagnosis_to_solution"}],
+               "samples": 1}
+        dialogue = None
+        for event in submit_job(address, job):
+            if event["event"] == "failed":
+                raise ServiceError(event["error"])
+            if event["event"] in ("dialogue", "rejected"):
+                dialogue = event["dialogue"]
+                if event["event"] == "rejected":
+                    print(f"⚠ Rejected: {'; '.join(event['reasons'])}")
+        if dialogue is None:
+            raise ServiceError("the job ended without a dialogue")
+        
+        print("\nGenerated dialogue:")
+        print(json.dumps(dialogue, ensure_ascii=False, indent=2))
+        with open(FILE_PATHS["test_output"], "w", encoding="utf-8") as f:
+            json.dump(dialogue, f, ensure_ascii=False, indent=2)
+        print(f"\nTest dialogue saved to {FILE_PATHS['test_output']}")
+        
+    except Exception as e:
+        print(f"Error during test: {e}")
+        sys.exit(1)
+
+
+def serve(host: str = None, port: int = None, socket_path: str = None, max_concurrency: int = None):
+    """Run the resident generation service until interrupted"""
+    from scenario_loader import flow_type_lookup
+    from service import GenerationService, service_address, start_service
+    from validators import VALIDATORS
+    
+    print("=== Dialogue Generation Service ===")
+    
+    try:
+        generator = create_generator()
+        data = load_data()
+        service = GenerationService(
+            generator,
+            FILE_PATHS["query_prompt"],
+            FILE_PATHS["response_prompt"],
+            flow_definitions_of(data),
+            flow_types=flow_type_lookup(data),
+            max_concurrency=max_concurrency or SERVICE_CONFIG.get("max_concurrency", 8),
+            max_dialogues_per_job=SERVICE_CONFIG.get("max_dialogues_per_job", 10000),
+            validators=VALIDATION_CONFIG.get("validators", list(VALIDATORS)),
+            validation_settings=VALIDATION_CONFIG
+        )
+        server = start_service(
+            service,
+            host=host or SERVICE_CONFIG.get("host", "127.0.0.1"),
+            port=port if port is not None else SERVICE_CONFIG.get("port", 8765),
+            socket_path=socket_path or SERVICE_CONFIG.get("socket")
+        )
+        print(f"✓ Serving on {service_address(server)} with {service.max_concurrency} workers "
+              f"(Ctrl+C to stop)")
+        
+    except Exception as e:
+        print(f"Error starting the service: {e}")
+        sys.exit(1)
+    
+    # SIGTERM (e.g. from a process supervisor) stops the service like Ctrl+C
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\nStopping the service...")
+        server.shutdown()
+        server.server_close()
+        service.close()
+        if isinstance(server.server_address, str) and os.path.exists(server.server_address):
+            os.unlink(server.server_address)
+
+
+def submit(input_file: str, address: str = None, output_file: str = None, samples: int = None,
+           validate: bool = None):
+    """Run a scenario file as a job on a running service, writing the streamed dialogues as JSONL"""
+    from output_writer import DialogueWriter
+    from service import submit_job
+    
+    print("=== Submit Generation Job ===")
+    
+    address = address or default_service_address()
+    output_file = output_file or FILE_PATHS["output_file"]
+    stream_file = stream_path_for(output_file, OUTPUT_CONFIG.get("compress", False))
+    
+    try:
+        data = load_scenarios(input_file, flow_definitions_path=FILE_PATHS.get("flow_definitions"))
+        if isinstance(data, ScenarioStream):
+            job = {"scenarios": [{"category": category, "scenario": scenario, "flow_type": flow_type}
+                                 for category, scenario, flow_type in data.records()]}
+        else:
+            job = {"categories": data.get("categories", {})}
+        if samples is not None:
+            job["samples"] = samples
+        if validate is not None:
+            job["validate"] = validate
+        
+        _ensure_parent_dir(stream_file)
+        failures = []
+        with DialogueWriter(stream_file, fsync_interval=OUTPUT_CONFIG.get("fsync_interval", 50),
+                            ensure_ascii=OUTPUT_CONFIG["ensure_ascii"]) as writer:
+            for event in submit_job(address, job):
+                if event["event"] == "job":
+                    print(f"✓ Job {event['id']} accepted: {event['dialogues']} dialogues")
+                elif event["event"] == "dialogue":
+                    writer.write(event["dialogue"])
+                    print(f"✓ Saved {writer.count} dialogues")
+                elif event["event"] in ("failed", "rejected"):
+                    reason = event.get("error") or "; ".join(event.get("reasons", []))
+                    failures.append(f"{' - '.join(map(str, event['key']))}: {event['event']}, {reason}")
+                elif event["event"] == "done":
+                    print(f"✓ Job {event['id']} finished in {event['seconds']:.1f}s"
+                          + (" (cancelled)" if event["cancelled"] else ""))
+        _report_failures(failures)
+        print(f"✓ Wrote {writer.count} dialogues to {stream_file}")
+        if stream_file != output_file and OUTPUT_CONFIG.get("finalize_json", True):
+            finalize_to_json(stream_file, output_file, ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                             indent=OUTPUT_CONFIG["indent"])
+            print(f"✓ Finalized {stream_file} into {output_file}")
+        
+    except Exception as e:
+        print(f"Error during submit: {e}")
+        sys.exit(1)
+
+
+def default_service_address() -> str:
+    """The address of the service configured in SERVICE_CONFIG"""
+    if SERVICE_CONFIG.get("socket"):
+        return f"unix:{SERVICE_CONFIG['socket']}"
+    return f"http://{SERVICE_CONFIG.get('host', '127.0.0.1')}:{SERVICE_CONFIG.get('port', 8765)}"
+
+
+def finalize():
+    """Convert the JSONL stream of a batch run into a JSON array file"""
+    print("=== Finalize Batch Output ===")
+    
+    output_file = FILE_PATHS["output_file"]
+    stream_file = stream_path_for(output_file, OUTPUT_CONFIG.get("compress", False))
+    
+    try:
+        count = finalize_to_json(
+            stream_file,
+            output_file,
+            ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+            indent=OUTPUT_CONFIG["indent"]
+        )
+        print(f"✓ Wrote {count} dialogues from {stream_file} to {output_file}")
+        
+    except Exception as e:
+        print(f"Error during finalize: {e}")
+        sys.exit(1)
+
+
+def merge_shards(num_shards: int, shard_files=None, allow_incomplete: bool = False):
+    """Merge the output shards of a sharded run into the configured output file"""
+    print("=== Merge Output Shards ===")
+    
+    output_file = FILE_PATHS["output_file"]
+    compress = OUTPUT_CONFIG.get("compress", False)
+    if not shard_files:
+        shard_files = [
+            stream_path_for(shard_output_path(output_file, index, num_shards), compress)
+            for index in range(num_shards)
+        ]
+    
+    try:
+        absent = [path for path in shard_files if not os.path.exists(path)]
+        if absent:
+            raise FileNotFoundError(f"missing shard files: {', '.join(absent)}")
+        
+        data = load_data()
+        stream_file = stream_path_for(output_file, compress)
+        count, duplicates, missing = merge_shard_streams(
+            shard_files,
+            data,
+            stream_file,
+            samples_per_scenario=max(1, GENERATION_CONFIG.get("samples_per_scenario", 1)),
+            fsync_interval=OUTPUT_CONFIG.get("fsync_interval", 50),
+            ensure_ascii=OUTPUT_CONFIG["ensure_ascii"]
+        )
+        print(f"✓ Merged {count} dialogues from {len(shard_files)} shards into {stream_file}")
+        if duplicates:
+            print(f"✓ Dropped {duplicates} duplicate dialogues")
+        if stream_file != output_file and OUTPUT_CONFIG.get("finalize_json", True):
+            finalize_to_json(stream_file, output_file, ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                             indent=OUTPUT_CONFIG["indent"])
+            print(f"✓ Finalized {stream_file} into {output_file}")
+        
+    except Exception as e:
+        print(f"Error during merge: {e}")
+        sys.exit(1)
+    
+    if missing:
+        _report_failures([f"{label}: not in any shard" for label in missing])
+        if not allow_incomplete:
+            print("Merged output is incomplete; resume the affected shards and merge again")
+            sys.exit(1)
+
+
+def dedup_output(input_file: str, output_file: str = None, threshold: float = None,
+                 report_file: str = None):
+    """Drop near-duplicate dialogues from an existing output file, keeping the first of each"""
+    from dedup import MinHashIndex, dedup_records, deduped_output_path
+    from output_writer import DialogueWriter
+    from records import read_dialogues
+    
+    print("=== Deduplicate Dialogues ===")
+    
+    output_file = output_file or deduped_output_path(input_file)
+    stream_file = stream_path_for(output_file, OUTPUT_CONFIG.get("compress", False))
+    
+    try:
+        records = read_dialogues(input_file, expand=False)
+        index = MinHashIndex(
+            threshold=threshold if threshold is not None else DEDUP_CONFIG.get("threshold", 0.8),
+            num_perm=DEDUP_CONFIG.get("num_perm", 128),
+            shingle_size=DEDUP_CONFIG.get("shingle_size", 5)
+        )
+        
+        _ensure_parent_dir(stream_file)
+        duplicates = []
+        with DialogueWriter(stream_file, fsync_interval=OUTPUT_CONFIG.get("fsync_interval", 50),
+                            ensure_ascii=OUTPUT_CONFIG["ensure_ascii"]) as writer:
+            for position, (record, match) in enumerate(dedup_records(records, index)):
+                if match is None:
+                    writer.write(record)
+                else:
+                    duplicates.append({
+                        "index": position,
+                        "category": record.get("category"),
+                        "duplicate_of": match[0],
+                        "similarity": round(match[1], 3)
+                    })
+        print(f"✓ Kept {writer.count} of {writer.count + len(duplicates)} dialogues, "
+              f"dropped {len(duplicates)} near-duplicates")
+        
+        if report_file:
+            _ensure_parent_dir(report_file)
+            with open(report_file, "w", encoding="utf-8") as f:
+                for duplicate in duplicates:
+                    f.write(json.dumps(duplicate, ensure_ascii=False) + "\n")
+            print(f"✓ Duplicate report written to {report_file}")
+        if stream_file != output_file and OUTPUT_CONFIG.get("finalize_json", True):
+            finalize_to_json(stream_file, output_file, ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                             indent=OUTPUT_CONFIG["indent"])
+            print(f"✓ Finalized {stream_file} into {output_file}")
+        
+    except Exception as e:
+        print(f"Error during dedup: {e}")
+        sys.exit(1)
+
+
+def validate_output(input_file: str, output_file: str = None, reject_file: str = None,
+                    workers: int = None):
+    """Split an existing output file into dialogues that pass the validators and rejects"""
+    from output_writer import DialogueWriter
+    from records import read_dialogues
+    from validators import VALIDATORS, ValidationPool, reject_path_for, validated_output_path
+    
+    print("=== Validate Dialogues ===")
+    
+    output_file = output_file or validated_output_path(input_file)
+    stream_file = stream_path_for(output_file, OUTPUT_CONFIG.get("compress", False))
+    reject_file = reject_file or reject_path_for(stream_file)
+    
+    try:
+        records = read_dialogues(input_file, expand=False)
+        pool = ValidationPool(
+            VALIDATION_CONFIG.get("validators", list(VALIDATORS)),
+            VALIDATION_CONFIG,
+            workers=workers if workers is not None else VALIDATION_CONFIG.get("workers", 2)
+        )
+        
+        _ensure_parent_dir(stream_file)
+        _ensure_parent_dir(reject_file)
+        options = {"fsync_interval": OUTPUT_CONFIG.get("fsync_interval", 50),
+                   "ensure_ascii": OUTPUT_CONFIG["ensure_ascii"]}
+        with pool, DialogueWriter(stream_file, **options) as writer, \
+                DialogueWriter(reject_file, **options) as rejects:
+            for position, (record, reasons) in enumerate(pool.map(records)):
+                if reasons:
+                    rejects.write({"index": position, "reasons": reasons, "dialogue": record})
+                else:
+                    writer.write(record)
+        print(f"✓ Kept {pool.passed} of {pool.passed + pool.rejected} dialogues, "
+              f"rejected {pool.rejected}")
+        for name, count in pool.reasons.most_common():
+            print(f"  {name}: {count}")
+        if pool.rejected:
+            print(f"✓ Rejects written to {reject_file}")
+        if stream_file != output_file and OUTPUT_CONFIG.get("finalize_json", True):
+            finalize_to_json(stream_file, output_file, ensure_ascii=OUTPUT_CONFIG["ensure_ascii"],
+                             indent=OUTPUT_CONFIG["indent"])
+            print(f"✓ Finalized {stream_file} into {output_file}")
+        
+    except Exception as e:
+        print(f"Error during validation: {e}")
+        sys.exit(1)
+
+
+def export_columnar(input_file: str, output_dir: str = None, format: str = None,
+                    rows_per_file: int = None, overwrite: bool = False):
+    """Write an output file as columnar files partitioned by category and flow type"""
+    from columnar import ColumnarWriter, columnar_path_for
+    from records import read_dialogues
+    from scenario_loader import category_flow_types
+    
+    print("=== Export Dialogues to Columnar Files ===")
+    
+    output_dir = output_dir or columnar_path_for(input_file)
+    
+    try:
+        with ColumnarWriter(
+            output_dir,
+            format=format or OUTPUT_CONFIG.get("columnar_format", "auto"),
+            rows_per_file=rows_per_file or OUTPUT_CONFIG.get("columnar_rows_per_file", 100000),
+            flow_types=category_flow_types(load_data()),
+            overwrite=overwrite
+        ) as writer:
+            for record in read_dialogues(input_file, expand=False):
+                writer.write(record)
+        print(f"✓ Wrote {writer.count} dialogues to {len(writer.files)} {writer.format} files in {output_dir}")
+        
+    except Exception as e:
+        print(f"Error during export: {e}")
+        sys.exit(1)
+
+
+def plan(concurrency: int = None, tokenizer: str = None, output_file: str = None):
+    """Estimate the tokens, cost and duration of a batch run without calling the API"""
+    from planner import get_tokenizer, plan_run
+    
+    print("=== Plan Batch Generation (dry run) ===")
+    
+    try:
+        generator = create_generator(offline=True)
+        data = load_data()
+        query_prompt_template = FILE_PATHS["query_prompt"]
+        response_prompt_template = FILE_PATHS["response_prompt"]
+        if concurrency is None:
+            concurrency = GENERATION_CONFIG.get("max_concurrency", 1)
+            if GENERATION_CONFIG.get("pipeline", False):
+                concurrency = (GENERATION_CONFIG.get("query_concurrency", 4)
+                               + GENERATION_CONFIG.get("response_concurrency", 8))
+        
+        estimate = plan_run(
+            generator, data, query_prompt_template, response_prompt_template, PLANNER_CONFIG,
+            tokenizer=get_tokenizer(tokenizer or PLANNER_CONFIG.get("tokenizer")),
+            concurrency=concurrency,
+            requests_per_minute=GENERATION_CONFIG.get("requests_per_minute"),
+            tokens_per_minute=GENERATION_CONFIG.get("tokens_per_minute")
+        )
+        
+        print(f"Dialogues: {estimate['dialogues']} ({estimate['scenarios']} scenarios), "
+              f"tokenizer: {estimate['tokenizer']}, completions from {estimate['completion_source']}")
+        for stage, values in estimate["stages"].items():
+            print(f"  {stage}: {values['calls']} calls, {values['prompt_tokens']} prompt + "
+                  f"{values['completion_tokens']} completion tokens, "
+                  f"{values['latency_per_call']:.1f}s per call")
+        print(f"✓ Total: {estimate['calls']} calls, {estimate['total_tokens']} tokens "
+              f"({estimate['prompt_tokens']} prompt + {estimate['completion_tokens']} completion)")
+        print(f"✓ Estimated cost: {estimate['cost']:.2f}")
+        print(f"✓ Estimated wall-clock time at concurrency {concurrency}: "
+              f"{estimate['wall_clock_seconds'] / 60:.1f} min")
+        
+        budget = GENERATION_CONFIG.get("token_budget")
+        if budget:
+            estimate["token_budget"] = budget
+            if estimate["total_tokens"] > budget:
+                print(f"⚠ The estimate exceeds token_budget ({budget}); "
+                      f"the run would stop after about {budget / estimate['total_tokens']:.0%} of it")
+            else:
+                print(f"✓ Within token_budget ({budget})")
+        
+        if output_file:
+            _ensure_parent_dir(output_file)
+            with open(output_file, "w", encoding="utf-8") as f:
+                json.dump(estimate, f, ensure_ascii=False, indent=2)
+            print(f"✓ Plan written to {output_file}")
+        
+    except Exception as e:
+        print(f"Error during planning: {e}")
+        sys.exit(1)
+
+
+def batch_export_queries(output_path: str):
+    """Render every query-stage prompt into a batch-request JSONL file"""
+    from batch_io import export_query_batch
+    
+    print("=== Export Query-Stage Batch Requests ===")
+    
+    try:
+        generator = create_generator(offline=True)
+        data = load_data()
+        query_prompt_template = FILE_PATHS["query_prompt"]
+        
+        _ensure_parent_dir(output_path)
+        count = export_query_batch(generator, data, query_prompt_template, output_path)
+        print(f"✓ Wrote {count} query-stage requests to {output_path}")
+        
+    except Exception as e:
+        print(f"Error during export: {e}")
+        sys.exit(1)
+
+
+def batch_ingest_queries(results_path: str, output_path: str):
+    """Turn query-stage batch results into response-stage batch requests"""
+    from batch_io import ingest_query_results
+    
+    print("=== Ingest Query-Stage Batch Results ===")
+    
+    try:
+        generator = create_generator(offline=True)
+        data = load_data()
+        response_prompt_template = FILE_PATHS["response_prompt"]
+        
+        _ensure_parent_dir(output_path)
+        count, failures = ingest_query_results(
+            generator, data, response_prompt_template, results_path, output_path
+        )
+        _report_failures(failures)
+        print(f"✓ Wrote {count} response-stage requests to {output_path}")
+        
+    except Exception as e:
+        print(f"Error during ingest: {e}")
+        sys.exit(1)
+
+
+def batch_merge(query_results_path: str, response_results_path: str, output_file: str):
+    """Merge both stages' batch results into dialogues"""
+    from batch_io import merge_batch_results
+    
+    print("=== Merge Batch Results ===")
+    
+    try:
+        generator = create_generator(offline=True)
+        data = load_data()
+        
+        count, failures = merge_batch_results(
+            generator, data, query_results_path, response_results_path, output_file
+        )
+        _report_failures(failures)
+        print(f"✓ Wrote {count} dialogues to {output_file}")
+        
+    except Exception as e:
+        print(f"Error during merge: {e}")
+        sys.exit(1)
+
+
+def _ensure_parent_dir(path: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _report_failures(failures, limit: int = 10):
+    if not failures:
+        return
+    print(f"⚠ {len(failures)} requests could not be used:")
+    for failure in failures[:limit]:
+        print(f"  {failure}")
+    if len(failures) > limit:
+        print(f"  ... and {len(failures) - limit} more")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Skeleton-guided multi-turn dialogue generation")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    run_parser = subparsers.add_parser("run", help="Batch generation (default)")
+    test_parser = subparsers.add_parser("test", help="Generate a single test dialogue")
+    test_parser.add_argument("--service", help="Generate it on a running service "
+                                               "(http://host:port or unix:<path>)")
+    resume_parser = subparsers.add_parser("resume", help="Resume an interrupted batch generation")
+    subparsers.add_parser("finalize", help="Convert the JSONL output stream into a JSON array")
+    for shard_parser in (run_parser, resume_parser):
+        shard_parser.add_argument("--shard-index", type=int, default=0,
+                                  help="Shard generated by this worker (0-based)")
+        shard_parser.add_argument("--num-shards", type=int, default=1,
+                                  help="Total number of shards the run is split into")
+    
+    merge_shards_parser = subparsers.add_parser(
+        "merge-shards", help="Merge, de-duplicate and validate the output shards of a sharded run"
+    )
+    merge_shards_parser.add_argument("shards", nargs="*",
+                                     help="Shard JSONL streams (default: derived from --num-shards)")
+    merge_shards_parser.add_argument("--num-shards", type=int, default=1)
+    merge_shards_parser.add_argument("--allow-incomplete", action="store_true",
+                                     help="Exit successfully even if dialogues are missing")
+    
+    dedup_parser = subparsers.add_parser(
+        "dedup", help="Drop near-duplicate dialogues (by their queries) from an output file"
+    )
+    dedup_parser.add_argument("input", nargs="?", default=FILE_PATHS["output_file"],
+                              help="Output file (.json) or stream (.jsonl[.gz]) to deduplicate")
+    dedup_parser.add_argument("--output", help="Deduplicated file (default: <input>.deduped.json)")
+    dedup_parser.add_argument("--threshold", type=float,
+                              help="Similarity threshold (default: DEDUP_CONFIG['threshold'])")
+    dedup_parser.add_argument("--report", help="Write the dropped duplicates to this JSONL file")
+    
+    validate_parser = subparsers.add_parser(
+        "validate", help="Drop dialogues that fail the quality validators from an output file"
+    )
+    validate_parser.add_argument("input", nargs="?", default=FILE_PATHS["output_file"],
+                                 help="Output file (.json) or stream (.jsonl[.gz]) to validate")
+    validate_parser.add_argument("--output", help="Validated file (default: <input>.valid.json)")
+    validate_parser.add_argument("--rejects", help="Rejected dialogues with reasons "
+                                                   "(default: <output>.rejects.jsonl)")
+    validate_parser.add_argument("--workers", type=int,
+                                 help="Validation processes (default: VALIDATION_CONFIG['workers'])")
+    
+    columnar_parser = subparsers.add_parser(
+        "export-columnar", help="Export dialogues to columnar files partitioned by category and flow type"
+    )
+    columnar_parser.add_argument("input", nargs="?", default=FILE_PATHS["output_file"],
+                                 help="Output file (.json) or stream (.jsonl[.gz]) to export")
+    columnar_parser.add_argument("--output", help="Export directory (default: <input>.columnar)")
+    columnar_parser.add_argument("--format", choices=["auto", "arrow", "parquet", "fallback"],
+                                 help="File format (default: OUTPUT_CONFIG['columnar_format'])")
+    columnar_parser.add_argument("--rows-per-file", type=int,
+                                 help="Rows per file (default: OUTPUT_CONFIG['columnar_rows_per_file'])")
+    columnar_parser.add_argument("--overwrite", action="store_true",
+                                 help="Replace an earlier export in the output directory")
+    
+    plan_parser = subparsers.add_parser(
+        "plan", help="Estimate tokens, cost and wall-clock time of a run (no API calls)"
+    )
+    plan_parser.add_argument("--concurrency", type=int,
+                             help="Concurrent requests (default: from GENERATION_CONFIG)")
+    plan_parser.add_argument("--tokenizer",
+                             help="heuristic, tiktoken:<name> or hf:<name> (default: PLANNER_CONFIG)")
+    plan_parser.add_argument("--json", dest="output", help="Also write the estimate to this JSON file")
+    
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run a resident generation service that accepts jobs over HTTP or a Unix socket"
+    )
+    serve_parser.add_argument("--host", help="Interface to listen on (default: SERVICE_CONFIG['host'])")
+    serve_parser.add_argument("--port", type=int, help="HTTP port (default: SERVICE_CONFIG['port'])")
+    serve_parser.add_argument("--socket", help="Listen on this Unix socket instead of host/port")
+    serve_parser.add_argument("--max-concurrency", type=int,
+                              help="Workers shared by all jobs (default: SERVICE_CONFIG['max_concurrency'])")
+    
+    submit_parser = subparsers.add_parser(
+        "submit", help="Generate the dialogues for a scenario file on a running service"
+    )
+    submit_parser.add_argument("input", help="Data file (.json) or scenario catalog (.jsonl[.gz])")
+    submit_parser.add_argument("--service", help="http://host:port or unix:<path> (default: from SERVICE_CONFIG)")
+    submit_parser.add_argument("--output", help="Output file (default: FILE_PATHS['output_file'])")
+    submit_parser.add_argument("--samples", type=int, help="Dialogues per scenario")
+    submit_parser.add_argument("--validate", action="store_true", default=None,
+                               help="Drop dialogues that fail the VALIDATION_CONFIG validators")
+    
+    export_parser = subparsers.add_parser(
+        "batch-export-queries", help="Write query-stage batch requests (no API calls)"
+    )
+    export_parser.add_argument("--output", default=FILE_PATHS.get("query_batch", "query_batch.jsonl"))
+    
+    ingest_parser = subparsers.add_parser(
+        "batch-ingest-queries", help="Turn query-stage batch results into response-stage requests"
+    )
+    ingest_parser.add_argument("results", help="Query-stage batch result JSONL")
+    ingest_parser.add_argument("--output", default=FILE_PATHS.get("response_batch", "response_batch.jsonl"))
+    
+    merge_parser = subparsers.add_parser(
+        "batch-merge", help="Merge query- and response-stage batch results into dialogues"
+    )
+    merge_parser.add_argument("query_results", help="Query-stage batch result JSONL")
+    merge_parser.add_argument("response_results", help="Response-stage batch result JSONL")
+    merge_parser.add_argument("--output", default=FILE_PATHS["output_file"])
+    
+    args = parser.parse_args(argv)
+    if args.command in ("run", "resume"):
+        try:
+            validate_shard(args.shard_index, args.num_shards)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] == "test":
-        test_single()
+    args = parse_args()
+    if args.command == "test":
+        test_single(args.service)
+    elif args.command == "run":
+        main(shard_index=args.shard_index, num_shards=args.num_shards)
+    elif args.command == "resume":
+        main(resume=True, shard_index=args.shard_index, num_shards=args.num_shards)
+    elif args.command == "finalize":
+        finalize()
+    elif args.command == "merge-shards":
+        merge_shards(args.num_shards, args.shards, args.allow_incomplete)
+    elif args.command == "dedup":
+        dedup_output(args.input, args.output, args.threshold, args.report)
+    elif args.command == "validate":
+        validate_output(args.input, args.output, args.rejects, args.workers)
+    elif args.command == "export-columnar":
+        export_columnar(args.input, args.output, args.format, args.rows_per_file, args.overwrite)
+    elif args.command == "plan":
+        plan(args.concurrency, args.tokenizer, args.output)
+    elif args.command == "serve":
+        serve(args.host, args.port, args.socket, args.max_concurrency)
+    elif args.command == "submit":
+        submit(args.input, args.service, args.output, args.samples, args.validate)
+    elif args.command == "batch-export-queries":
+        batch_export_queries(args.output)
+    elif args.command == "batch-ingest-queries":
+        batch_ingest_queries(args.results, args.output)
+    elif args.command == "batch-merge":
+        batch_merge(args.query_results, args.response_results, args.output)
     else:
         main()
@@ -0,0 +1,209 @@
+"""
+Per-call instrumentation of API requests.
+
+Every chat completion call is recorded with its prompt/completion token usage,
+wall latency, time to first token (for streamed calls), retry count and finish
+reason, labelled by stage (query/response), category, flow type and endpoint.
+``MetricsRecorder`` keeps running aggregates for each label value that can be
+read while a run is in progress and written out at the end as JSON or in the
+Prometheus text exposition format. Percentiles come from fixed-size latency
+samples and histograms from bucket counts, and the number of values per
+label is capped, so memory stays flat in a long-running service.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from pipeline import LatencySample
+
+# Upper bounds (seconds) of the exported latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+DIMENSIONS = ("stage", "category", "flow_type", "endpoint")
+
+# Latencies kept for percentiles: the total and each label value
+TOTAL_SAMPLE_SIZE = 2048
+LABEL_SAMPLE_SIZE = 256
+# Distinct values per dimension; later ones (e.g. categories sent by service
+# clients) are aggregated under OTHER_LABEL
+MAX_LABEL_VALUES = 1000
+OTHER_LABEL = "other"
+
+
+class CallStats:
+    """Aggregates over the calls that share one label value"""
+
+    def __init__(self, sample_size: int = LABEL_SAMPLE_SIZE):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.truncated = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = LatencySample(sample_size, LATENCY_BUCKETS)
+        self.ttfts = LatencySample(sample_size, LATENCY_BUCKETS)
+
+    def add(self, prompt_tokens: int, completion_tokens: int, latency: float,
+            ttft: Optional[float], retries: int, ok: bool, truncated: bool):
+        self.calls += 1
+        self.retries += retries
+        if not ok:
+            self.failures += 1
+            return
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.latencies.add(latency)
+        if ttft is not None:
+            self.ttfts.add(ttft)
+        if truncated:
+            self.truncated += 1
+
+    def snapshot(self, elapsed: float) -> Dict:
+        """Counters, tokens/sec and latency percentiles"""
+        snapshot = {
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "truncated": self.truncated,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "completion_tokens_per_sec": self.completion_tokens / elapsed if elapsed > 0 else 0.0,
+            "latency_mean": self.latencies.mean(),
+        }
+        for label, value in self.latencies.percentiles().items():
+            snapshot[f"latency_{label}"] = value
+        if self.ttfts.count:
+            for label, value in self.ttfts.percentiles().items():
+                snapshot[f"ttft_{label}"] = value
+        return snapshot
+
+
+class MetricsRecorder:
+    """Thread-safe recorder of per-call API metrics"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.total = CallStats(TOTAL_SAMPLE_SIZE)
+        self.by: Dict[str, Dict[str, CallStats]] = {dimension: {} for dimension in DIMENSIONS}
+        # Category -> flow type, so calls only need to know their category
+        self.flow_types: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str = "", category: str = "", endpoint: str = "",
+               prompt_tokens: int = 0, completion_tokens: int = 0, latency: float = 0.0,
+               ttft: Optional[float] = None, retries: int = 0, ok: bool = True,
+               truncated: bool = False):
+        """
+        Record one API call.
+
+        ``retries`` counts failed attempts before the final one; ``truncated``
+        marks completions cut off by ``max_tokens`` (finish_reason "length").
+        """
+        labels = {
+            "stage": stage,
+            "category": category,
+            "flow_type": self.flow_types.get(category, ""),
+            "endpoint": endpoint,
+        }
+        values = (prompt_tokens, completion_tokens, latency, ttft, retries, ok, truncated)
+        with self._lock:
+            self.total.add(*values)
+            for dimension, value in labels.items():
+                if value:
+                    groups = self.by[dimension]
+                    if value not in groups and len(groups) >= MAX_LABEL_VALUES:
+                        value = OTHER_LABEL
+                    groups.setdefault(value, CallStats()).add(*values)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def snapshot(self) -> Dict:
+        """Live totals and per-label aggregates"""
+        elapsed = self.elapsed()
+        with self._lock:
+            return {
+                "elapsed_seconds": elapsed,
+                "total": self.total.snapshot(elapsed),
+                **{
+                    f"by_{dimension}": {
+                        value: stats.snapshot(elapsed) for value, stats in groups.items()
+                    }
+                    for dimension, groups in self.by.items()
+                },
+            }
+
+    def tokens_per_second(self) -> float:
+        """Completion tokens per second since the recorder was created"""
+        elapsed = self.elapsed()
+        with self._lock:
+            return self.total.completion_tokens / elapsed if elapsed > 0 else 0.0
+
+    def write(self, path: str):
+        """Write a snapshot to path: Prometheus text for .prom/.txt, JSON otherwise"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith(".prom") or path.endswith(".txt"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def to_prometheus(self) -> str:
+        """Aggregates in the Prometheus text exposition format"""
+        with self._lock:
+            groups = [({}, self.total)] + [
+                ({dimension: value}, stats)
+                for dimension, by_value in self.by.items()
+                for value, stats in by_value.items()
+            ]
+            counters = [
+                ("calls", "API calls", lambda s: s.calls),
+                ("failures", "API calls that failed after all retries", lambda s: s.failures),
+                ("retries", "Retried API attempts", lambda s: s.retries),
+                ("truncated", "Completions cut off by max_tokens", lambda s: s.truncated),
+                ("prompt_tokens", "Prompt tokens", lambda s: s.prompt_tokens),
+                ("completion_tokens", "Completion tokens", lambda s: s.completion_tokens),
+            ]
+            lines = []
+            for name, help_text, value in counters:
+                lines.append(f"# HELP dialogue_api_{name}_total {help_text}")
+                lines.append(f"# TYPE dialogue_api_{name}_total counter")
+                for labels, stats in groups:
+                    lines.append(f"dialogue_api_{name}_total{_labels(labels)} {value(stats)}")
+
+            for name, help_text, attribute in (
+                ("latency_seconds", "Wall latency of successful API calls", "latencies"),
+                ("ttft_seconds", "Time to first token of streamed API calls", "ttfts"),
+            ):
+                lines.append(f"# HELP dialogue_api_{name} {help_text}")
+                lines.append(f"# TYPE dialogue_api_{name} histogram")
+                for labels, stats in groups:
+                    samples = getattr(stats, attribute)
+                    for bound, count in zip(samples.buckets, samples.bucket_counts):
+                        bucket = _labels({**labels, "le": f"{bound:g}"})
+                        lines.append(f"dialogue_api_{name}_bucket{bucket} {count}")
+                    lines.append(f"dialogue_api_{name}_bucket{_labels({**labels, 'le': '+Inf'})} "
+                                 f"{samples.count}")
+                    lines.append(f"dialogue_api_{name}_sum{_labels(labels)} {samples.total}")
+                    lines.append(f"dialogue_api_{name}_count{_labels(labels)} {samples.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    """Prometheus label set, e.g. {stage="query"}"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Local mock OpenAI-compatible server for offline testing and benchmarking.
+
+Speaks ``GET /v1/models`` and ``POST /v1/chat/completions`` and answers with
+valid ``{"turns": [...]}`` payloads: query-stage prompts get six questions and
+response-stage prompts get one answer per listed question. Latency follows a
+configurable distribution plus a per-token decode time, and a fraction of
+requests can be answered with 5xx errors, 429s or malformed completions
+(never when ``response_format`` or ``guided_json`` constrains the output).
+Completions longer than ``max_tokens`` are cut off with finish_reason
+"length", and ``stream: true`` requests are answered as server-sent events,
+counting clients that hang up mid-stream as cancelled.
+
+Usage:
+    python mock_server.py --port 8000 --latency 0.2 --latency-dist lognormal
+    python mock_server.py --port 8000 --tokens-per-second 50 --error-rate 0.02 --rate-limit-rate 0.05
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+class MockServerConfig:
+    """Behaviour of the mock server"""
+
+    def __init__(self, latency: float = 0.2, latency_dist: str = "fixed", latency_sigma: float = 0.5,
+                 tokens_per_second: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, malformed_rate: float = 0.0,
+                 retry_after: Optional[float] = None, slots: int = 0, seed: Optional[int] = None):
+        """
+        ``latency`` is the mean time to first token, drawn from ``latency_dist``
+        (``lognormal`` uses ``latency_sigma`` as the shape). With
+        ``tokens_per_second`` set, decoding the completion adds its estimated
+        token count divided by that rate. ``error_rate``, ``rate_limit_rate``
+        and ``malformed_rate`` are per-request probabilities of a 500, a 429
+        (with ``Retry-After`` if given) and an unparseable completion. ``slots``
+        limits concurrent requests like a replica's batch capacity (0 = unlimited).
+        """
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"latency_dist must be one of {LATENCY_DISTRIBUTIONS}")
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.retry_after = retry_after
+        self.slots = slots
+        self.random = random.Random(seed)
+
+    def sample_latency(self) -> float:
+        """Time to first token for one request"""
+        if self.latency <= 0:
+            return 0.0
+        if self.latency_dist == "uniform":
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_dist == "exponential":
+            return self.random.expovariate(1 / self.latency)
+        if self.latency_dist == "lognormal":
+            # Parameterised so the mean stays at `latency`
+            mu = math.log(self.latency) - self.latency_sigma ** 2 / 2
+            return self.random.lognormvariate(mu, self.latency_sigma)
+        return self.latency
+
+
+class MockServerStats:
+    """Thread-safe counters of what the server answered"""
+
+    def __init__(self):
+        self.requests = 0
+        self.completions = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.malformed = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def count(self, field: str, amount: int = 1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "completions": self.completions,
+                "errors": self.errors,
+                "rate_limited": self.rate_limited,
+                "malformed": self.malformed,
+                "cancelled": self.cancelled,
+            }
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (4 characters per token)"""
+    return max(1, len(text) // 4)
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """/v1/chat/completions handler returning {"turns": [...]} payloads"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    config = MockServerConfig()
+    stats = MockServerStats()
+    # Limits concurrent requests per server, like a replica's batch capacity
+    slots = None
+
+    def do_GET(self):
+        self._send_json(200, {
+            "object": "list",
+            "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}],
+        })
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        prompt = body["messages"][-1]["content"]
+        config = self.config
+        self.stats.count("requests")
+
+        roll = config.random.random()
+        if roll < config.rate_limit_rate:
+            self.stats.count("rate_limited")
+            headers = {}
+            if config.retry_after is not None:
+                headers["Retry-After"] = f"{config.retry_after:g}"
+            self._send_json(429, {"error": {"message": "Rate limit exceeded (mock)",
+                                            "type": "rate_limit_error"}}, headers)
+            return
+        if roll < config.rate_limit_rate + config.error_rate:
+            self.stats.count("errors")
+            self._send_json(500, {"error": {"message": "Internal error (mock)",
+                                            "type": "server_error"}})
+            return
+
+        # Response-stage prompts list the questions; answer each of them.
+        questions = re.findall(r"^Question \d+:", prompt, flags=re.MULTILINE)
+        if questions:
+            turns = [f"Mock answer {i + 1}" for i in range(len(questions))]
+        else:
+            turns = [f"Mock question {i + 1}" for i in range(6)]
+
+        max_tokens = body.get("max_tokens")
+        # Constrained decoding always yields valid JSON
+        constrained = bool(body.get("response_format") or body.get("guided_json"))
+        choices = []
+        for index in range(max(1, body.get("n", 1))):
+            content = json.dumps({"turns": turns})
+            if not constrained and config.random.random() < config.malformed_rate:
+                self.stats.count("malformed")
+                # A chatty preamble and a syntax error right after the first turn
+                content = "Sure! Here are the turns:\n```json\n" + content.replace('", "', '", oops "', 1)
+            finish_reason = "stop"
+            if max_tokens and estimate_tokens(content) > max_tokens:
+                content = content[:max_tokens * 4]
+                finish_reason = "length"
+            choices.append({"index": index, "content": content, "finish_reason": finish_reason})
+
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = sum(estimate_tokens(choice["content"]) for choice in choices)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        with self.slots if self.slots is not None else contextlib.nullcontext():
+            if body.get("stream"):
+                self._stream(body, choices, usage)
+                return
+            delay = config.sample_latency()
+            if config.tokens_per_second > 0:
+                # Choices decode in parallel, so one choice's tokens set the pace
+                delay += completion_tokens / len(choices) / config.tokens_per_second
+            time.sleep(delay)
+
+        self.stats.count("completions", len(choices))
+        self._send_json(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {
+                    "index": choice["index"],
+                    "message": {"role": "assistant", "content": choice["content"]},
+                    "finish_reason": choice["finish_reason"],
+                }
+                for choice in choices
+            ],
+            "usage": usage,
+        })
+
+    def _stream(self, body: Dict, choices: List[Dict], usage: Dict):
+        """Send the choices as server-sent events, one token-sized piece at a time"""
+        config = self.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(payload) -> bytes:
+            data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n"
+            data = data.encode("utf-8")
+            return f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n"
+
+        def chunk(index: int, delta: Dict, finish_reason: Optional[str] = None) -> Dict:
+            return {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        pieces = [
+            [choice["content"][i:i + 4] for i in range(0, len(choice["content"]), 4)]
+            for choice in choices
+        ]
+        try:
+            time.sleep(config.sample_latency())
+            for step in range(max(len(p) for p in pieces)):
+                for choice, choice_pieces in zip(choices, pieces):
+                    if step < len(choice_pieces):
+                        delta = {"content": choice_pieces[step]}
+                        if step == 0:
+                            delta["role"] = "assistant"
+                        self.wfile.write(event(chunk(choice["index"], delta)))
+                self.wfile.flush()
+                if config.tokens_per_second > 0:
+                    time.sleep(1 / config.tokens_per_second)
+            for choice in choices:
+                self.wfile.write(event(chunk(choice["index"], {}, choice["finish_reason"])))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                final = chunk(0, {})
+                final["choices"] = []
+                final["usage"] = usage
+                self.wfile.write(event(final))
+            self.wfile.write(event("[DONE]"))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up mid-stream, which cancels the request
+            self.stats.count("cancelled")
+            self.close_connection = True
+            return
+        self.stats.count("completions", len(choices))
+
+    def _send_json(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(latency: float = 0.2, slots: int = 0, config: Optional[MockServerConfig] = None,
+                      host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start a mock server in a background thread (port 0 picks a free port).
+
+    Pass a MockServerConfig for anything beyond a fixed latency. The config
+    stays live as ``server.config`` and the counters are ``server.stats``.
+    """
+    if config is None:
+        config = MockServerConfig(latency=latency, slots=slots)
+    stats = MockServerStats()
+    handler = type("ConfiguredMockChatHandler", (MockChatHandler,), {
+        "config": config,
+        "stats": stats,
+        "slots": threading.BoundedSemaphore(config.slots) if config.slots else None,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """Command line options shared by this script and benchmark.py"""
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Mean time to first token per request in seconds")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="fixed",
+                        help="Distribution of the per-request latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.5,
+                        help="Shape of the lognormal latency distribution")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Decode rate per request (0 = instant decoding)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with HTTP 429")
+    parser.add_argument("--retry-after", type=float, default=None,
+                        help="Retry-After seconds sent with 429 responses")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Fraction of completions that are not valid JSON")
+    parser.add_argument("--server-slots", type=int, default=0,
+                        help="Concurrent requests each mock server handles (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed for reproducible latencies and failures")
+
+
+def config_from_args(args: argparse.Namespace) -> MockServerConfig:
+    """Build a MockServerConfig from add_server_arguments options"""
+    return MockServerConfig(
+        latency=args.latency,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        malformed_rate=args.malformed_rate,
+        retry_after=args.retry_after,
+        slots=args.server_slots,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(config=config_from_args(args), host=args.host, port=args.port)
+    host, port = server.server_address[:2]
+    print(f"Mock server listening on http://{host}:{port}/v1 (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"\nServed: {server.stats.snapshot()}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Streaming output writer for generated dialogues.
+
+Dialogues are appended to a JSON Lines file one record at a time, so memory use
+and bytes written per dialogue stay constant regardless of run size. The
+finished stream can be converted into the pretty-printed JSON array format that
+batch_generate used to produce.
+"""
+
+import gzip
+import json
+import os
+from typing import Callable, Dict, Iterator, Optional
+
+
+def stream_path_for(output_file: str, compress: bool = False) -> str:
+    """Return the JSONL stream path that backs an output file"""
+    if is_stream_path(output_file):
+        return output_file
+    root, ext = os.path.splitext(output_file)
+    path = f"{root}.jsonl" if ext == ".json" else f"{output_file}.jsonl"
+    return f"{path}.gz" if compress else path
+
+
+def is_stream_path(path: str) -> bool:
+    """Whether a path already names a JSONL stream"""
+    return path.endswith(".jsonl") or path.endswith(".jsonl.gz")
+
+
+def _open_text(path: str, mode: str):
+    """Open a plain or gzip-compressed text file"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_records(path: str) -> Iterator[Dict]:
+    """Lazily iterate over the records of a JSONL stream (plain or gzip)"""
+    with _open_text(path, "r") as f:
+        line_number = 0
+        try:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write can leave a partial last line behind
+                    print(f"Skipping unreadable record at {path}:{line_number}")
+        except EOFError:
+            # Truncated gzip member, again from a crash mid-write
+            print(f"Stream {path} ends with a truncated record after line {line_number}")
+
+
+def repair_stream(path: str):
+    """Drop a partially written trailing record so the stream can be appended to"""
+    if not os.path.exists(path):
+        return
+
+    if not path.endswith(".gz"):
+        with open(path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            # Scan backwards for the last complete line
+            position = size
+            while position > 0:
+                step = min(65536, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position != size:
+                f.truncate(position)
+        return
+
+    try:
+        with gzip.open(path, "rb") as f:
+            while f.read(1 << 20):
+                pass
+        return
+    except (EOFError, OSError):
+        pass
+
+    # Rewrite the readable records into a fresh gzip stream
+    tmp_path = f"{path}.repair.gz"
+    with DialogueWriter(tmp_path, fsync_interval=0) as writer:
+        for record in read_records(path):
+            writer.write(record)
+    os.replace(tmp_path, path)
+
+
+class DialogueWriter:
+    """
+    Append-only JSONL writer with optional gzip compression.
+
+    Every record is written as a single line. The underlying file is flushed
+    and fsynced every ``fsync_interval`` records (0 disables periodic fsync)
+    and always on close. ``on_sync`` is called after each fsync, once the
+    records written so far are on disk.
+    """
+
+    def __init__(self, path: str, fsync_interval: int = 50, ensure_ascii: bool = False,
+                 append: bool = False, on_sync: Optional[Callable[[], None]] = None):
+        """Open the stream, truncating it unless append is set"""
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.ensure_ascii = ensure_ascii
+        self.on_sync = on_sync
+        self.count = 0
+        self._unsynced = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._raw = open(path, "ab" if append else "wb")
+        if path.endswith(".gz"):
+            # Appending to a gzip file adds a new member; readers concatenate them
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        else:
+            self._stream = self._raw
+
+    def write(self, record: Dict):
+        """Append one record"""
+        line = json.dumps(record, ensure_ascii=self.ensure_ascii) + "\n"
+        self._stream.write(line.encode("utf-8"))
+        self.count += 1
+        self._unsynced += 1
+        if self.fsync_interval and self._unsynced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Flush buffered records and fsync them to disk"""
+        if self._stream is not self._raw:
+            self._stream.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._unsynced = 0
+        if self.on_sync is not None:
+            self.on_sync()
+
+    def close(self):
+        """Sync and close the stream"""
+        if self._raw.closed:
+            return
+        self.sync()
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def finalize_to_json(stream_path: str, json_path: str, ensure_ascii: bool = False,
+                     indent: Optional[int] = 2) -> int:
+    """
+    Convert a JSONL stream into a JSON array file.
+
+    The output is byte-identical to ``json.dump(records, f, indent=indent)``
+    but records are streamed one at a time instead of loaded into memory.
+    Returns the number of records written.
+    """
+    count = 0
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        out.write("[")
+        for record in read_records(stream_path):
+            if indent is None:
+                out.write(", " if count else "")
+                out.write(json.dumps(record, ensure_ascii=ensure_ascii))
+            else:
+                pad = " " * indent
+                text = json.dumps(record, ensure_ascii=ensure_ascii, indent=indent)
+                out.write(",\n" if count else "\n")
+                out.write(pad + text.replace("\n", "\n" + pad))
+            count += 1
+        if count and indent is not None:
+            out.write("\n")
+        out.write("]")
+    os.replace(tmp_path, json_path)
+    return count
@@ -0,0 +1,261 @@
+"""
+Two-stage pipelined scheduler for dialogue generation.
+
+The query stage and the response stage each get their own bounded input queue
+and worker pool, so the queries of the next scenarios are in flight while
+earlier responses are still decoding. Bounded queues give backpressure: the
+feeder blocks when the query stage falls behind and query workers block when
+the response stage does.
+"""
+
+import bisect
+import queue
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from work_items import WorkItem
+
+_DONE = object()
+
+
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+
+class LatencySample:
+    """
+    Count, sum and a bounded uniform sample of latencies.
+
+    Percentiles come from a reservoir of at most ``size`` values, so memory
+    and the cost of a snapshot stay flat however many latencies are added.
+    With ``buckets`` (ascending upper bounds) it also keeps exact cumulative
+    histogram counts. Not thread-safe; callers hold their own lock.
+    """
+
+    def __init__(self, size: int = 2048, buckets: Tuple[float, ...] = ()):
+        self.size = max(1, size)
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self._reservoir: List[float] = []
+        # Seeded so identical runs report identical percentiles
+        self._random = random.Random(0)
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        for index in range(bisect.bisect_left(self.buckets, value), len(self.buckets)):
+            self.bucket_counts[index] += 1
+        if len(self._reservoir) < self.size:
+            self._reservoir.append(value)
+        else:
+            # Reservoir sampling: every value ends up kept with equal probability
+            index = self._random.randrange(self.count)
+            if index < self.size:
+                self._reservoir[index] = value
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentiles(self) -> Dict[str, float]:
+        """p50/p95/p99 of the sampled values"""
+        values = sorted(self._reservoir)
+        return {label: percentile(values, fraction) for label, fraction in PERCENTILES}
+
+
+class StageStats:
+    """Thread-safe counters and latency samples for one pipeline stage"""
+
+    def __init__(self, name: str, concurrency: int, input_queue: queue.Queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self._queue = input_queue
+        self._latencies = LatencySample()
+        self._lock = threading.Lock()
+
+    def observe_queue(self):
+        """Sample the current input queue depth"""
+        depth = self._queue.qsize()
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finish(self, latency: float, ok: bool):
+        with self._lock:
+            self.in_flight -= 1
+            self._latencies.add(latency)
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self) -> Dict:
+        """Current queue depth, throughput counters and latency percentiles"""
+        with self._lock:
+            snapshot = {
+                "concurrency": self.concurrency,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+            for label, value in self._latencies.percentiles().items():
+                snapshot[f"latency_{label}"] = value
+            snapshot["latency_mean"] = self._latencies.mean()
+        return snapshot
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class TwoStagePipeline:
+    """
+    Run query and response stages on separate worker pools.
+
+    ``query_stage(group)`` takes a group of work items (the samples of one
+    scenario) and returns ``(item, queries)`` pairs; each pair goes to
+    ``response_stage(item, queries)``, which turns it into a dialogue. Results
+    and failures are delivered per item on the thread that calls ``run``, so
+    callers can write output without extra locking. An error raised by the
+    groups iterable stops the feed and is re-raised by ``run`` once the
+    items already queued are done.
+    """
+
+    def __init__(self, query_stage: Callable[[List[WorkItem]], List[Tuple[WorkItem, Any]]],
+                 response_stage: Callable[[WorkItem, Any], Dict],
+                 query_concurrency: int = 4, response_concurrency: int = 8,
+                 queue_size: int = 16):
+        self.query_stage = query_stage
+        self.response_stage = response_stage
+        self.query_concurrency = max(1, query_concurrency)
+        self.response_concurrency = max(1, response_concurrency)
+
+        self._query_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self._response_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self._results: queue.Queue = queue.Queue()
+        self.query_stats = StageStats("query", self.query_concurrency, self._query_queue)
+        self.response_stats = StageStats("response", self.response_concurrency,
+                                         self._response_queue)
+
+        self._query_workers_left = self.query_concurrency
+        self._feed_error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per-stage queue depth, counters and latency percentiles"""
+        return {
+            "query": self.query_stats.snapshot(),
+            "response": self.response_stats.snapshot(),
+        }
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Current input queue depth per stage, without the latency percentiles"""
+        return {
+            "query": self._query_queue.qsize(),
+            "response": self._response_queue.qsize(),
+        }
+
+    def _feed(self, groups: Iterable[List[WorkItem]]):
+        try:
+            for group in groups:
+                self._query_queue.put(group)
+                self.query_stats.observe_queue()
+        except BaseException as e:
+            # Raised again on the caller's thread by run()
+            self._feed_error = e
+        finally:
+            for _ in range(self.query_concurrency):
+                self._query_queue.put(_DONE)
+
+    def _query_worker(self):
+        while True:
+            group = self._query_queue.get()
+            if group is _DONE:
+                break
+            self.query_stats.start()
+            start = time.perf_counter()
+            try:
+                pairs = self.query_stage(group)
+            except Exception as e:
+                self.query_stats.finish(time.perf_counter() - start, ok=False)
+                for item in group:
+                    self._results.put((item, None, e))
+                continue
+            self.query_stats.finish(time.perf_counter() - start, ok=True)
+            for item, queries in pairs:
+                self._response_queue.put((item, queries))
+                self.response_stats.observe_queue()
+
+        # The last query worker to finish shuts the response stage down
+        with self._lock:
+            self._query_workers_left -= 1
+            last = self._query_workers_left == 0
+        if last:
+            for _ in range(self.response_concurrency):
+                self._response_queue.put(_DONE)
+
+    def _response_worker(self):
+        while True:
+            entry = self._response_queue.get()
+            if entry is _DONE:
+                break
+            item, queries = entry
+            self.response_stats.start()
+            start = time.perf_counter()
+            try:
+                dialogue = self.response_stage(item, queries)
+            except Exception as e:
+                self.response_stats.finish(time.perf_counter() - start, ok=False)
+                self._results.put((item, None, e))
+                continue
+            self.response_stats.finish(time.perf_counter() - start, ok=True)
+            self._results.put((item, dialogue, None))
+        self._results.put(_DONE)
+
+    def run(self, groups: Iterable[List[WorkItem]], on_result: Callable[[WorkItem, Dict], None],
+            on_error: Callable[[WorkItem, Exception], None]):
+        """
+        Push every group through both stages, blocking until all items are done.
+
+        Re-raises an error from groups after the workers have stopped, so a
+        run whose input broke off never looks complete.
+        """
+        threads = [threading.Thread(target=self._feed, args=(groups,), daemon=True)]
+        threads += [threading.Thread(target=self._query_worker, daemon=True)
+                    for _ in range(self.query_concurrency)]
+        threads += [threading.Thread(target=self._response_worker, daemon=True)
+                    for _ in range(self.response_concurrency)]
+        for thread in threads:
+            thread.start()
+
+        response_workers_left = self.response_concurrency
+        while response_workers_left:
+            entry = self._results.get()
+            if entry is _DONE:
+                response_workers_left -= 1
+                continue
+            item, dialogue, error = entry
+            if error is not None:
+                on_error(item, error)
+            else:
+                on_result(item, dialogue)
+
+        for thread in threads:
+            thread.join()
+        if self._feed_error is not None:
+            raise self._feed_error
@@ -0,0 +1,187 @@
+"""
+Dry-run planning of a batch run.
+
+``plan_run`` renders every query-stage prompt (and the instruction part of
+every response-stage prompt) from the data and templates without any network
+access, counts prompt tokens with a pluggable tokenizer and adds the expected
+completion tokens per call, taken from PLANNER_CONFIG or from the metrics
+file of an earlier run. The result projects total tokens, cost and
+wall-clock time at a given concurrency.
+
+Tokenizers are named by a spec string: ``"heuristic"`` (about four
+characters per token, one per CJK character), ``"tiktoken:<encoding or
+model>"`` or ``"hf:<model name or path>"``. The latter two need tiktoken or
+transformers installed and fall back to the heuristic otherwise.
+"""
+
+import json
+import os
+import re
+from itertools import groupby
+from typing import Callable, Dict, Optional, Union
+
+from scenario_loader import flow_definitions_of
+from work_items import iter_work_items
+
+# Chat-format tokens around a single user message (role markers etc.)
+MESSAGE_OVERHEAD_TOKENS = 8
+
+_WIDE_CHARACTERS = re.compile(r"[⺀-鿿가-힯豈-﫿＀-￯]")
+
+
+class Tokenizer:
+    """A named token counter"""
+
+    def __init__(self, name: str, count: Callable[[str], int]):
+        self.name = name
+        self.count = count
+
+
+def heuristic_token_count(text: str) -> int:
+    """About four characters per token, and one token per CJK character"""
+    wide = len(_WIDE_CHARACTERS.findall(text))
+    return (len(text) - wide + 3) // 4 + wide
+
+
+def get_tokenizer(spec: Union[str, Callable[[str], int], None] = None) -> Tokenizer:
+    """
+    Tokenizer for a spec string or a plain counting function.
+
+    Specs whose library is not installed fall back to the heuristic with a
+    warning; unknown specs raise ValueError.
+    """
+    if callable(spec):
+        return Tokenizer(getattr(spec, "__name__", "custom"), spec)
+    if not spec or spec == "heuristic":
+        return Tokenizer("heuristic", heuristic_token_count)
+
+    kind, _, name = spec.partition(":")
+    try:
+        if kind == "tiktoken":
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(name)
+            except KeyError:
+                encoding = tiktoken.get_encoding(name)
+            return Tokenizer(spec, lambda text: len(encoding.encode(text, disallowed_special=())))
+        if kind == "hf":
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(name)
+            return Tokenizer(spec, lambda text: len(tokenizer.encode(text, add_special_tokens=False)))
+    except ImportError as e:
+        print(f"⚠ Tokenizer {spec} is unavailable ({e}); using the heuristic")
+        return Tokenizer("heuristic", heuristic_token_count)
+    raise ValueError(f"unknown tokenizer {spec!r} (use heuristic, tiktoken:<name> or hf:<name>)")
+
+
+def recorded_stats(metrics_file: Optional[str]) -> Dict[str, Dict[str, float]]:
+    """
+    Per-stage completion tokens and latency per call from an earlier run's metrics JSON.
+
+    Returns {} when the file is missing or is not a JSON metrics snapshot.
+    """
+    if not metrics_file or not os.path.exists(metrics_file) or not metrics_file.endswith(".json"):
+        return {}
+    with open(metrics_file, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    stats = {}
+    for stage, values in snapshot.get("by_stage", {}).items():
+        calls = values.get("calls", 0) - values.get("failures", 0)
+        if calls > 0:
+            stats[stage] = {
+                "completion_tokens": values["completion_tokens"] / calls,
+                "latency": values.get("latency_mean", 0.0),
+            }
+    return stats
+
+
+def plan_run(generator, data, query_prompt_template: str, response_prompt_template: str,
+             settings: Dict, tokenizer: Optional[Tokenizer] = None, concurrency: int = 1,
+             requests_per_minute: Optional[float] = None,
+             tokens_per_minute: Optional[float] = None) -> Dict:
+    """
+    Project the tokens, cost and wall-clock time of generating every work item in data.
+
+    settings holds the PLANNER_CONFIG keys. Response prompts are estimated
+    as their rendered instructions plus the expected query-stage output,
+    since the real questions are not known before the run.
+    """
+    tokenizer = tokenizer or get_tokenizer(settings.get("tokenizer"))
+    flow_definitions = flow_definitions_of(data)
+    samples = generator.samples_per_scenario
+    recorded = recorded_stats(settings.get("metrics_file"))
+
+    completion = {
+        "query": settings.get("completion_tokens_query", 400),
+        "response": settings.get("completion_tokens_response", 1000),
+    }
+    latency = {}
+    for stage in completion:
+        if stage in recorded:
+            completion[stage] = recorded[stage]["completion_tokens"]
+            latency[stage] = recorded[stage]["latency"]
+        else:
+            latency[stage] = (settings.get("time_to_first_token", 0.5)
+                              + completion[stage] / max(1e-9, settings.get("decode_tokens_per_second", 40)))
+
+    # With n, all samples of a scenario share one query call and its prompt
+    query_calls_per_scenario = 1 if samples > 1 and generator.supports_n else samples
+    totals = {stage: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0.0} for stage in completion}
+    scenarios = 0
+    items = iter_work_items(data, samples)
+    for _, group in groupby(items, key=lambda item: (item.category, item.scenario)):
+        item = next(group)
+        scenarios += 1
+        flow_steps = generator.format_flow_steps(item.flow_type, flow_definitions)
+        query_prompt = generator.render_query_prompt(item.category, item.scenario,
+                                                     query_prompt_template, flow_steps)
+        query_tokens = tokenizer.count(query_prompt) + MESSAGE_OVERHEAD_TOKENS
+        totals["query"]["calls"] += query_calls_per_scenario
+        totals["query"]["prompt_tokens"] += query_tokens * query_calls_per_scenario
+        totals["query"]["completion_tokens"] += completion["query"] * samples
+
+        response_prompt = generator.render_response_prompt(item.category, item.scenario, [],
+                                                           response_prompt_template)
+        response_tokens = (tokenizer.count(response_prompt) + MESSAGE_OVERHEAD_TOKENS
+                           + int(completion["query"]))
+        totals["response"]["calls"] += samples
+        totals["response"]["prompt_tokens"] += response_tokens * samples
+        totals["response"]["completion_tokens"] += completion["response"] * samples
+
+    calls = sum(stage["calls"] for stage in totals.values())
+    prompt_tokens = sum(stage["prompt_tokens"] for stage in totals.values())
+    completion_tokens = int(sum(stage["completion_tokens"] for stage in totals.values()))
+    total_tokens = prompt_tokens + completion_tokens
+
+    # Wall-clock time: concurrency-bound call time, unless a rate limit is slower
+    call_seconds = sum(totals[stage]["calls"] * latency[stage] for stage in totals)
+    seconds = call_seconds / max(1, concurrency)
+    if requests_per_minute:
+        seconds = max(seconds, calls / requests_per_minute * 60)
+    if tokens_per_minute:
+        seconds = max(seconds, total_tokens / tokens_per_minute * 60)
+
+    cost = (prompt_tokens * settings.get("prompt_price_per_million", 0.0)
+            + completion_tokens * settings.get("completion_price_per_million", 0.0)) / 1_000_000
+    return {
+        "tokenizer": tokenizer.name,
+        "completion_source": "metrics" if recorded else "config",
+        "scenarios": scenarios,
+        "dialogues": scenarios * samples,
+        "concurrency": concurrency,
+        "stages": {
+            stage: {
+                "calls": values["calls"],
+                "prompt_tokens": values["prompt_tokens"],
+                "completion_tokens": int(values["completion_tokens"]),
+                "latency_per_call": latency[stage],
+            }
+            for stage, values in totals.items()
+        },
+        "calls": calls,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "cost": cost,
+        "wall_clock_seconds": seconds,
+    }
@@ -0,0 +1,66 @@
+"""
+Prefix-cache-friendly ordering of query-stage requests.
+
+vLLM and SGLang reuse the KV cache of a prompt prefix that an earlier request
+already computed. Query prompts share the static instructions, then diverge
+at the flow steps (``{{info_flows_steps}}``) and again at the scenario
+(``{{context}}``), so requests for the same flow type share a much longer
+prefix than requests for neighbouring categories in data-file order.
+
+``order_by_prefix`` reads pending scenario groups in bounded windows, renders
+each group's query prompt and sorts the window by it. Lexicographic order
+walks the prompts' prefix tree depth-first, so every request follows the one
+it shares the longest prefix with. The shared-prefix ratio reported per window
+is the fraction of prompt characters a prefix cache can reuse:
+``sum(common_prefix(previous, current)) / sum(len(prompt))``.
+"""
+
+import os
+from itertools import count, islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from work_items import WorkItem
+
+
+def common_prefix_length(first: str, second: str) -> int:
+    """Length of the longest common prefix of two strings"""
+    return len(os.path.commonprefix([first, second]))
+
+
+def shared_prefix_ratio(prompts: List[str]) -> float:
+    """Fraction of prompt characters shared with the preceding prompt, in the given order"""
+    total = sum(len(prompt) for prompt in prompts)
+    if not total:
+        return 0.0
+    shared = sum(common_prefix_length(previous, current)
+                 for previous, current in zip(prompts, prompts[1:]))
+    return shared / total
+
+
+def order_by_prefix(groups: Iterable[List[WorkItem]], render: Callable[[WorkItem], str],
+                    window: int = 256,
+                    report: Optional[Callable[[Dict], None]] = None) -> Iterator[List[WorkItem]]:
+    """
+    Yield groups reordered by their rendered prompt, one window of groups at a time.
+
+    render returns a work item's query prompt. report, if given, receives
+    each window's statistics: its index, request and prompt character
+    counts, and the shared-prefix ratio in arrival and in sorted order.
+    """
+    groups = iter(groups)
+    for index in count():
+        batch = list(islice(groups, max(1, window)))
+        if not batch:
+            return
+        prompts = [render(group[0]) for group in batch]
+        order = sorted(range(len(batch)), key=prompts.__getitem__)
+        if report is not None:
+            report({
+                "batch": index,
+                "requests": len(batch),
+                "prompt_chars": sum(len(prompt) for prompt in prompts),
+                "arrival_shared_prefix_ratio": shared_prefix_ratio(prompts),
+                "shared_prefix_ratio": shared_prefix_ratio([prompts[i] for i in order]),
+            })
+        for i in order:
+            yield batch[i]
@@ -0,0 +1,241 @@
+"""
+Rate control for API calls.
+
+Provides request/token budgets (token buckets), a hard per-run token budget,
+error classification into retryable and fatal failures, exponential backoff with jitter that honors
+``Retry-After``, and an AIMD concurrency limit that backs off when the server
+reports overload (429/503) and slowly grows back while requests succeed.
+"""
+
+import email.utils
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+from openai import APIConnectionError, APIStatusError
+
+RETRYABLE = "retryable"
+OVERLOADED = "overloaded"
+FATAL = "fatal"
+
+_RETRYABLE_STATUS = {408, 409, 500, 502, 504}
+_OVERLOADED_STATUS = {429, 503}
+_INVALID_REQUEST_STATUS = {400, 422}
+
+
+def classify_error(error: Exception) -> str:
+    """Classify an API error as OVERLOADED, RETRYABLE or FATAL"""
+    if isinstance(error, BudgetExceeded):
+        return FATAL
+    if isinstance(error, APIStatusError):
+        status = error.status_code
+        if status in _OVERLOADED_STATUS:
+            return OVERLOADED
+        if status in _RETRYABLE_STATUS or status >= 500:
+            return RETRYABLE
+        # 400/401/403/404/422 will fail the same way on every attempt
+        return FATAL
+    if isinstance(error, APIConnectionError):
+        return RETRYABLE
+    # Malformed or empty completions and other transient client-side issues
+    return RETRYABLE
+
+
+def rejects_parameter(error: Exception, name: str) -> bool:
+    """Whether error is the server refusing the request parameter called name"""
+    if not isinstance(error, APIStatusError) or error.status_code not in _INVALID_REQUEST_STATUS:
+        return False
+    if getattr(error, "param", None) == name:
+        return True
+    # Servers without a structured "param" name it in the message, e.g. "n must be 1"
+    pattern = rf"(?<![\w\\-])['\"`]?{re.escape(name)}['\"`]?(?![\w-])"
+    return re.search(pattern, f"{error} {getattr(error, 'body', '') or ''}") is not None
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Server-requested delay from Retry-After / retry-after-ms headers, if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter for the given (0-based) attempt"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at a per-minute rate"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float = 1.0):
+        """Block until ``amount`` tokens are available and take them"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, delta: float):
+        """Return (positive) or charge (negative) tokens after the fact"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets; None disables either"""
+
+    def __init__(self, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, estimated_tokens: int):
+        """Wait until one request of roughly ``estimated_tokens`` fits the budgets"""
+        if self.requests is not None:
+            self.requests.acquire(1)
+        if self.tokens is not None:
+            self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Correct the token budget once the real usage is known"""
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+
+class BudgetExceeded(RuntimeError):
+    """A request would take the run past its hard token budget"""
+
+
+class TokenBudget:
+    """
+    Hard cap on the prompt + completion tokens of a run; None disables it.
+
+    Each request reserves its worst case (prompt estimate plus max_tokens)
+    before it is sent and settles to the real usage afterwards, so
+    concurrent requests can never overshoot the limit together.
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.used = 0
+        self.reserved = 0
+        self.exceeded = False
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int):
+        """Reserve tokens for one request, raising BudgetExceeded if they do not fit"""
+        if self.limit is None:
+            return
+        with self._lock:
+            if self.used + self.reserved + tokens > self.limit:
+                self.exceeded = True
+                raise BudgetExceeded(f"token budget of {self.limit} would be exceeded "
+                                     f"({self.used} used, {self.reserved} reserved, {tokens} requested)")
+            self.reserved += tokens
+
+    def settle(self, reserved: int, actual: Optional[int]):
+        """Replace a reservation by the tokens actually used (the reservation if unknown)"""
+        if self.limit is None:
+            return
+        with self._lock:
+            self.reserved -= reserved
+            self.used += reserved if actual is None else actual
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on concurrent requests.
+
+    Each success raises the limit by ``1 / limit`` (about +1 per round trip of
+    the whole window); an overload signal cuts it to a fraction of the
+    requests actually in flight, at most once per ``cooldown`` seconds so one
+    burst of 429s only counts once. Until the first overload the limit sits at
+    ``max_limit`` and the callers' own worker counts decide concurrency.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease_factor: float = 0.5,
+                 cooldown: float = 2.0):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def on_success(self):
+        """Additive increase"""
+        with self._condition:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self._condition.notify_all()
+
+    def on_overload(self):
+        """Multiplicative decrease"""
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            current = min(self.limit, max(self.in_flight, 1))
+            self.limit = max(self.min_limit, current * self.decrease_factor)
+            print(f"Server overloaded, reducing concurrent requests to {int(self.limit)}")
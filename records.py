@@ -0,0 +1,69 @@
+"""
+Dialogue record formats.
+
+Full records hold every utterance twice: as ``turns`` (human/assistant pairs)
+and in the ``queries`` and ``responses`` lists. Compact records keep only the
+two lists, which halves their size and serialization time;
+``expand_record`` derives the turns again on read. ``read_dialogues`` reads
+either format from a JSON array, a JSONL stream or a columnar export.
+"""
+
+import json
+import os
+from typing import Dict, Iterator, List
+
+from output_writer import is_stream_path, read_records
+
+RECORD_FORMATS = ("full", "compact")
+
+# File suffixes of columnar exports (see columnar.py)
+COLUMNAR_SUFFIXES = (".arrow", ".parquet", ".dlgcol")
+
+
+def build_turns(queries: List[str], responses: List[str]) -> List[Dict]:
+    """Pair queries with responses into human/assistant turns"""
+    return [{"human": query, "assistant": response} for query, response in zip(queries, responses)]
+
+
+def compact_record(record: Dict) -> Dict:
+    """The record without its turns, deriving queries/responses from them if they are missing"""
+    compact = {key: value for key, value in record.items() if key != "turns"}
+    if "queries" not in compact or "responses" not in compact:
+        turns = record.get("turns") or []
+        compact.setdefault("queries", [turn["human"] for turn in turns])
+        compact.setdefault("responses", [turn["assistant"] for turn in turns])
+    return compact
+
+
+def expand_record(record: Dict) -> Dict:
+    """The record with turns, derived from queries/responses for compact records"""
+    if "turns" in record:
+        return record
+    expanded = dict(record)
+    expanded["turns"] = build_turns(record.get("queries") or [], record.get("responses") or [])
+    return expanded
+
+
+def turn_count(record: Dict) -> int:
+    """Number of human/assistant turns in a full or compact record"""
+    if "turns" in record:
+        return len(record["turns"] or [])
+    return min(len(record.get("queries") or []), len(record.get("responses") or []))
+
+
+def read_dialogues(path: str, expand: bool = True) -> Iterator[Dict]:
+    """
+    Iterate over the dialogues in a JSON array, a JSONL stream or a columnar export.
+
+    Records are expanded to full records unless expand is False.
+    """
+    if os.path.isdir(path) or path.endswith(COLUMNAR_SUFFIXES):
+        from columnar import read_columnar
+        records = read_columnar(path)
+    elif is_stream_path(path):
+        records = read_records(path)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+    for record in records:
+        yield expand_record(record) if expand else record
@@ -0,0 +1,157 @@
+"""
+Persistent cache of LLM completions.
+
+Completions are stored in a SQLite database keyed by a hash of the model,
+rendered messages and sampling parameters, so re-running a generation with an
+unchanged prompt returns the earlier completion without a network call. The
+database is kept under a size limit by evicting least recently used entries.
+Several processes can share one database: each tracks the size of its own
+writes and re-reads the total from SQLite every RESYNC_INTERVAL writes and
+before evicting, so the file exceeds the limit by at most what the other
+writers stored since the last re-read.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Writes between re-reads of the shared database size
+RESYNC_INTERVAL = 16
+
+
+class ResponseCache:
+    """Content-addressed, size-bounded LRU cache backed by SQLite"""
+
+    def __init__(self, path: str, max_size_mb: float = 512, bypass: bool = False):
+        """
+        Open (or create) the cache database.
+
+        With bypass set, lookups always miss but fresh completions are still
+        stored, which refreshes the cache without reading from it.
+        """
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Generous busy timeout: shard workers on one box share the cache file
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)"
+        )
+        self._conn.commit()
+        self._size = self._stored_size()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], **params) -> str:
+        """Hash the model, rendered messages and sampling parameters"""
+        payload = json.dumps(
+            {"model": model, "messages": messages, "params": params},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached completion for a key, or None on a miss"""
+        with self._lock:
+            if self.bypass:
+                self.misses += 1
+                return None
+            row = self._conn.execute(
+                "SELECT value FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        """Store a completion, evicting old entries if over the size limit"""
+        size = len(key) + len(value.encode("utf-8"))
+        with self._lock:
+            previous = self._conn.execute(
+                "SELECT size FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._size += size - (previous[0] if previous else 0)
+            self._writes += 1
+            if self._writes % RESYNC_INTERVAL == 0:
+                self._size = self._stored_size()
+            if self._size > self.max_size_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _stored_size(self) -> int:
+        """Size of every entry in the database, including other writers' entries"""
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def _evict(self):
+        """
+        Drop least recently used entries until the database is at 90% of the size limit.
+
+        Called inside the write transaction of put, so the size re-read here
+        and the deletes are not interleaved with other writers.
+        """
+        self._size = self._stored_size()
+        target = int(self.max_size_bytes * 0.9)
+        while self._size > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM completions ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._size -= size
+                self.evictions += 1
+                if self._size <= target:
+                    break
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current cache size"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": self._stored_size(),
+            }
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Streaming scenario catalogs.
+
+The JSON data file keeps every category and scenario in memory. Very large
+catalogs (e.g. topics crossed with personas) can instead be stored as JSON
+Lines, one scenario per line, that reference flow types by name::
+
+    {"flow_definitions": {"problem_diagnosis_to_solution": {"steps": [...]}}}
+    {"category": "Problem-solving Interaction", "scenario": "Technical Support", "flow_type": "problem_diagnosis_to_solution"}
+    {"category": "Educational Interaction", "scenarios": ["Math Tutoring", "Art Theory"], "flow_type": "theory_to_scene"}
+
+The optional first line holds the flow definitions; they can also come from a
+separate JSON file. ``ScenarioStream`` reads the catalog lazily on a
+background thread that stays a bounded number of work items ahead of the
+scheduler, so startup time and memory do not grow with the catalog. Records
+are validated as they are read: malformed lines and unknown flow types are
+reported and skipped.
+
+Usage (convert a JSON data file into a catalog):
+    python scenario_loader.py data/dummy_data.json data/catalog.jsonl
+"""
+
+import argparse
+import gzip
+import json
+import queue
+import threading
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, TypeVar, Union
+
+from work_items import WorkItem
+
+T = TypeVar("T")
+
+# Per-problem warnings printed before further ones are only counted
+MAX_WARNINGS = 10
+
+
+def read_ahead(iterable: Iterable[T], size: int) -> Iterator[T]:
+    """
+    Iterate over iterable from a background thread that stays up to size items ahead.
+
+    Exceptions raised while producing items are re-raised to the consumer.
+    Closing the returned generator stops the background thread.
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    buffer: queue.Queue = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for value in iterable:
+                if not put((True, value)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True, name="scenario-read-ahead")
+    thread.start()
+    try:
+        while True:
+            has_value, value = buffer.get()
+            if not has_value:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+class ScenarioStream:
+    """A JSON Lines scenario catalog, read lazily"""
+
+    def __init__(self, path: str, flow_definitions: Optional[Dict] = None, read_ahead: int = 1024):
+        """
+        Open a catalog without reading past its header line.
+
+        flow_definitions, if given, extend (and override) the ones in the header.
+        """
+        self.path = path
+        self.read_ahead = read_ahead
+        self.flow_definitions: Dict = {}
+        self.scenarios = 0
+        self.skipped = 0
+        self._warnings: Dict[str, int] = {}
+        # Category -> flow type, learned as the catalog is read
+        self.flow_types: Dict[str, str] = {}
+        self._scan: Optional[Iterator[Tuple[str, str, str]]] = self._read(lambda *args: None)
+        self._flow_types_lock = threading.Lock()
+
+        with _open_text(path) as f:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        header = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        raise ValueError(f"{path}:{line_number}: header is not valid JSON ({e})") from e
+                    if isinstance(header, dict) and "flow_definitions" in header:
+                        if not isinstance(header["flow_definitions"], dict):
+                            raise ValueError(f"{path}:{line_number}: flow_definitions must be an object")
+                        self.flow_definitions.update(header["flow_definitions"])
+                    break
+        self.flow_definitions.update(flow_definitions or {})
+
+    def _skip(self, problem: str, line_number: int, detail: str):
+        """Count a skipped record, printing the first few of each kind"""
+        self.skipped += 1
+        seen = self._warnings.get(problem, 0) + 1
+        self._warnings[problem] = seen
+        if seen <= MAX_WARNINGS:
+            print(f"⚠ Skipping {self.path}:{line_number}: {detail}")
+        elif seen == MAX_WARNINGS + 1:
+            print(f"⚠ Further '{problem}' records in {self.path} are skipped silently")
+
+    def records(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Yield valid (category, scenario, flow_type) records in file order.
+
+        scenarios and skipped count the current pass and start over with
+        every call, as does the warning budget.
+        """
+        self.scenarios = 0
+        self.skipped = 0
+        self._warnings = {}
+        for record in self._read(self._skip):
+            self.scenarios += 1
+            yield record
+
+    def _read(self, skip: Callable[[str, int, str], None]) -> Iterator[Tuple[str, str, str]]:
+        """Parse the catalog, passing invalid records to skip and learning category flow types"""
+        with _open_text(self.path) as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    skip("unreadable", line_number, f"not valid JSON ({e})")
+                    continue
+                if not isinstance(record, dict):
+                    skip("unreadable", line_number, "not a JSON object")
+                    continue
+                if "flow_definitions" in record:
+                    continue
+
+                category = record.get("category")
+                scenarios = record.get("scenarios", [record.get("scenario")])
+                if not isinstance(category, str) or not category or not isinstance(scenarios, list) \
+                        or not all(isinstance(scenario, str) and scenario for scenario in scenarios):
+                    skip("incomplete", line_number, "needs a category and a scenario (or scenarios)")
+                    continue
+                flow_type = record.get("flow_type", "")
+                if flow_type and flow_type not in self.flow_definitions:
+                    skip(f"flow type {flow_type}", line_number, f"unknown flow_type {flow_type!r}")
+                    continue
+
+                self.flow_types.setdefault(category, flow_type)
+                for scenario in scenarios:
+                    yield category, scenario, flow_type
+
+    def flow_type_of(self, category: str) -> str:
+        """
+        Flow type of a category ("" if the catalog has none).
+
+        Categories are learned from every pass over the catalog; one not seen
+        yet is looked up by reading on from where the last lookup stopped.
+        """
+        with self._flow_types_lock:
+            while category not in self.flow_types and self._scan is not None:
+                if next(self._scan, None) is None:
+                    self._scan = None
+            return self.flow_types.get(category, "")
+
+    def all_flow_types(self) -> Dict[str, str]:
+        """Flow type of every category, reading whatever part of the catalog was not looked up yet"""
+        with self._flow_types_lock:
+            if self._scan is not None:
+                for _ in self._scan:
+                    pass
+                self._scan = None
+            return dict(self.flow_types)
+
+    def _work_items(self, samples_per_scenario: int) -> Iterator[WorkItem]:
+        for category, scenario, flow_type in self.records():
+            for sample_id in range(max(1, samples_per_scenario)):
+                yield WorkItem(category, scenario, flow_type, sample_id)
+
+    def iter_work_items(self, samples_per_scenario: int = 1) -> Iterator[WorkItem]:
+        """Yield samples_per_scenario work items per scenario, read ahead in the background"""
+        return read_ahead(self._work_items(samples_per_scenario), self.read_ahead)
+
+
+def is_catalog_path(path: str) -> bool:
+    """Whether a data path names a JSON Lines scenario catalog"""
+    return path.endswith(".jsonl") or path.endswith(".jsonl.gz")
+
+
+def load_scenarios(path: str, flow_definitions_path: Optional[str] = None,
+                   read_ahead: int = 1024) -> Union[Dict, ScenarioStream]:
+    """
+    Open a data file: a ScenarioStream for JSONL catalogs, else the parsed JSON data.
+
+    flow_definitions_path optionally names a JSON file whose "flow_definitions"
+    a catalog references.
+    """
+    if not is_catalog_path(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    flow_definitions = None
+    if flow_definitions_path:
+        with open(flow_definitions_path, "r", encoding="utf-8") as f:
+            flow_definitions = json.load(f).get("flow_definitions", {})
+    return ScenarioStream(path, flow_definitions, read_ahead=read_ahead)
+
+
+def flow_definitions_of(data: Union[Dict, ScenarioStream]) -> Dict:
+    """The flow definitions of a JSON data dict or a scenario stream"""
+    if isinstance(data, ScenarioStream):
+        return data.flow_definitions
+    return data.get("flow_definitions", {})
+
+
+def category_flow_types(data: Union[Dict, ScenarioStream]) -> Dict[str, str]:
+    """Flow type of each category in a JSON data dict or a scenario stream"""
+    if isinstance(data, ScenarioStream):
+        return data.all_flow_types()
+    return {category: category_data.get("flow_type", "")
+            for category, category_data in data.get("categories", {}).items()}
+
+
+def flow_type_lookup(data: Union[Dict, ScenarioStream]) -> Callable[[str], str]:
+    """Category -> flow type function that reads a scenario stream only as far as needed"""
+    if isinstance(data, ScenarioStream):
+        return data.flow_type_of
+    return category_flow_types(data).get
+
+
+def write_catalog(data: Dict, path: str) -> int:
+    """Write JSON data as a catalog (flow definitions header, one line per scenario)"""
+    opener = gzip.open if path.endswith(".gz") else open
+    count = 0
+    with opener(path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"flow_definitions": data.get("flow_definitions", {})},
+                           ensure_ascii=False) + "\n")
+        for category, category_data in data.get("categories", {}).items():
+            for scenario in category_data.get("scenarios", []):
+                record = {"category": category, "scenario": scenario,
+                          "flow_type": category_data.get("flow_type", "")}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a JSON data file into a JSONL scenario catalog")
+    parser.add_argument("data", help="JSON data file with categories and flow_definitions")
+    parser.add_argument("catalog", help="Catalog to write (.jsonl or .jsonl.gz)")
+    args = parser.parse_args()
+
+    with open(args.data, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    count = write_catalog(data, args.catalog)
+    print(f"✓ Wrote {count} scenarios to {args.catalog}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Quota-driven scheduling of work across categories and flow types.
+
+Batch generation otherwise walks the data file in order, so a run that stops
+early covers only the first categories. ``QuotaScheduler`` buckets pending
+scenario groups by category and hands them out interleaved with smooth
+weighted round-robin (the strategy nginx uses for upstream weights): every
+eligible category gains its weight, the one with the most credit is served
+and pays back the total. Equal weights give plain round-robin; the
+``"weighted"`` strategy uses configured weights or, by default, each
+category's quota, so a partial run keeps the target distribution.
+
+Categories and flow types can have quotas. Only dialogues that were written
+(i.e. passed validation) count towards a quota, and dialogues in flight
+reserve their share, so a quota is never overshot. A category whose quota is
+filled drops out of the rotation and its share goes to the others; capacity
+reserved by dialogues that fail is handed out again.
+"""
+
+import math
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from work_items import WorkItem
+
+STRATEGIES = ("round_robin", "weighted")
+
+
+class QuotaScheduler:
+    """Interleave scenario groups across categories within per-category and per-flow-type quotas"""
+
+    def __init__(self, category_quotas: Optional[Dict[str, int]] = None,
+                 flow_type_quotas: Optional[Dict[str, int]] = None,
+                 default_category_quota: Optional[int] = None,
+                 category_weights: Optional[Dict[str, float]] = None,
+                 strategy: str = "round_robin", window: int = 1024, num_shards: int = 1):
+        """
+        Create a scheduler; feed it groups before iterating over groups().
+
+        window bounds the scenario groups read ahead of the rotation. With
+        num_shards > 1 every quota is split evenly across the shards.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"unknown scheduling strategy {strategy!r} (use one of {', '.join(STRATEGIES)})")
+        shards = max(1, num_shards)
+        self.category_quotas = {name: math.ceil(quota / shards)
+                                for name, quota in (category_quotas or {}).items()}
+        self.flow_type_quotas = {name: math.ceil(quota / shards)
+                                 for name, quota in (flow_type_quotas or {}).items()}
+        self.default_category_quota = (math.ceil(default_category_quota / shards)
+                                       if default_category_quota is not None else None)
+        self.category_weights = category_weights or {}
+        self.strategy = strategy
+        self.window = max(1, window)
+        # Dialogues written (or already in the output) and dialogues in flight
+        self.saved: Dict[str, Dict[str, int]] = {"category": defaultdict(int), "flow_type": defaultdict(int)}
+        self.in_flight: Dict[str, Dict[str, int]] = {"category": defaultdict(int), "flow_type": defaultdict(int)}
+        self._queues: Dict[str, Deque[List[WorkItem]]] = {}
+        self._flow_types: Dict[str, str] = {}
+        self._credit: Dict[str, float] = defaultdict(float)
+        self._buffered = 0
+        self._source: Iterator[List[WorkItem]] = iter(())
+        self._exhausted = True
+        self._lock = threading.Lock()
+
+    @property
+    def has_quotas(self) -> bool:
+        return bool(self.category_quotas or self.flow_type_quotas
+                    or self.default_category_quota is not None)
+
+    def feed(self, groups: Iterable[List[WorkItem]]):
+        """Set the pending scenario groups to schedule"""
+        self._source = iter(groups)
+        self._exhausted = False
+
+    def category_quota(self, category: str) -> Optional[int]:
+        return self.category_quotas.get(category, self.default_category_quota)
+
+    def _remaining(self, category: str, flow_type: str, reserved: bool = True) -> float:
+        """Dialogues a category may still start, counting in-flight ones unless reserved is False"""
+        remaining = math.inf
+        for dimension, name, quota in (("category", category, self.category_quota(category)),
+                                       ("flow_type", flow_type, self.flow_type_quotas.get(flow_type))):
+            if quota is not None:
+                used = self.saved[dimension][name] + (self.in_flight[dimension][name] if reserved else 0)
+                remaining = min(remaining, quota - used)
+        return remaining
+
+    def _weight(self, category: str) -> float:
+        if self.strategy == "round_robin":
+            return 1.0
+        if category in self.category_weights:
+            return self.category_weights[category]
+        quota = self.category_quota(category)
+        return float(quota) if quota else 1.0
+
+    def _read(self) -> bool:
+        """Buffer the next group from the source; False once it is exhausted"""
+        group = None if self._exhausted else next(self._source, None)
+        if group is None:
+            self._exhausted = True
+            return False
+        category = group[0].category
+        self._flow_types.setdefault(category, group[0].flow_type)
+        self._queues.setdefault(category, deque()).append(group)
+        self._buffered += 1
+        return True
+
+    def _eligible(self) -> Tuple[List[str], bool]:
+        """
+        Categories with queued groups and room in their quotas, dropping filled ones.
+
+        Also tells whether some category only waits for dialogues in flight.
+        """
+        eligible, waiting = [], False
+        for category, queue in list(self._queues.items()):
+            if not queue:
+                continue
+            flow_type = self._flow_types[category]
+            if self._remaining(category, flow_type, reserved=False) <= 0:
+                # Filled for good: free the window for other categories
+                self._buffered -= len(queue)
+                queue.clear()
+            elif self._remaining(category, flow_type) > 0:
+                eligible.append(category)
+            else:
+                waiting = True
+        return eligible, waiting
+
+    def _next_group(self) -> Optional[List[WorkItem]]:
+        while self._buffered < self.window and self._read():
+            pass
+        eligible, waiting = self._eligible()
+        # Read past the window rather than stall while every buffered category is
+        # filled; categories waiting for dialogues in flight end the round instead
+        while not eligible and not waiting and self._read():
+            eligible, waiting = self._eligible()
+        if not eligible:
+            return None
+
+        total = 0.0
+        for category in eligible:
+            weight = self._weight(category)
+            self._credit[category] += weight
+            total += weight
+        category = max(eligible, key=lambda name: self._credit[name])
+        self._credit[category] -= total
+
+        queue = self._queues[category]
+        group = queue.popleft()
+        self._buffered -= 1
+        room = self._remaining(category, self._flow_types[category])
+        if room < len(group):
+            # Samples beyond the quota wait for capacity that failures may free
+            queue.appendleft(group[int(room):])
+            self._buffered += 1
+            group = group[:int(room)]
+        for item in group:
+            self.in_flight["category"][item.category] += 1
+            self.in_flight["flow_type"][item.flow_type] += 1
+        return group
+
+    def groups(self) -> Iterator[List[WorkItem]]:
+        """
+        Yield the next scheduled groups until no category has room.
+
+        A round ends while dialogues are still in flight; call pending()
+        once they finished to see whether freed capacity allows another round.
+        """
+        while True:
+            with self._lock:
+                group = self._next_group()
+            if group is None:
+                return
+            yield group
+
+    def pending(self) -> bool:
+        """Whether another round of groups() could schedule work"""
+        with self._lock:
+            eligible, waiting = self._eligible()
+            return bool(eligible) or waiting or not self._exhausted
+
+    def record_done(self, item: WorkItem):
+        """Count a dialogue that an earlier run already wrote"""
+        with self._lock:
+            self.saved["category"][item.category] += 1
+            self.saved["flow_type"][item.flow_type] += 1
+
+    def record_saved(self, item: WorkItem):
+        """Count a scheduled dialogue that was written"""
+        with self._lock:
+            self._release(item)
+            self.saved["category"][item.category] += 1
+            self.saved["flow_type"][item.flow_type] += 1
+
+    def release(self, item: WorkItem):
+        """Return the capacity of a scheduled dialogue that was not written"""
+        with self._lock:
+            self._release(item)
+
+    def _release(self, item: WorkItem):
+        for dimension, name in (("category", item.category), ("flow_type", item.flow_type)):
+            if self.in_flight[dimension][name] > 0:
+                self.in_flight[dimension][name] -= 1
+
+    def summary(self) -> List[str]:
+        """"name saved/quota" for every category and flow type with a quota"""
+        lines = []
+        categories = sorted(set(self.category_quotas) | (set(self._flow_types)
+                                                         if self.default_category_quota is not None else set()))
+        for category in categories:
+            lines.append(f"{category} {self.saved['category'][category]}/{self.category_quota(category)}")
+        for flow_type, quota in sorted(self.flow_type_quotas.items()):
+            lines.append(f"{flow_type} {self.saved['flow_type'][flow_type]}/{quota}")
+        return lines
@@ -0,0 +1,483 @@
+"""
+Resident generation service.
+
+``python main.py serve`` keeps one DialogueGenerator warm (its connection
+pools, rate limits, token budget and response cache), together with the
+compiled prompt templates and the flow definitions of the data file, and
+accepts generation jobs over local HTTP or a Unix socket:
+
+    POST   /v1/jobs        start a job and stream its results as JSON Lines
+    DELETE /v1/jobs/<id>   cancel a job
+    GET    /v1/health      service and job counters, per-stage API metrics
+
+A job names its scenarios either as ``"scenarios"``, a list of catalog
+records (``{"category", "scenario", "flow_type"}``, the flow type defaulting
+to the category's one in the data file), or as ``"categories"`` in the data
+file layout. Options are ``"samples"`` (dialogues per scenario) and
+``"validate"`` (run the VALIDATION_CONFIG validators inline; defaults to
+its ``enabled``).
+
+All jobs share a fixed set of ``max_concurrency`` workers. Workers take the
+next task round-robin across jobs, so a small job is not stuck behind a big
+one, and finish started dialogues before starting new scenarios. Every
+dialogue is streamed back as soon as it is done, as one event per line:
+``job``, then ``dialogue``, ``rejected`` or ``failed`` per work item, then
+``done``. A client that hangs up cancels its job.
+
+The client side (``submit_job``, ``service_health``) only needs the
+standard library, so ``main.py submit`` and ``main.py test --service`` start
+without importing the generator.
+"""
+
+import http.client
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import groupby
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+from work_items import WorkItem, iter_work_items
+
+
+class ServiceError(RuntimeError):
+    """A job the service refused, or a service that cannot be reached"""
+
+
+class Job:
+    """A submitted list of work items and the events it produced"""
+
+    def __init__(self, job_id: str, groups: List[List[WorkItem]], samples: int, validate: bool):
+        self.id = job_id
+        self.samples = samples
+        self.validate = validate
+        self.dialogues = sum(len(group) for group in groups)
+        # Tasks are ("query", group) or ("response", item, queries)
+        self.tasks: Deque[Tuple] = deque(("query", group) for group in groups)
+        self.events: "queue.Queue[Dict]" = queue.Queue()
+        self.counts: Counter = Counter()
+        self.remaining = self.dialogues
+        self.cancelled = False
+        self.started = time.time()
+
+    def iter_events(self) -> Iterator[Dict]:
+        """Yield the job's events until its done event"""
+        while True:
+            event = self.events.get()
+            yield event
+            if event["event"] == "done":
+                return
+
+
+class GenerationService:
+    """Run jobs from many clients on one warm generator and one shared worker pool"""
+
+    def __init__(self, generator, query_prompt_template: str, response_prompt_template: str,
+                 flow_definitions: Dict,
+                 flow_types: Optional[Union[Dict[str, str], Callable[[str], str]]] = None,
+                 max_concurrency: int = 8, max_dialogues_per_job: int = 10000,
+                 validators: Optional[List[str]] = None, validation_settings: Optional[Dict] = None):
+        """
+        Compile the templates and start max_concurrency workers.
+
+        Templates are file paths (recompiled when the file changes) or
+        template sources, as accepted by generator.get_template.
+
+        flow_types maps categories to the flow type used when a job's
+        scenario does not name one: a dict, or a lookup function such as
+        scenario_loader.flow_type_lookup(data), which reads a catalog lazily.
+
+        validators are resolved here, so an unknown name or a
+        "module:function" that cannot be imported raises ValueError at
+        startup rather than in a worker.
+        """
+        self.generator = generator
+        # Compiled up front so a broken template fails at startup, rendered by path later
+        generator.get_template(query_prompt_template)
+        generator.get_template(response_prompt_template)
+        self.query_template = query_prompt_template
+        self.response_template = response_prompt_template
+        self.flow_definitions = flow_definitions
+        self.flow_type_of = flow_types if callable(flow_types) else (flow_types or {}).get
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_dialogues_per_job = max_dialogues_per_job
+        self.validators = tuple(validators or ())
+        from validators import resolve_validator
+        for name in self.validators:
+            try:
+                resolve_validator(name)
+            except (ImportError, AttributeError, ValueError) as e:
+                raise ValueError(f"cannot load validator {name!r}: {e}") from e
+        self.validation_settings = dict(validation_settings or {})
+        self.counts: Counter = Counter()
+        self._jobs: Dict[str, Job] = {}
+        self._ids = itertools.count(1)
+        self._busy = 0
+        self._closed = False
+        self._ready = threading.Condition()
+        self._workers = [threading.Thread(target=self._work, name=f"service-worker-{index}", daemon=True)
+                         for index in range(self.max_concurrency)]
+        for worker in self._workers:
+            worker.start()
+
+    def work_items(self, spec: Dict) -> List[WorkItem]:
+        """The work items a job spec asks for; raises ValueError for malformed specs"""
+        if not isinstance(spec, dict):
+            raise ValueError("job must be a JSON object")
+        samples = spec.get("samples", self.generator.samples_per_scenario)
+        if not isinstance(samples, int) or samples < 1:
+            raise ValueError("samples must be a positive integer")
+        if "categories" in spec:
+            if not isinstance(spec["categories"], dict):
+                raise ValueError("categories must map category names to {flow_type, scenarios}")
+            items = list(iter_work_items({"categories": spec["categories"]}, samples))
+        elif isinstance(spec.get("scenarios"), list):
+            items = []
+            for index, record in enumerate(spec["scenarios"]):
+                if (not isinstance(record, dict) or not isinstance(record.get("category"), str)
+                        or not isinstance(record.get("scenario"), str)):
+                    raise ValueError(f"scenario {index} needs string category and scenario fields")
+                flow_type = record.get("flow_type") or (self.flow_type_of(record["category"]) or "")
+                items.extend(WorkItem(record["category"], record["scenario"], flow_type, sample_id)
+                             for sample_id in range(samples))
+        else:
+            raise ValueError("job needs a scenarios list or a categories object")
+        if not items:
+            raise ValueError("job has no scenarios")
+        if len(items) > self.max_dialogues_per_job:
+            raise ValueError(f"job asks for {len(items)} dialogues, the limit is {self.max_dialogues_per_job}")
+        return items
+
+    def submit(self, spec: Dict) -> Job:
+        """Queue a job; its events start with a job event"""
+        items = self.work_items(spec)
+        samples = spec.get("samples", self.generator.samples_per_scenario)
+        groups = [list(group) for _, group in groupby(items, key=lambda item: (item.category, item.scenario))]
+        validate = bool(self.validators) and bool(spec.get("validate",
+                                                            self.validation_settings.get("enabled", False)))
+        with self._ready:
+            if self._closed:
+                raise ServiceError("service is shutting down")
+            job = Job(f"job-{next(self._ids)}", groups, samples, validate)
+            job.events.put({"event": "job", "id": job.id, "dialogues": job.dialogues})
+            self._jobs[job.id] = job
+            self.counts["jobs"] += 1
+            self._ready.notify_all()
+        print(f"✓ Job {job.id}: {job.dialogues} dialogues from {len(groups)} scenarios")
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """Drop a job's tasks that have not started; False if it is not running"""
+        with self._ready:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return False
+            job.cancelled = True
+            job.tasks.clear()
+            self.counts["cancelled"] += 1
+        job.events.put(self._done_event(job))
+        print(f"⚠ Job {job.id} cancelled")
+        return True
+
+    def stats(self) -> Dict:
+        """Counters for the health endpoint"""
+        with self._ready:
+            stats = {
+                "status": "closing" if self._closed else "ok",
+                "max_concurrency": self.max_concurrency,
+                "busy_workers": self._busy,
+                "active_jobs": len(self._jobs),
+                "queued_tasks": sum(len(job.tasks) for job in self._jobs.values()),
+            }
+            stats.update(self.counts)
+        stats["by_stage"] = self.generator.metrics.snapshot()["by_stage"]
+        budget = self.generator.token_budget
+        if budget.limit is not None:
+            stats["token_budget"] = {"used": budget.used, "limit": budget.limit}
+        return stats
+
+    def close(self):
+        """Cancel every job and stop the workers once their current task ends"""
+        with self._ready:
+            self._closed = True
+            job_ids = list(self._jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+        with self._ready:
+            self._ready.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _next_task(self) -> Optional[Tuple[Job, Tuple]]:
+        with self._ready:
+            while True:
+                if self._closed:
+                    return None
+                for job in list(self._jobs.values()):
+                    if job.tasks:
+                        # Serve jobs in turn: the served job goes to the back
+                        self._jobs[job.id] = self._jobs.pop(job.id)
+                        self._busy += 1
+                        return job, job.tasks.popleft()
+                self._ready.wait()
+
+    def _work(self):
+        while True:
+            next_task = self._next_task()
+            if next_task is None:
+                return
+            job, task = next_task
+            try:
+                if task[0] == "query":
+                    self._run_query(job, task[1])
+                else:
+                    self._run_response(job, task[1], task[2])
+            finally:
+                with self._ready:
+                    self._busy -= 1
+
+    def _run_query(self, job: Job, group: List[WorkItem]):
+        first = group[0]
+        try:
+            query_sets = self.generator.run_query_stage_samples(
+                first.category, first.scenario, first.flow_type, self.query_template,
+                self.flow_definitions, [item.sample_id for item in group]
+            )
+        except Exception as e:
+            for item in group:
+                self._finish(job, item, {"event": "failed", "error": str(e)})
+            return
+        with self._ready:
+            # Responses of started scenarios go first so dialogues finish early
+            for item, queries in reversed(list(zip(group, query_sets))):
+                if queries is not None and not job.cancelled:
+                    job.tasks.appendleft(("response", item, queries))
+            self._ready.notify_all()
+        for item, queries in zip(group, query_sets):
+            if queries is None:
+                self._finish(job, item, {"event": "failed", "error": "query stage produced no usable questions"})
+
+    def _run_response(self, job: Job, item: WorkItem, queries: List[str]):
+        try:
+            dialogue = self.generator.run_response_stage(
+                item.category, item.scenario, queries, self.response_template,
+                # Single-sample jobs keep the original record layout
+                item.sample_id if job.samples > 1 else None,
+                item.sample_id
+            )
+        except Exception as e:
+            self._finish(job, item, {"event": "failed", "error": str(e)})
+            return
+        if job.validate:
+            from validators import validate_record
+            try:
+                reasons = validate_record(dialogue, self.validators, self.validation_settings)
+            except Exception as e:
+                self._finish(job, item, {"event": "failed", "error": f"validation failed: {e}"})
+                return
+            if reasons:
+                self._finish(job, item, {"event": "rejected", "reasons": reasons, "dialogue": dialogue})
+                return
+        self._finish(job, item, {"event": "dialogue", "dialogue": dialogue})
+
+    def _finish(self, job: Job, item: WorkItem, event: Dict):
+        """Stream an item's result and end the job after its last item"""
+        event["key"] = list(item.key)
+        with self._ready:
+            if job.cancelled:
+                return
+            job.counts[event["event"]] += 1
+            self.counts[event["event"]] += 1
+            job.remaining -= 1
+            done = job.remaining <= 0
+            if done:
+                self._jobs.pop(job.id, None)
+        job.events.put(event)
+        if done:
+            job.events.put(self._done_event(job))
+            print(f"✓ Job {job.id} done: {job.counts['dialogue']} dialogues, "
+                  f"{job.counts['rejected']} rejected, {job.counts['failed']} failed")
+
+    def _done_event(self, job: Job) -> Dict:
+        return {
+            "event": "done",
+            "id": job.id,
+            "cancelled": job.cancelled,
+            "dialogues": job.counts["dialogue"],
+            "rejected": job.counts["rejected"],
+            "failed": job.counts["failed"],
+            "seconds": round(time.time() - job.started, 3),
+        }
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP front end of a GenerationService"""
+
+    protocol_version = "HTTP/1.1"
+    service: GenerationService = None
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/health":
+            self._send_json(200, self.service.stats())
+        else:
+            self._send_json(404, {"error": f"no such endpoint: {self.path}"})
+
+    def do_DELETE(self):
+        prefix = "/v1/jobs/"
+        if not self.path.startswith(prefix):
+            self._send_json(404, {"error": f"no such endpoint: {self.path}"})
+        elif self.service.cancel(self.path[len(prefix):]):
+            self._send_json(200, {"cancelled": self.path[len(prefix):]})
+        else:
+            self._send_json(404, {"error": f"no running job {self.path[len(prefix):]}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/jobs":
+            self._send_json(404, {"error": f"no such endpoint: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = self.service.submit(json.loads(self.rfile.read(length) or b"null"))
+        except (ValueError, ServiceError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for event in job.iter_events():
+                line = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up, so nobody is left to receive the job's results
+            self.service.cancel(job.id)
+            self.close_connection = True
+
+    def _send_json(self, status: int, body: Dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ServiceHandler over a Unix socket"""
+
+    daemon_threads = True
+
+
+def start_service(service: GenerationService, host: str = "127.0.0.1", port: int = 0,
+                  socket_path: Optional[str] = None):
+    """
+    Serve a GenerationService in a background thread (port 0 picks a free port).
+
+    With socket_path the service listens on that Unix socket instead; a
+    stale socket file left by a crashed service is replaced.
+    """
+    handler = type("ConfiguredServiceHandler", (ServiceHandler,), {"service": service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise ServiceError(f"a service is already listening on {socket_path}")
+            finally:
+                probe.close()
+        server = UnixServiceServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def service_address(server) -> str:
+    """The address clients pass to submit_job for a started server"""
+    if isinstance(server.server_address, str):
+        return f"unix:{server.server_address}"
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _connect(address: str, timeout: Optional[float]) -> http.client.HTTPConnection:
+    """A connection for "unix:<path>", "http://host:port" or "host:port" """
+    if address.startswith("unix:"):
+        return _UnixHTTPConnection(address[len("unix:"):], timeout=timeout)
+    host = address.split("://", 1)[-1].rstrip("/")
+    return http.client.HTTPConnection(host, timeout=timeout)
+
+
+def _request(address: str, method: str, path: str, body: Optional[Dict] = None,
+             timeout: Optional[float] = None) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+    connection = _connect(address, timeout)
+    try:
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else None
+        connection.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+    except OSError as e:
+        connection.close()
+        raise ServiceError(f"cannot reach the service at {address}: {e}")
+    if response.status != 200:
+        try:
+            message = json.loads(response.read()).get("error", "")
+        except ValueError:
+            message = ""
+        connection.close()
+        raise ServiceError(f"service answered {response.status}: {message}")
+    return connection, response
+
+
+def submit_job(address: str, job: Dict, timeout: Optional[float] = None) -> Iterator[Dict]:
+    """Submit a job spec and yield its events as they are streamed back"""
+    connection, response = _request(address, "POST", "/v1/jobs", job, timeout)
+    try:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        connection.close()
+
+
+def service_health(address: str, timeout: Optional[float] = 5) -> Dict:
+    """The service's health counters"""
+    connection, response = _request(address, "GET", "/v1/health", timeout=timeout)
+    try:
+        return json.loads(response.read())
+    finally:
+        connection.close()
@@ -30,6 +30,12 @@ setup(
     python_requires=">=3.10",
     install_requires=requirements,
     extras_require={
+        "fast": [
+            "numpy>=1.22",
+        ],
+        "arrow": [
+            "pyarrow>=12.0",
+        ],
         "dev": [
             "pytest>=6.0",
             "black>=21.0",
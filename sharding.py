@@ -0,0 +1,141 @@
+"""
+Deterministic sharding of batch runs across independent workers.
+
+Each work item is assigned to a shard by hashing its category, scenario and
+sample index, so any number of processes or machines can each run one shard
+with no coordination and write their own output shard. ``merge_shards``
+merges the shard streams in data-file order, drops duplicates and reports
+dialogues that are missing from every shard.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Tuple
+
+from output_writer import DialogueWriter
+from work_items import WorkItem, iter_work_items
+
+
+def shard_of(item: WorkItem, num_shards: int) -> int:
+    """Shard index of a work item; stable across processes, runs and machines"""
+    key = f"{item.category}\x1f{item.scenario}\x1f{item.sample_id}".encode("utf-8")
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], "big") % num_shards
+
+
+def validate_shard(shard_index: int, num_shards: int):
+    """Raise ValueError for an impossible shard selection"""
+    if num_shards < 1:
+        raise ValueError(f"num_shards must be at least 1, got {num_shards}")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index must be in [0, {num_shards}), got {shard_index}")
+
+
+def select_shard(items: Iterable[WorkItem], shard_index: int,
+                 num_shards: int) -> Iterator[WorkItem]:
+    """Yield the work items owned by one shard"""
+    validate_shard(shard_index, num_shards)
+    for item in items:
+        if num_shards == 1 or shard_of(item, num_shards) == shard_index:
+            yield item
+
+
+def shard_output_path(output_file: str, shard_index: int, num_shards: int) -> str:
+    """Output file of one shard, e.g. out.json -> out.shard-01-of-04.json"""
+    if num_shards == 1:
+        return output_file
+    width = len(str(num_shards - 1))
+    root, ext = os.path.splitext(output_file)
+    if ext == ".gz":
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return f"{root}.shard-{shard_index:0{width}d}-of-{num_shards:0{width}d}{ext}"
+
+
+def _record_key(record: Dict) -> Tuple[str, int]:
+    """("category - scenario" label, sample_id) of an output record"""
+    return record.get("category", ""), record.get("sample_id", 0)
+
+
+def _index_shard(path: str, shard: int, index: Dict[Tuple[str, int], List[Tuple[int, int]]]) -> BinaryIO:
+    """
+    Add the byte offset of every record in a shard to index, keyed by _record_key.
+
+    Returns a seekable binary file holding the records: the shard itself,
+    or for a gzip shard a temporary file with the decompressed lines, since
+    seeking in a gzip stream means decompressing it again from the start.
+    """
+    if not path.endswith(".gz"):
+        source = target = open(path, "rb")
+    else:
+        source, target = gzip.open(path, "rb"), tempfile.TemporaryFile()
+    line_number = 0
+    try:
+        while True:
+            offset = target.tell()
+            line = source.readline()
+            if not line:
+                break
+            line_number += 1
+            if source is not target:
+                target.write(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-write can leave a partial last line behind
+                print(f"Skipping unreadable record at {path}:{line_number}")
+                continue
+            index.setdefault(_record_key(record), []).append((shard, offset))
+    except EOFError:
+        # Truncated gzip member, again from a crash mid-write
+        print(f"Stream {path} ends with a truncated record after line {line_number}")
+    finally:
+        if source is not target:
+            source.close()
+    return target
+
+
+def merge_shards(shard_paths: List[str], data: Dict, output_stream: str,
+                 samples_per_scenario: int = 1, fsync_interval: int = 50,
+                 ensure_ascii: bool = False) -> Tuple[int, int, List[str]]:
+    """
+    Merge shard streams into one stream in data-file order.
+
+    The shards are indexed in one pass, keeping only the offset of each
+    record, and the records are then read back by seeking in data-file
+    order, so memory holds no records however large the shards are.
+    Records that are not part of ``data`` or occur more often than the data
+    file asks for are dropped as duplicates. Returns the number of records
+    written, the number of duplicates dropped and the labels of dialogues
+    missing from every shard.
+    """
+    index: Dict[Tuple[str, int], List[Tuple[int, int]]] = {}
+    files: List[BinaryIO] = []
+    missing: List[str] = []
+    try:
+        for shard, path in enumerate(shard_paths):
+            files.append(_index_shard(path, shard, index))
+
+        with DialogueWriter(output_stream, fsync_interval=fsync_interval,
+                            ensure_ascii=ensure_ascii) as writer:
+            for item in iter_work_items(data, samples_per_scenario):
+                offsets = index.get((item.context, item.sample_id))
+                if offsets:
+                    shard, offset = offsets.pop(0)
+                    files[shard].seek(offset)
+                    writer.write(json.loads(files[shard].readline()))
+                else:
+                    label = item.context
+                    if samples_per_scenario > 1:
+                        label += f" (sample {item.sample_id})"
+                    missing.append(label)
+    finally:
+        for f in files:
+            f.close()
+    # Whatever the data file did not ask for is a duplicate
+    duplicates = sum(len(offsets) for offsets in index.values())
+    return writer.count, duplicates, missing
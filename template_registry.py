@@ -0,0 +1,88 @@
+"""
+Shared registry of compiled Jinja2 prompt templates.
+
+Templates are parsed and compiled once into a shared ``jinja2.Environment``
+instead of once per rendered prompt. File templates are cached by path,
+backed by a bytecode cache, and recompiled automatically when the file's mtime
+changes; template sources passed as strings are cached by their text.
+"""
+
+import os
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, Template, TemplateNotFound
+from jinja2.bccache import Bucket
+
+
+class _PathLoader(BaseLoader):
+    """Load templates by (relative or absolute) file path"""
+
+    def get_source(self, environment: Environment,
+                   template: str) -> Tuple[str, str, Callable[[], bool]]:
+        path = os.path.abspath(template)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, "r", encoding="utf-8") as f:
+                source = f.read()
+        except OSError:
+            raise TemplateNotFound(template)
+
+        def uptodate() -> bool:
+            try:
+                return os.path.getmtime(path) == mtime
+            except OSError:
+                return False
+
+        return source, path, uptodate
+
+
+class _LazyBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache that creates its directory on the first write"""
+
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+
+class TemplateRegistry:
+    """Compile-once cache of prompt templates"""
+
+    def __init__(self, bytecode_cache_dir: Optional[str] = None):
+        """
+        Create the shared environment, optionally with an on-disk bytecode cache.
+
+        The cache directory is only created once a file template is compiled.
+        """
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            bytecode_cache = _LazyBytecodeCache(bytecode_cache_dir)
+        # Same defaults as jinja2.Template(source), so prompts render identically
+        self.env = Environment(
+            loader=_PathLoader(),
+            bytecode_cache=bytecode_cache,
+            auto_reload=True,
+        )
+        self._from_string: Dict[str, Template] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Template:
+        """Compiled template for a file, recompiled if the file changed on disk"""
+        return self.env.get_template(path)
+
+    def from_string(self, source: str) -> Template:
+        """Compiled template for a template source string"""
+        template = self._from_string.get(source)
+        if template is None:
+            with self._lock:
+                template = self._from_string.get(source)
+                if template is None:
+                    template = self.env.from_string(source)
+                    self._from_string[source] = template
+        return template
+
+    def clear(self):
+        """Drop all compiled templates"""
+        with self._lock:
+            self._from_string.clear()
+        self.env.cache.clear()
@@ -10,10 +10,49 @@ License: MIT
 Version: 1.0.0
 """
 
+import email.utils
+import gzip
 import json
 import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from typing import Optional
+from openai import APIConnectionError, APIStatusError
+from batch_io import (
+    dialogue_id, export_query_batch, ingest_query_results, merge_batch_results, split_custom_id
+)
+from checkpoint import checkpoint_path_for
+from columnar import ColumnarWriter, read_columnar
+from dedup import MinHashIndex
 from dialogue_generator import DialogueGenerator
-from config import API_CONFIG, FILE_PATHS, GENERATION_CONFIG
+from endpoints import EndpointPool
+from extraction import ExtractionError, extract_json, turns_from
+from json_stream import COMPLETE, MALFORMED, JSONPrefixValidator
+from metrics import MetricsRecorder
+from mock_server import MockServerConfig, start_mock_server
+from output_writer import DialogueWriter, finalize_to_json, read_records
+from pipeline import LatencySample, TwoStagePipeline
+from planner import get_tokenizer, plan_run
+from prefix_order import order_by_prefix, shared_prefix_ratio
+from rate_control import (
+    FATAL, OVERLOADED, RETRYABLE, AdaptiveConcurrency, BudgetExceeded, TokenBucket, TokenBudget,
+    classify_error, retry_after_seconds
+)
+from records import compact_record, expand_record
+from response_cache import RESYNC_INTERVAL, ResponseCache
+from scenario_loader import ScenarioStream, category_flow_types, write_catalog
+from scheduler import QuotaScheduler
+from service import GenerationService, service_address, start_service, submit_job
+from sharding import merge_shards, select_shard, shard_of
+from template_registry import TemplateRegistry
+from validators import ValidationPool
+from work_items import WorkItem, iter_work_items
+from config import API_CONFIG, FILE_PATHS, GENERATION_CONFIG, OUTPUT_CONFIG
 
 
 def test_config_loading():
@@ -31,6 +70,47 @@ def test_config_loading():
         return False
 
 
+LEGACY_CONFIG = """
+API_CONFIG = {"base_url": "http://localhost:7813/v1", "api_key": "sk-xxx", "model": "Qwen-2.5-72B-Instruct"}
+FILE_PATHS = {
+    "data": "data/dummy_data.json",
+    "query_prompt": "prompt/query_template_en.txt",
+    "response_prompt": "prompt/response_template_en.txt",
+    "output_file": "generated_dialogues.json",
+    "test_output": "test_dialogue.json"
+}
+GENERATION_CONFIG = {"max_tokens_query": 800, "max_tokens_response": 1200, "temperature_query": 0.8,
+                     "temperature_response": 0.7, "max_retries": 3, "retry_delay": 1}
+OUTPUT_CONFIG = {"ensure_ascii": False, "indent": 2}
+"""
+
+
+def test_legacy_config():
+    """Test that a config.py written for the original release still loads"""
+    print("\n=== Testing Legacy Config ===")
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "config.py"), "w", encoding="utf-8") as f:
+                f.write(LEGACY_CONFIG)
+            script = ("import sys; sys.path.insert(0, sys.argv[1]); import batch_run, main; "
+                      "generator = main.create_generator(); print(generator.cache is None); "
+                      "generator.endpoints.close()")
+            result = subprocess.run([sys.executable, "-c", script, tmp_dir],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True)
+        if result.returncode != 0 or result.stdout.strip() != "True":
+            print(f"❌ Legacy config failed to load: {result.stderr.strip()[-500:] or result.stdout}")
+            return False
+        
+        print("✓ A config.py without the newer sections loads, with the response cache off")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Legacy config test failed: {e}")
+        return False
+
+
 def test_data_structure():
     """Test simplified data structure"""
     print("\n=== Testing Simplified Data Structure ===")
@@ -81,6 +161,61 @@ def test_data_structure():
         return False
 
 
+def test_generation_service():
+    """Test jobs streamed from the resident generation service"""
+    print("\n=== Testing Generation Service ===")
+    
+    try:
+        server = start_mock_server(config=MockServerConfig(latency=0.01, seed=4))
+        generator = DialogueGenerator(base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                                      api_key="sk-mock", model="mock")
+        generator.cache = None
+        data = generator.load_data(FILE_PATHS["data"])
+        service = GenerationService(
+            generator,
+            FILE_PATHS["query_prompt"],
+            FILE_PATHS["response_prompt"],
+            data["flow_definitions"],
+            max_concurrency=2
+        )
+        service_server = start_service(service)
+        try:
+            job = {"scenarios": [{"category": "Health Consultation", "scenario": "Diet"},
+                                 {"category": "Emotional Support", "scenario": "Stress Relief"}],
+                   "samples": 2}
+            events = list(submit_job(service_address(service_server), job))
+            # A validator that raises fails its dialogues instead of the worker
+            service.validators = ("json:loads",)
+            validated_events = list(submit_job(service_address(service_server), dict(job, validate=True)))
+        finally:
+            service_server.shutdown()
+            service_server.server_close()
+            service.close()
+            server.shutdown()
+        
+        dialogues = [event["dialogue"] for event in events if event["event"] == "dialogue"]
+        if events[0]["event"] != "job" or events[-1]["event"] != "done" or len(dialogues) != 4:
+            print(f"❌ Unexpected job events: {[event['event'] for event in events]}")
+            return False
+        if [event["event"] for event in validated_events] != ["job"] + ["failed"] * 4 + ["done"]:
+            print(f"❌ Unexpected events with a raising validator: {[e['event'] for e in validated_events]}")
+            return False
+        try:
+            GenerationService(generator, FILE_PATHS["query_prompt"], FILE_PATHS["response_prompt"],
+                              data["flow_definitions"], validators=["no_such_module:check"])
+            print("❌ An unloadable validator was accepted")
+            return False
+        except ValueError:
+            pass
+        
+        print(f"✓ Service streamed {len(dialogues)} dialogues in {events[-1]['seconds']:.2f}s")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Generation service test failed: {e}")
+        return False
+
+
 def test_dialogue_generator():
     """Test simplified dialogue generator"""
     print("\n=== Testing Simplified Dialogue Generator ===")
@@ -90,7 +225,8 @@ def test_dialogue_generator():
         generator = DialogueGenerator(
             base_url=API_CONFIG["base_url"],
             api_key=API_CONFIG["api_key"],
-            model=API_CONFIG["model"]
+            model=API_CONFIG["model"],
+            endpoints=API_CONFIG.get("endpoints")
         )
         print("✓ Successfully initialized dialogue generator")
         
@@ -139,13 +275,1418 @@ def test_dialogue_generator():
         return False
 
 
+def test_response_cache():
+    """Test on-disk response cache hits, misses and eviction"""
+    print("\n=== Testing Response Cache ===")
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = ResponseCache(os.path.join(tmp_dir, "cache.sqlite"), max_size_mb=0.01)
+            messages = [{"role": "user", "content": "hello"}]
+            key = ResponseCache.make_key("model", messages, max_tokens=10, temperature=0.7)
+            other = ResponseCache.make_key("model", messages, max_tokens=10, temperature=0.8)
+            
+            if key == other:
+                print("❌ Sampling parameters do not change the cache key")
+                return False
+            if cache.get(key) is not None:
+                print("❌ Empty cache returned a value")
+                return False
+            
+            cache.put(key, '{"turns": []}')
+            if cache.get(key) != '{"turns": []}':
+                print("❌ Cached value was not returned")
+                return False
+            
+            for i in range(200):
+                cache.put(str(i), "x" * 200)
+            stats = cache.stats()
+            if stats["size_bytes"] > cache.max_size_bytes or stats["evictions"] == 0:
+                print(f"❌ Cache was not kept under its size limit: {stats}")
+                return False
+            
+            cache.close()
+            
+            # Two writers on one file each see the other's entries when they resync
+            path = os.path.join(tmp_dir, "shared.sqlite")
+            writers = [ResponseCache(path, max_size_mb=0.01) for _ in range(2)]
+            largest = 0
+            for i in range(200):
+                writers[i % 2].put(f"shared-{i:03d}", "y" * 200)
+                largest = max(largest, writers[0].stats()["size_bytes"])
+            slack = RESYNC_INTERVAL * (len("shared-000") + 200)
+            if largest > writers[0].max_size_bytes + slack:
+                print(f"❌ Two writers grew the cache to {largest} bytes, past its size limit")
+                return False
+            for writer in writers:
+                writer.close()
+        
+        print(f"✓ Cache hits, misses and eviction work: {stats}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Response cache test failed: {e}")
+        return False
+
+
+def test_extraction():
+    """Test structured-output extraction from untidy completions"""
+    print("\n=== Testing Structured-Output Extraction ===")
+    
+    try:
+        recoverable = [
+            '{"turns": ["a", "b"]}',
+            'Let me think about {this}.\n```json\n{"turns": ["a", "b"]}\n```\nHope it helps!',
+            '{"turns": ["a", "b",],}',
+            "{'turns': ['a', 'b']}",
+            '{“turns”: [“a”, “b”]}',
+            '{"draft": true}\n{"turns": ["a", "b"]}',
+        ]
+        for text in recoverable:
+            if turns_from(extract_json(text), expected=2) != ["a", "b"]:
+                print(f"❌ Wrong turns extracted from {text!r}")
+                return False
+        
+        unusable = ['{"turns": ["a", "b"', "No JSON here", '{"turns": []}', '{"turns": ["a"]}']
+        for text in unusable:
+            try:
+                turns_from(extract_json(text), expected=2)
+            except ExtractionError:
+                continue
+            print(f"❌ Unusable completion was accepted: {text!r}")
+            return False
+        
+        print(f"✓ Extracted {len(recoverable)} untidy completions, rejected {len(unusable)} unusable ones")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Extraction test failed: {e}")
+        return False
+
+
+def test_dedup_index():
+    """Test near-duplicate detection of query lists"""
+    print("\n=== Testing Near-Duplicate Index ===")
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "index.dedup.jsonl")
+            queries = ["How do I fix my router when the connection keeps dropping?",
+                       "Which settings should I check first?"]
+            near = ["How do I fix my router when the connection keeps dropping?",
+                    "Which settings should I check first, then?"]
+            other = ["Can you plan a weekly strength workout?", "How much cardio should I add?"]
+            
+            with MinHashIndex(threshold=0.8, path=path) as index:
+                if (index.add(("a", "x", 0), queries) is not None
+                        or index.add(("b", "y", 0), other) is not None):
+                    print("❌ Distinct query lists were reported as duplicates")
+                    return False
+                match = index.add(("c", "z", 0), near)
+                if match is None or match[0] != ("a", "x", 0):
+                    print(f"❌ Near-duplicate was not detected: {match}")
+                    return False
+            
+            with MinHashIndex(threshold=0.8, path=path, resume=True) as index:
+                if len(index) != 2 or index.query(near) is None:
+                    print("❌ Persisted index was not reloaded")
+                    return False
+        
+        print(f"✓ Near-duplicate detected with similarity {match[1]:.2f}, index reloaded")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Dedup index test failed: {e}")
+        return False
+
+
+def test_validators():
+    """Test the built-in dialogue validators"""
+    print("\n=== Testing Dialogue Validators ===")
+    
+    try:
+        queries = [f"Question {i}" for i in range(6)]
+        responses = [f"Answer {i}." for i in range(6)]
+        good = {"category": "a - b", "queries": queries, "responses": responses,
+                "turns": [{"human": q, "assistant": r} for q, r in zip(queries, responses)]}
+        bad = dict(good, responses=responses[:5] + ["Would you like more tips?"])
+        short = dict(good, queries=queries[:5], turns=good["turns"][:5])
+        
+        with ValidationPool(["alignment", "placeholders", "turn_count", "follow_up_questions"],
+                            {"min_turns": 6, "max_turns": 8}) as pool:
+            results = [reasons for _, reasons in pool.map([good, bad, short])]
+        if results[0] or not any(r.startswith("follow_up_questions") for r in results[1]):
+            print(f"❌ Unexpected validation results: {results}")
+            return False
+        if not any(r.startswith("alignment") for r in results[2]) \
+                or not any(r.startswith("turn_count") for r in results[2]):
+            print(f"❌ Short dialogue was not rejected: {results[2]}")
+            return False
+        
+        # A failed submit gives its slot back, and callback errors reach on_error
+        errors = []
+        
+        def broken_submit(*args):
+            raise RuntimeError("pool is broken")
+        
+        def broken_callback(reasons):
+            raise OSError("disk full")
+        
+        with ValidationPool(["turn_count"], {"min_turns": 6, "max_turns": 8},
+                            workers=1, max_pending=1) as failing_pool:
+            executor = failing_pool._executor
+            failing_pool._executor = SimpleNamespace(submit=broken_submit)
+            try:
+                failing_pool.submit(good, lambda reasons: None)
+                print("❌ A failed submit did not raise")
+                return False
+            except RuntimeError:
+                pass
+            failing_pool._executor = executor
+            failing_pool.submit(good, broken_callback, errors.append)
+            failing_pool.drain()
+        if [str(error) for error in errors] != ["disk full"]:
+            print(f"❌ Callback errors were not passed to on_error: {errors}")
+            return False
+        
+        print(f"✓ Validators passed {pool.passed} and rejected {pool.rejected} dialogues")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Validator test failed: {e}")
+        return False
+
+
+def test_scenario_stream():
+    """Test per-pass counters and lazy flow type lookups of a streamed scenario catalog"""
+    print("\n=== Testing Scenario Stream ===")
+    
+    try:
+        with open(FILE_PATHS["data"], "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalog = os.path.join(tmp_dir, "catalog.jsonl")
+            total = write_catalog(data, catalog)
+            with open(catalog, "a", encoding="utf-8") as f:
+                f.write("not json\n")
+            stream = ScenarioStream(catalog)
+            
+            second, last = list(data["categories"])[1], list(data["categories"])[-1]
+            lookup = stream.flow_type_of(second)
+            learned = len(stream.flow_types)
+            passes = []
+            for _ in range(2):
+                count = sum(1 for _ in stream.records())
+                passes.append((count, stream.scenarios, stream.skipped))
+            flow_types = category_flow_types(stream)
+            
+            header_errors = []
+            for header in ("\n{not json\n", '{"flow_definitions": null}\n'):
+                broken = os.path.join(tmp_dir, "broken.jsonl")
+                with open(broken, "w", encoding="utf-8") as f:
+                    f.write(header)
+                try:
+                    ScenarioStream(broken)
+                except ValueError as e:
+                    header_errors.append(str(e))
+        
+        if len(header_errors) != 2 or not all(error.startswith(f"{broken}:") for error in header_errors) \
+                or not header_errors[0].startswith(f"{broken}:2:"):
+            print(f"❌ Malformed catalog headers did not raise ValueError with their line: {header_errors}")
+            return False
+        if lookup != data["categories"][second]["flow_type"] or learned != 2:
+            print(f"❌ Looking up {second!r} read {learned} categories instead of stopping after it")
+            return False
+        if passes != [(total, total, 1)] * 2:
+            print(f"❌ Counters accumulated across passes: {passes}")
+            return False
+        if flow_types != category_flow_types(data) or stream.flow_type_of(last) != data["categories"][last]["flow_type"]:
+            print("❌ Catalog flow types do not match the data file")
+            return False
+        
+        print(f"✓ {total} scenarios per pass, 1 skipped each time; first lookup read {learned} categories")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Scenario stream test failed: {e}")
+        return False
+
+
+def test_sharding():
+    """Test shard assignment and merging shard streams"""
+    print("\n=== Testing Sharding ===")
+    
+    try:
+        with open(FILE_PATHS["data"], "r", encoding="utf-8") as f:
+            data = json.load(f)
+        items = list(iter_work_items(data, 2))
+        for num_shards in (1, 3, 8):
+            shards = [list(select_shard(items, index, num_shards)) for index in range(num_shards)]
+            owned = [item for shard in shards for item in shard]
+            if len(owned) != len(items) or set(owned) != set(items):
+                print(f"❌ {num_shards} shards do not partition the work items")
+                return False
+            if any(shard_of(item, num_shards) != index for index, shard in enumerate(shards) for item in shard):
+                print(f"❌ Shard assignment is not stable across calls for {num_shards} shards")
+                return False
+        
+        def record(item: WorkItem) -> dict:
+            return {"category": item.context, "queries": [item.scenario], "responses": ["ok"],
+                    "sample_id": item.sample_id}
+        
+        num_shards = 3
+        lost = items[5]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, f"shard-{index}.jsonl") for index in range(num_shards)]
+            paths[-1] += ".gz"
+            for index, path in enumerate(paths):
+                lines = [json.dumps(record(item)) for item in select_shard(items, index, num_shards)
+                         if item != lost]
+                if index == 0:
+                    # A dialogue written twice and one the data file does not ask for
+                    lines += [json.dumps(record(items[0])), json.dumps(record(WorkItem("Other", "x", "", 0)))]
+                text = "\n".join(reversed(lines)) + "\n" + lines[0][:20]
+                with (gzip.open(path, "wt", encoding="utf-8") if path.endswith(".gz")
+                      else open(path, "w", encoding="utf-8")) as f:
+                    f.write(text)
+            output_stream = os.path.join(tmp_dir, "merged.jsonl")
+            count, duplicates, missing = merge_shards(paths, data, output_stream, samples_per_scenario=2)
+            merged = list(read_records(output_stream))
+        
+        expected = [record(item) for item in items if item != lost]
+        if merged != expected or count != len(expected):
+            print(f"❌ Merged {count} records, not the {len(expected)} expected in data-file order")
+            return False
+        if duplicates != 2 or missing != [f"{lost.context} (sample {lost.sample_id})"]:
+            print(f"❌ Expected 2 duplicates and {lost.context} missing, got {duplicates} and {missing}")
+            return False
+        
+        print(f"✓ Shards partition {len(items)} work items; merged {count} dialogues, "
+              f"dropped {duplicates} duplicates, reported {len(missing)} missing")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Sharding test failed: {e}")
+        return False
+
+
+def test_columnar_export():
+    """Test compact records and the built-in columnar format round trip"""
+    print("\n=== Testing Columnar Export ===")
+    
+    try:
+        records = [
+            {"category": "Health Consultation - Diet", "queries": ["Is rice healthy?", "How much?"],
+             "responses": ["In moderation, yes.", "About a cup a day."]},
+            {"category": "Educational Interaction - Math Tutoring", "queries": ["What is π?"],
+             "responses": ["The ratio of a circle's circumference to its diameter."], "sample_id": 2},
+        ]
+        records = [expand_record(record) for record in records]
+        flow_types = {"Health Consultation": "user_needs_to_solution", "Educational Interaction": ""}
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_dir = os.path.join(tmp_dir, "export")
+            with ColumnarWriter(export_dir, format="fallback", flow_types=flow_types) as writer:
+                for record in records:
+                    writer.write(record)
+            restored = list(read_columnar(export_dir))
+            health = list(read_columnar(export_dir, category="Health Consultation"))
+        
+        expected = [compact_record(record) for record in records]
+        if sorted(restored, key=lambda r: r["category"]) != sorted(expected, key=lambda r: r["category"]):
+            print(f"❌ Columnar round trip changed the records: {restored}")
+            return False
+        if len(health) != 1 or expand_record(health[0]) != records[0]:
+            print(f"❌ Partition filter returned {health}")
+            return False
+        
+        print(f"✓ {len(restored)} compact records round-tripped through {len(writer.files)} partitions")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Columnar export test failed: {e}")
+        return False
+
+
+def test_template_registry():
+    """Test that file templates are compiled through the registry and reloaded on change"""
+    print("\n=== Testing Template Registry ===")
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bytecode_dir = os.path.join(tmp_dir, "jinja2")
+            template_path = os.path.join(tmp_dir, "query.txt")
+            with open(template_path, "w", encoding="utf-8") as f:
+                f.write("Context: {{ context }}\n")
+            
+            generator = DialogueGenerator(base_url="http://127.0.0.1:1/v1", api_key="sk-mock",
+                                          model="mock", offline=True)
+            generator.templates = TemplateRegistry(bytecode_dir)
+            if os.path.exists(bytecode_dir):
+                print("❌ Bytecode cache directory created before any template was compiled")
+                return False
+            
+            first = generator.render_query_prompt("A", "B", template_path)
+            same = generator.get_template(template_path) is generator.templates.get(template_path)
+            source = generator.get_template(generator.load_prompt_template(template_path))
+            distinct = source is not generator.templates.get(template_path)
+            with open(template_path, "w", encoding="utf-8") as f:
+                f.write("Scenario: {{ context }}\n")
+            os.utime(template_path, (time.time() + 5, time.time() + 5))
+            second = generator.render_query_prompt("A", "B", template_path)
+            cached = os.listdir(bytecode_dir)
+        
+        if not same or not distinct:
+            print("❌ Template paths and sources are not told apart")
+            return False
+        if first != "Context: A - B" or second != "Scenario: A - B" or not cached:
+            print(f"❌ Unexpected renders {first!r}, {second!r} or empty bytecode cache {cached}")
+            return False
+        
+        print(f"✓ File template reloaded after an edit ({len(cached)} bytecode cache files)")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Template registry test failed: {e}")
+        return False
+
+
+def test_batch_io_round_trip():
+    """Test exporting, ingesting and merging offline batch files for both stages"""
+    print("\n=== Testing Batch I/O Round Trip ===")
+    
+    try:
+        generator = DialogueGenerator(base_url="http://127.0.0.1:1/v1", api_key="sk-mock",
+                                      model="mock", offline=True)
+        generator.samples_per_scenario = 2
+        data = generator.load_data(FILE_PATHS["data"])
+        category_name, category_data = next(iter(data["categories"].items()))
+        data["categories"] = {category_name: category_data}
+        items = {dialogue_id(item): item for item in iter_work_items(data, 2)}
+        
+        def result_line(request_id: str, turns: list) -> dict:
+            content = json.dumps({"turns": turns}, ensure_ascii=False)
+            return {"custom_id": request_id, "error": None,
+                    "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}}}
+        
+        def write_results(path: str, lines: list):
+            with open(path, "w", encoding="utf-8") as f:
+                for line in lines:
+                    f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        
+        previous_finalize = OUTPUT_CONFIG.get("finalize_json", True)
+        OUTPUT_CONFIG["finalize_json"] = False
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                paths = {name: os.path.join(tmp_dir, f"{name}.jsonl")
+                         for name in ("query_requests", "query_results", "response_requests",
+                                      "response_results", "dialogues")}
+                exported = export_query_batch(generator, data, FILE_PATHS["query_prompt"],
+                                              paths["query_requests"])
+                query_requests = list(read_records(paths["query_requests"]))
+                
+                # Every request succeeds except the first one, in reverse order
+                queries = {}
+                query_results = [{"custom_id": query_requests[0]["custom_id"], "response": None,
+                                  "error": {"code": "server_error", "message": "failed"}}]
+                for request in reversed(query_requests[1:]):
+                    key = split_custom_id(request["custom_id"])[1]
+                    queries[key] = [f"Question {turn} of {key}" for turn in range(3)]
+                    query_results.append(result_line(request["custom_id"], queries[key]))
+                write_results(paths["query_results"], query_results)
+                
+                ingested, query_failures = ingest_query_results(
+                    generator, data, FILE_PATHS["response_prompt"], paths["query_results"],
+                    paths["response_requests"])
+                response_requests = list(read_records(paths["response_requests"]))
+                responses = {}
+                response_results = []
+                for request in response_requests:
+                    key = split_custom_id(request["custom_id"])[1]
+                    responses[key] = [f"Answer {turn} of {key}" for turn in range(3)]
+                    response_results.append(result_line(request["custom_id"], responses[key]))
+                write_results(paths["response_results"], response_results)
+                
+                merged, failures = merge_batch_results(generator, data, paths["query_results"],
+                                                       paths["response_results"], paths["dialogues"])
+                dialogues = list(read_records(paths["dialogues"]))
+        finally:
+            OUTPUT_CONFIG["finalize_json"] = previous_finalize
+        
+        ids = [request["custom_id"] for request in query_requests]
+        prompts = {}
+        for request in query_requests:
+            key = split_custom_id(request["custom_id"])[1]
+            prompts.setdefault(key.rsplit(":", 1)[0], set()).add(request["body"]["messages"][0]["content"])
+        if (exported != len(items) or len(set(ids)) != len(ids)
+                or any(not re.fullmatch(r"query:[0-9a-f]{16}:[01]", request_id) for request_id in ids)):
+            print(f"❌ Expected {len(items)} query requests with unique <stage>:<sha1>:<sample> ids, got {ids[:3]}")
+            return False
+        if any(len(texts) != 1 for texts in prompts.values()) or len(prompts) != len(items) // 2:
+            print("❌ Samples of a scenario were not exported as separate requests with the same prompt")
+            return False
+        if ingested != len(items) - 1 or len(query_failures) != 1:
+            print(f"❌ Ingest wrote {ingested} response requests with failures {query_failures}")
+            return False
+        
+        expected = sorted((json.dumps(generator.build_dialogue(item.category, item.scenario, queries[key],
+                                                               responses[key], item.sample_id),
+                                      sort_keys=True)
+                           for key, item in items.items() if key in responses))
+        if merged != len(items) - 1 or sorted(json.dumps(d, sort_keys=True) for d in dialogues) != expected:
+            print(f"❌ Merged {merged} dialogues that do not match build_dialogue (failures: {failures})")
+            return False
+        
+        print(f"✓ Round trip of {exported} requests merged {merged} dialogues, 1 failure reported")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Batch I/O round trip test failed: {e}")
+        return False
+
+
+def test_quota_scheduler():
+    """Test category interleaving and quota accounting of the scheduler"""
+    print("\n=== Testing Quota Scheduler ===")
+    
+    try:
+        groups = [[WorkItem(category, f"scenario {index}", "flow")]
+                  for category in ("A", "B", "C") for index in range(4)]
+        scheduler = QuotaScheduler(category_quotas={"A": 2}, flow_type_quotas={"flow": 6})
+        scheduler.feed(groups)
+        scheduled = scheduler.groups()
+        first = [next(scheduled)[0] for _ in range(3)]
+        if [item.category for item in first] != ["A", "B", "C"]:
+            print(f"❌ Categories were not interleaved: {[item.category for item in first]}")
+            return False
+        
+        # A failed dialogue frees its share of the quota, a written one keeps it
+        scheduler.release(first[0])
+        scheduler.record_saved(first[1])
+        rest = [group[0] for group in scheduled]
+        for item in first[2:] + rest:
+            scheduler.record_saved(item)
+        counts = dict(scheduler.saved["category"])
+        if counts != {"A": 2, "B": 2, "C": 2} or scheduler.pending():
+            print(f"❌ Quotas were not kept: {counts}")
+            return False
+        
+        print(f"✓ Interleaved categories and filled quotas: {', '.join(scheduler.summary())}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Quota scheduler test failed: {e}")
+        return False
+
+
+def test_rate_control():
+    """Test error classification, Retry-After parsing, token bucket refill and AIMD concurrency"""
+    print("\n=== Testing Rate Control ===")
+    
+    try:
+        # Stand-ins for the HTTP request/response objects the errors wrap
+        request = SimpleNamespace(method="POST", url="http://127.0.0.1/v1/chat/completions")
+        
+        def status_error(status: int, headers: dict = None) -> APIStatusError:
+            response = SimpleNamespace(status_code=status, headers=headers or {}, request=request)
+            return APIStatusError(f"status {status}", response=response, body=None)
+        
+        expected = {429: OVERLOADED, 503: OVERLOADED, 408: RETRYABLE, 500: RETRYABLE,
+                    502: RETRYABLE, 400: FATAL, 401: FATAL, 404: FATAL, 422: FATAL}
+        kinds = {status: classify_error(status_error(status)) for status in expected}
+        kinds["connection"] = classify_error(APIConnectionError(request=request))
+        kinds["budget"] = classify_error(BudgetExceeded("spent"))
+        if kinds != dict(expected, connection=RETRYABLE, budget=FATAL):
+            print(f"❌ Unexpected error classes: {kinds}")
+            return False
+        
+        delays = [
+            retry_after_seconds(status_error(429, {"retry-after": "7"})),
+            retry_after_seconds(status_error(429, {"retry-after-ms": "1500"})),
+            retry_after_seconds(status_error(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})),
+            retry_after_seconds(status_error(429)),
+        ]
+        future = retry_after_seconds(status_error(
+            503, {"retry-after": email.utils.formatdate(time.time() + 30, usegmt=True)}))
+        if delays != [7.0, 1.5, 0.0, None] or not 28 <= future <= 30:
+            print(f"❌ Unexpected Retry-After delays: {delays}, {future}")
+            return False
+        
+        # Backdate the last refill instead of sleeping
+        bucket = TokenBucket(60)
+        bucket.acquire(60)
+        bucket._updated -= 10
+        bucket.adjust(0)
+        refilled = bucket.tokens
+        bucket._updated -= 1000
+        bucket.adjust(0)
+        if not 10 <= refilled < 10.5 or bucket.tokens != 60:
+            print(f"❌ Token bucket refilled to {refilled} after 10s and {bucket.tokens} when full")
+            return False
+        
+        limit = AdaptiveConcurrency(16, min_limit=2, cooldown=0)
+        for _ in range(8):
+            limit.acquire()
+        halvings = []
+        for _ in range(3):
+            limit.on_overload()
+            halvings.append(limit.limit)
+        for _ in range(8):
+            limit.release()
+        limits = []
+        for _ in range(400):
+            limit.on_success()
+            limits.append(limit.limit)
+        cooled = AdaptiveConcurrency(16, cooldown=60)
+        for _ in range(8):
+            cooled.acquire()
+        cooled.on_overload()
+        cooled.on_overload()
+        if halvings != [4.0, 2.0, 2.0] or limits != sorted(limits) or limits[-1] != 16:
+            print(f"❌ AIMD limits went {halvings} on overload and ended at {limits[-1]} on success")
+            return False
+        if cooled.limit != 4.0:
+            print(f"❌ Overloads within the cooldown were counted twice: limit {cooled.limit}")
+            return False
+        
+        print(f"✓ Errors classified, Retry-After parsed, AIMD halved to {halvings} "
+              f"and recovered to 16 after {limits.index(16.0) + 1} successes")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Rate control test failed: {e}")
+        return False
+
+
+def test_streaming_validation():
+    """Test early detection of malformed streamed JSON and the stream retry paths"""
+    print("\n=== Testing Streaming Validation ===")
+    
+    try:
+        document = 'Sure:\n```json\n{"turns": ["a \\"quoted\\" {b}", 1.5e3, true, null, {"c": []}]}\n```'
+        validator = JSONPrefixValidator()
+        states = [validator.feed(char) for char in document]
+        if MALFORMED in states or states[-1] != COMPLETE:
+            print(f"❌ Valid prefixes were rejected: {validator.error}")
+            return False
+        if JSONPrefixValidator().feed("I would use {curly braces} here.\n") == MALFORMED:
+            print("❌ Braces in a free-form preamble were taken for JSON")
+            return False
+        # Defects extraction repairs must not cost an aborted stream
+        for repairable in ("{'turns': ['a', 'b'], 'done': True, 'note': None}",
+                           '{“turns”: [“a”, “b”]}',
+                           '{"turns": ["He said “hi”", "don’t"]}',
+                           '{"turns": ["a", "b",],}'):
+            validator = JSONPrefixValidator()
+            if validator.feed(repairable) != COMPLETE or not turns_from(extract_json(repairable)):
+                print(f"❌ Repairable output {repairable!r} was rejected: {validator.error}")
+                return False
+        for broken, stop in (('{"turns": ["a", oops "b"]}', '{"turns": ["a", o'),
+                             ('{"turns": tru, "x": 1}', '{"turns": tru,'),
+                             ('{"a": 1 "b": 2}', '{"a": 1 "')):
+            validator = JSONPrefixValidator()
+            if validator.feed(broken[:len(stop)]) != MALFORMED:
+                print(f"❌ {broken!r} not reported malformed by {stop!r}")
+                return False
+        
+        server = start_mock_server(config=MockServerConfig(latency=0.01, seed=8, malformed_rate=1.0))
+        generator = DialogueGenerator(base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                                      api_key="sk-mock", model="mock")
+        generator.cache = None
+        generator.stream = True
+        # Any backoff would sleep for seconds
+        generator.retry_delay = 30
+        generator.truncation_retry_factor = 2
+        max_tokens_sent = []
+        stream_completion = generator._stream_completion
+        
+        def recording_stream_completion(client, messages, max_tokens, *args, **kwargs):
+            max_tokens_sent.append(max_tokens)
+            return stream_completion(client, messages, max_tokens, *args, **kwargs)
+        
+        generator._stream_completion = recording_stream_completion
+        messages = [{"role": "user", "content": "Generate the user queries"}]
+        try:
+            start = time.perf_counter()
+            partial = generator.call_api_with_retry(messages, max_tokens=800, stage="query")
+            elapsed = time.perf_counter() - start
+            aborted = server.stats.snapshot()
+            aborts = generator.retries
+            
+            server.config.malformed_rate = 0.0
+            max_tokens_sent.clear()
+            completion = generator.call_api_with_retry(messages, max_tokens=20, stage="query")
+        finally:
+            generator.endpoints.close()
+            server.shutdown()
+        
+        if aborted["requests"] != generator.max_retries or aborts != generator.max_retries - 1:
+            print(f"❌ Expected {generator.max_retries} aborted attempts, got {aborted} ({aborts} retries)")
+            return False
+        if elapsed > 5 or "oops" not in partial:
+            print(f"❌ Aborted streams backed off ({elapsed:.1f}s) or lost the partial text")
+            return False
+        if max_tokens_sent != [20, 40] or len(turns_from(extract_json(completion))) != 6:
+            print(f"❌ Truncation retry sent max_tokens {max_tokens_sent}")
+            return False
+        
+        print(f"✓ Malformed streams aborted {aborted['requests']} times in {elapsed:.2f}s; "
+              f"truncation retried with max_tokens {max_tokens_sent}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Streaming validation test failed: {e}")
+        return False
+
+
+def test_metrics_recorder():
+    """Test bounded latency samples, exact histogram buckets and capped label values"""
+    print("\n=== Testing Metrics Recorder ===")
+    
+    try:
+        metrics = MetricsRecorder()
+        for index in range(5000):
+            metrics.record(stage="query", category=f"category {index % 1500}", latency=index / 1000,
+                           prompt_tokens=10, completion_tokens=5)
+        snapshot = metrics.snapshot()
+        total = snapshot["total"]
+        if total["calls"] != 5000 or abs(total["latency_mean"] - 2.4995) > 1e-6 \
+                or not 1.5 < total["latency_p50"] < 3.5:
+            print(f"❌ Unexpected totals: {total}")
+            return False
+        if len(metrics.total.latencies._reservoir) > 2048 \
+                or len(snapshot["by_category"]) != 1001 or "other" not in snapshot["by_category"]:
+            print(f"❌ Latencies or label values are not bounded: {len(snapshot['by_category'])} categories")
+            return False
+        prometheus = metrics.to_prometheus()
+        # 0.0 through 0.5 seconds are 501 calls, exactly
+        if 'dialogue_api_latency_seconds_bucket{le="0.5"} 501' not in prometheus \
+                or 'dialogue_api_latency_seconds_count 5000' not in prometheus:
+            print("❌ Prometheus histogram counts are not exact")
+            return False
+        
+        print(f"✓ Metrics kept {len(metrics.total.latencies._reservoir)} latency samples of 5000 calls "
+              f"and {len(snapshot['by_category'])} category labels")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Metrics recorder test failed: {e}")
+        return False
+
+
+def test_n_fallback():
+    """Test that only an explicit rejection of n switches to single-completion calls"""
+    print("\n=== Testing n Parameter Fallback ===")
+    
+    try:
+        request = SimpleNamespace(method="POST", url="http://127.0.0.1/v1/chat/completions")
+        
+        def status_error(status: int, message: str) -> APIStatusError:
+            response = SimpleNamespace(status_code=status, headers={}, request=request)
+            return APIStatusError(message, response=response, body=None)
+        
+        messages = [{"role": "user", "content": "Write the turns"}]
+        cases = [
+            ("budget", BudgetExceeded("token budget of 100 tokens is spent"), True),
+            ("auth", status_error(401, "Incorrect API key provided"), True),
+            ("context", status_error(400, "This model's maximum context length is 4096 tokens"), True),
+            ("n rejected", status_error(400, "'n' must be 1 when using this model"), False),
+        ]
+        for name, error, raises in cases:
+            generator = DialogueGenerator(base_url="", api_key="", model="mock", offline=True)
+            generator.supports_n = True
+            calls = []
+            
+            def create_completion(messages, max_tokens, temperature, n=1, **kwargs):
+                calls.append(n)
+                if n > 1 or raises:
+                    raise error
+                return [f"sample {len(calls)}"]
+            
+            generator._create_completion = create_completion
+            try:
+                completions = generator.call_api_samples(messages, [0, 1, 2])
+            except Exception as e:
+                if not raises or e is not error:
+                    print(f"❌ {name}: unexpected error {e!r}")
+                    return False
+                if not generator.supports_n:
+                    print(f"❌ {name}: a {type(e).__name__} turned off the n parameter")
+                    return False
+                continue
+            if raises:
+                print(f"❌ {name}: the error was swallowed and {len(completions)} completions returned")
+                return False
+            if generator.supports_n or sorted(calls) != [1, 1, 1, 3] or len(set(completions)) != 3:
+                print(f"❌ {name}: expected single-completion fallback, got calls {calls}, "
+                      f"supports_n={generator.supports_n}")
+                return False
+        
+        print("✓ Budget, auth and context errors are raised; an explicit n rejection falls back")
+        return True
+        
+    except Exception as e:
+        print(f"❌ n fallback test failed: {e}")
+        return False
+
+
+def test_prefix_order():
+    """Test shared-prefix ratios and windowed, stable prefix ordering of query requests"""
+    print("\n=== Testing Prefix Order ===")
+    
+    try:
+        if shared_prefix_ratio(["abc", "abd"]) != 2 / 6 or shared_prefix_ratio([]) != 0.0:
+            print("❌ Unexpected shared-prefix ratios")
+            return False
+        
+        # Two flow types interleaved; scenarios 1 and 2 render to the same prompt
+        prompts = {"s0": "flow B / x", "s1": "flow A / y", "s2": "flow A / y",
+                   "s3": "flow B / w", "s4": "flow B / a", "s5": "flow A / z"}
+        groups = [[WorkItem("c", scenario, "", sample_id) for sample_id in range(2)]
+                  for scenario in prompts]
+        reports = []
+        ordered = list(order_by_prefix(groups, lambda item: prompts[item.scenario], window=4,
+                                       report=reports.append))
+        scenarios = [group[0].scenario for group in ordered]
+        # Sorted within each window of 4, ties kept in arrival order, windows never mixed
+        if scenarios != ["s1", "s2", "s3", "s0", "s5", "s4"]:
+            print(f"❌ Unexpected prefix order: {scenarios}")
+            return False
+        if any(len(group) != 2 for group in ordered) or [r["requests"] for r in reports] != [4, 2]:
+            print(f"❌ Groups were split or windows miscounted: {reports}")
+            return False
+        if reports[0]["shared_prefix_ratio"] <= reports[0]["arrival_shared_prefix_ratio"]:
+            print(f"❌ Sorting did not raise the shared-prefix ratio: {reports[0]}")
+            return False
+        if list(order_by_prefix(groups, lambda item: prompts[item.scenario], window=4)) != ordered:
+            print("❌ Prefix order is not stable across runs")
+            return False
+        
+        print(f"✓ Prefix order {scenarios}, shared prefix {reports[0]['shared_prefix_ratio']:.0%} "
+              f"vs {reports[0]['arrival_shared_prefix_ratio']:.0%} in arrival order")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Prefix order test failed: {e}")
+        return False
+
+
+def test_planner():
+    """Test the dry-run token, cost and time projection"""
+    print("\n=== Testing Run Planner ===")
+    
+    try:
+        generator = DialogueGenerator(base_url="", api_key="", model="mock", offline=True)
+        data = generator.load_data(FILE_PATHS["data"])
+        scenarios = sum(len(category["scenarios"]) for category in data["categories"].values())
+        settings = {"completion_tokens_query": 100, "completion_tokens_response": 300,
+                    "time_to_first_token": 0.5, "decode_tokens_per_second": 100,
+                    "prompt_price_per_million": 1.0, "completion_price_per_million": 2.0}
+        query_template = generator.load_prompt_template(FILE_PATHS["query_prompt"])
+        response_template = generator.load_prompt_template(FILE_PATHS["response_prompt"])
+        
+        plan = plan_run(generator, data, query_template, response_template, settings,
+                        tokenizer=get_tokenizer("heuristic"), concurrency=4)
+        stages = plan["stages"]
+        if plan["scenarios"] != scenarios or stages["query"]["calls"] != scenarios \
+                or stages["response"]["calls"] != scenarios:
+            print(f"❌ Expected {scenarios} query and response calls: {stages}")
+            return False
+        if plan["completion_tokens"] != scenarios * 400 \
+                or plan["total_tokens"] != plan["prompt_tokens"] + plan["completion_tokens"]:
+            print(f"❌ Unexpected token totals: {plan}")
+            return False
+        expected_cost = (plan["prompt_tokens"] * 1.0 + plan["completion_tokens"] * 2.0) / 1_000_000
+        expected_seconds = scenarios * ((0.5 + 1.0) + (0.5 + 3.0)) / 4
+        if abs(plan["cost"] - expected_cost) > 1e-9 or abs(plan["wall_clock_seconds"] - expected_seconds) > 1e-6:
+            print(f"❌ Unexpected cost {plan['cost']} or time {plan['wall_clock_seconds']}")
+            return False
+        
+        # With n, the samples of a scenario share one query call
+        generator.samples_per_scenario = 3
+        generator.supports_n = True
+        sampled = plan_run(generator, data, query_template, response_template, settings,
+                           tokenizer=get_tokenizer("heuristic"))
+        if sampled["stages"]["query"]["calls"] != scenarios \
+                or sampled["stages"]["response"]["calls"] != 3 * scenarios \
+                or sampled["stages"]["query"]["prompt_tokens"] != stages["query"]["prompt_tokens"]:
+            print(f"❌ Unexpected multi-sample plan: {sampled['stages']}")
+            return False
+        
+        print(f"✓ Planned {plan['total_tokens']} tokens, ${plan['cost']:.4f} and "
+              f"{plan['wall_clock_seconds']:.0f}s for {scenarios} dialogues")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Planner test failed: {e}")
+        return False
+
+
+def test_token_budget():
+    """Test that the token budget stops a run without writing partial records, and resume finishes it"""
+    print("\n=== Testing Token Budget ===")
+    
+    try:
+        server = start_mock_server(config=MockServerConfig(latency=0.01, seed=9))
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        data = DialogueGenerator.load_data(None, FILE_PATHS["data"])
+        data["categories"] = dict(list(data["categories"].items())[:2])
+        expected = {f"{category} - {scenario}" for category, category_data in data["categories"].items()
+                    for scenario in category_data["scenarios"]}
+        
+        def run(output_file: str, budget: Optional[int], resume: bool) -> DialogueGenerator:
+            generator = DialogueGenerator(base_url=base_url, api_key="sk-mock", model="mock")
+            generator.cache = None
+            generator.token_budget = TokenBudget(budget)
+            generator.batch_generate(
+                data,
+                generator.load_prompt_template(FILE_PATHS["query_prompt"]),
+                generator.load_prompt_template(FILE_PATHS["response_prompt"]),
+                output_file,
+                resume=resume
+            )
+            generator.endpoints.close()
+            return generator
+        
+        previous_metrics_file = OUTPUT_CONFIG.get("metrics_file")
+        OUTPUT_CONFIG["metrics_file"] = None
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output_file = os.path.join(tmp_dir, "budget_dialogues.jsonl")
+                generator = run(output_file, 15000, resume=False)
+                stopped = list(read_records(output_file))
+                budget = generator.token_budget
+                run(output_file, None, resume=True)
+                resumed = list(read_records(output_file))
+        finally:
+            OUTPUT_CONFIG["metrics_file"] = previous_metrics_file
+            server.shutdown()
+        
+        if not budget.exceeded or budget.used > budget.limit or not 0 < len(stopped) < len(expected):
+            print(f"❌ Budget did not stop the run: {len(stopped)} of {len(expected)} written, "
+                  f"{budget.used}/{budget.limit} tokens")
+            return False
+        incomplete = [record["category"] for record in stopped
+                      if not record.get("turns") or len(record["queries"]) != len(record["responses"])]
+        if incomplete:
+            print(f"❌ Partial records written under the budget: {incomplete}")
+            return False
+        categories = [record["category"] for record in resumed]
+        if len(categories) != len(set(categories)) or set(categories) != expected:
+            print(f"❌ Resume after the budget stop left duplicates or gaps: {len(categories)} records")
+            return False
+        
+        print(f"✓ Budget stopped the run at {len(stopped)} of {len(expected)} dialogues "
+              f"({budget.used}/{budget.limit} tokens); resume finished the rest")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Token budget test failed: {e}")
+        return False
+
+
+def test_mock_server_generation():
+    """Test batch generation end to end against the local mock server"""
+    print("\n=== Testing Batch Generation Against Mock Server ===")
+    
+    try:
+        # Lognormal latencies finish requests out of order
+        server = start_mock_server(config=MockServerConfig(latency=0.01, latency_dist="lognormal",
+                                                           latency_sigma=1.0, rate_limit_rate=0.2,
+                                                           retry_after=0, seed=3))
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        generator = DialogueGenerator(base_url=base_url, api_key="sk-mock", model="mock")
+        generator.cache = None
+        generator.max_concurrency = 4
+        
+        data = generator.load_data(FILE_PATHS["data"])
+        category_name, category_data = next(iter(data["categories"].items()))
+        data["categories"] = {category_name: category_data}
+        query_prompt_template = generator.load_prompt_template(FILE_PATHS["query_prompt"])
+        response_prompt_template = generator.load_prompt_template(FILE_PATHS["response_prompt"])
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, "mock_dialogues.json")
+            metrics_file = os.path.join(tmp_dir, "mock_metrics.json")
+            previous_metrics_file = OUTPUT_CONFIG.get("metrics_file")
+            OUTPUT_CONFIG["metrics_file"] = metrics_file
+            try:
+                total = generator.batch_generate(data, query_prompt_template,
+                                                 response_prompt_template, output_file)
+            finally:
+                OUTPUT_CONFIG["metrics_file"] = previous_metrics_file
+            with open(output_file, "r", encoding="utf-8") as f:
+                dialogues = json.load(f)
+            with open(metrics_file, "r", encoding="utf-8") as f:
+                metrics = json.load(f)
+        generator.endpoints.close()
+        server.shutdown()
+        
+        expected = len(category_data["scenarios"])
+        if total != expected or len(dialogues) != expected:
+            print(f"❌ Expected {expected} dialogues, got {total} ({len(dialogues)} in file)")
+            return False
+        if any(len(d["turns"]) != len(d["queries"]) for d in dialogues):
+            print("❌ Some dialogues have unanswered questions")
+            return False
+        expected_order = [f"{category_name} - {scenario}" for scenario in category_data["scenarios"]]
+        if [d["category"] for d in dialogues] != expected_order:
+            print("❌ Concurrent run did not write dialogues in data-file order")
+            return False
+        if metrics["total"]["calls"] != 2 * expected or not metrics["total"]["completion_tokens"]:
+            print(f"❌ Metrics do not match the calls made: {metrics['total']}")
+            return False
+        
+        print(f"✓ Generated {total} dialogues with {generator.retries} retries: "
+              f"{server.stats.snapshot()}")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Mock server generation test failed: {e}")
+        return False
+
+
+def test_endpoint_pool():
+    """Test balancing, ejection and health checks across several local mock servers"""
+    print("\n=== Testing Endpoint Pool ===")
+    
+    try:
+        servers = [start_mock_server(config=MockServerConfig(latency=0.01, seed=index)) for index in range(3)]
+        # The third replica answers health checks but fails every completion
+        servers[2].config.error_rate = 1.0
+        urls = [f"http://127.0.0.1:{server.server_address[1]}/v1" for server in servers]
+        try:
+            # Least outstanding requests relative to weight
+            pool = EndpointPool([{"base_url": urls[0], "api_key": "sk-mock", "weight": 2},
+                                 {"base_url": urls[1], "api_key": "sk-mock"}],
+                                health_check_interval=0)
+            leased = [pool.acquire() for _ in range(6)]
+            shares = [sum(1 for endpoint in leased if endpoint is e) for e in pool.endpoints]
+            for endpoint in leased:
+                pool.release(endpoint)
+            if shares != [4, 2]:
+                print(f"❌ Weighted balancing gave shares {shares}, expected [4, 2]")
+                return False
+            
+            # Failing completions eject the replica; every call still succeeds elsewhere
+            generator = DialogueGenerator(base_url=urls[0], api_key="sk-mock", model="mock",
+                                          endpoints=[{"base_url": url, "api_key": "sk-mock"} for url in urls])
+            generator.cache = None
+            generator.retry_delay = 0.01
+            generator.endpoints.health_check_interval = 0
+            generator.endpoints.failure_threshold = 3
+            messages = [{"role": "user", "content": "Write the turns"}]
+            for _ in range(12):
+                generator.call_api_with_retry(messages, stage="query")
+            stats = {stat["base_url"]: stat for stat in generator.endpoints.stats()}
+            generator.endpoints.close()
+            if stats[urls[2]]["healthy"] or stats[urls[2]]["failures"] != 3:
+                print(f"❌ Failing replica not ejected after 3 failures: {stats[urls[2]]}")
+                return False
+            if stats[urls[0]]["requests"] < 4 or stats[urls[1]]["requests"] < 4:
+                print(f"❌ Requests were not spread over the healthy replicas: {stats}")
+                return False
+            
+            # Health probes respect the failure threshold and reinstate a replica that is back
+            down_port = servers[1].server_address[1]
+            servers[1].shutdown()
+            servers[1].server_close()
+            pool = EndpointPool([{"base_url": url, "api_key": "sk-mock"} for url in urls[:2]],
+                                failure_threshold=2,
+                                ejection_seconds=0, health_check_interval=0,
+                                client_options={"max_retries": 0})
+            pool.check_health()
+            after_one = pool.endpoints[1].healthy
+            pool.check_health()
+            after_two = pool.endpoints[1].healthy
+            servers[1] = start_mock_server(config=MockServerConfig(latency=0.01), port=down_port)
+            pool.check_health()
+            if not after_one or after_two or not pool.endpoints[1].healthy or not pool.endpoints[0].healthy:
+                print(f"❌ Health states after 1, 2 failed probes and recovery: "
+                      f"{after_one}, {after_two}, {pool.endpoints[1].healthy}")
+                return False
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+        
+        print(f"✓ Balanced 4:2 by weight, ejected the failing replica after 3 failures, "
+              f"ejected a down replica after 2 probes and reinstated it")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Endpoint pool test failed: {e}")
+        return False
+
+
+def test_two_stage_pipeline():
+    """Test stage ordering, concurrency limits and error propagation of the two-stage pipeline"""
+    print("\n=== Testing Two-Stage Pipeline ===")
+    
+    try:
+        server = start_mock_server(config=MockServerConfig(latency=0.02, seed=7))
+        generator = DialogueGenerator(base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                                      api_key="sk-mock", model="mock")
+        generator.cache = None
+        data = generator.load_data(FILE_PATHS["data"])
+        query_prompt_template = generator.load_prompt_template(FILE_PATHS["query_prompt"])
+        response_prompt_template = generator.load_prompt_template(FILE_PATHS["response_prompt"])
+        items = list(iter_work_items(data))[:12]
+        broken = items[3]
+        
+        lock = threading.Lock()
+        active = {"query": 0, "response": 0}
+        peak = {"query": 0, "response": 0}
+        queried = set()
+        out_of_order = []
+        
+        def enter(stage: str):
+            with lock:
+                active[stage] += 1
+                peak[stage] = max(peak[stage], active[stage])
+        
+        def leave(stage: str):
+            with lock:
+                active[stage] -= 1
+        
+        def query_stage(group):
+            enter("query")
+            try:
+                item = group[0]
+                if item == broken:
+                    raise ValueError("broken scenario")
+                queries = generator.run_query_stage(item.category, item.scenario, item.flow_type,
+                                                    query_prompt_template, data["flow_definitions"])
+                with lock:
+                    queried.add(item)
+                return [(item, queries)]
+            finally:
+                leave("query")
+        
+        def response_stage(item, queries):
+            enter("response")
+            try:
+                with lock:
+                    if item not in queried:
+                        out_of_order.append(item)
+                return generator.run_response_stage(item.category, item.scenario, queries,
+                                                    response_prompt_template)
+            finally:
+                leave("response")
+        
+        results, errors, threads = [], [], set()
+        
+        def on_result(item, dialogue):
+            threads.add(threading.get_ident())
+            results.append(item)
+        
+        def on_error(item, error):
+            threads.add(threading.get_ident())
+            errors.append(item)
+        
+        def groups(limit=None):
+            for index, item in enumerate(items):
+                if index == limit:
+                    raise RuntimeError("scenario source broke off")
+                yield [item]
+        
+        try:
+            pipeline = TwoStagePipeline(query_stage, response_stage, query_concurrency=2,
+                                        response_concurrency=3, queue_size=2)
+            pipeline.run(groups(), on_result, on_error)
+            stats = pipeline.stats()
+            
+            feed_error = None
+            partial = []
+            pipeline = TwoStagePipeline(query_stage, response_stage, query_concurrency=2,
+                                        response_concurrency=3, queue_size=2)
+            try:
+                pipeline.run(groups(limit=6), lambda item, dialogue: partial.append(item),
+                             lambda item, error: None)
+            except RuntimeError as e:
+                feed_error = e
+        finally:
+            generator.endpoints.close()
+            server.shutdown()
+        
+        if out_of_order or threads != {threading.get_ident()}:
+            print(f"❌ Responses started before their queries or results left the run thread: {out_of_order}")
+            return False
+        if sorted(results + errors) != sorted(items) or errors[:1] != [broken]:
+            print(f"❌ Expected {len(items) - 1} dialogues and 1 failure, got {len(results)} and {errors}")
+            return False
+        if peak["query"] > 2 or peak["response"] > 3 or stats["query"]["max_queue_depth"] > 2:
+            print(f"❌ Concurrency limits exceeded: {peak}, max queue depth {stats['query']['max_queue_depth']}")
+            return False
+        if feed_error is None or sorted(partial) != sorted(item for item in items[:6] if item != broken):
+            print(f"❌ Feed error not propagated after the queued items finished: {feed_error}, {len(partial)} done")
+            return False
+        
+        # Stage latencies stay bounded however long the run
+        sample = LatencySample(size=100)
+        for index in range(10000):
+            sample.add(index / 10000)
+        percentiles = sample.percentiles()
+        if len(sample._reservoir) != 100 or sample.count != 10000 or abs(sample.mean() - 0.49995) > 1e-9 \
+                or not 0.3 < percentiles["p50"] < 0.7 or percentiles["p99"] < 0.8:
+            print(f"❌ Unexpected latency sample: {len(sample._reservoir)} kept, {percentiles}")
+            return False
+        
+        print(f"✓ Pipeline ran {len(results)} dialogues (peak {peak['query']} query / "
+              f"{peak['response']} response calls) and re-raised the feed error")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Two-stage pipeline test failed: {e}")
+        return False
+
+
+def test_finalize_json():
+    """Test that finalizing a JSONL stream matches the legacy json.dump output byte for byte"""
+    print("\n=== Testing JSON Finalization ===")
+    
+    try:
+        records = [
+            {"category": "健康咨询 - Diet", "turns": [{"human": "Café?", "assistant": "Sí \"sure\"\n"}],
+             "queries": ["Café?"], "responses": ["Sí \"sure\"\n"]},
+            {"category": "Empty - Nested", "turns": [], "queries": [], "responses": [],
+             "meta": {"sample_id": 1, "score": 0.5, "ok": True, "note": None, "tags": [[], {}]}},
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for compress in (False, True):
+                stream_path = os.path.join(tmp_dir, "dialogues.jsonl" + (".gz" if compress else ""))
+                with DialogueWriter(stream_path) as writer:
+                    for record in records:
+                        writer.write(record)
+                for subset in (records, []):
+                    if not subset:
+                        stream_path = os.path.join(tmp_dir, "empty.jsonl")
+                        DialogueWriter(stream_path).close()
+                    for ensure_ascii in (False, True):
+                        for indent in (2, 4, None):
+                            json_path = os.path.join(tmp_dir, "dialogues.json")
+                            finalize_to_json(stream_path, json_path, ensure_ascii=ensure_ascii, indent=indent)
+                            with open(json_path, "rb") as f:
+                                finalized = f.read()
+                            legacy_path = os.path.join(tmp_dir, "legacy.json")
+                            with open(legacy_path, "w", encoding="utf-8") as f:
+                                json.dump(subset, f, ensure_ascii=ensure_ascii, indent=indent)
+                            with open(legacy_path, "rb") as f:
+                                legacy = f.read()
+                            if finalized != legacy:
+                                print(f"❌ Finalized output differs from json.dump (compress={compress}, "
+                                      f"{len(subset)} records, ensure_ascii={ensure_ascii}, indent={indent})")
+                                return False
+        
+        print("✓ Finalized JSON matches json.dump byte for byte (plain/gzip, empty, ascii, indents 2/4/None)")
+        return True
+        
+    except Exception as e:
+        print(f"❌ JSON finalization test failed: {e}")
+        return False
+
+
+def test_checkpoint_resume():
+    """Test resuming a run that crashed mid-record against the local mock server"""
+    print("\n=== Testing Checkpoint Resume ===")
+    
+    try:
+        server = start_mock_server(config=MockServerConfig(latency=0.01, seed=6))
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        data = DialogueGenerator.load_data(None, FILE_PATHS["data"])
+        data["categories"] = dict(list(data["categories"].items())[:2])
+        expected = {(f"{category} - {scenario}", 0)
+                    for category, category_data in data["categories"].items()
+                    for scenario in category_data["scenarios"]}
+        
+        def run(output_file: str, resume: bool) -> DialogueGenerator:
+            generator = DialogueGenerator(base_url=base_url, api_key="sk-mock", model="mock")
+            generator.cache = None
+            generator.max_concurrency = 4
+            generator.batch_generate(
+                data,
+                generator.load_prompt_template(FILE_PATHS["query_prompt"]),
+                generator.load_prompt_template(FILE_PATHS["response_prompt"]),
+                output_file,
+                resume=resume
+            )
+            generator.endpoints.close()
+            return generator
+        
+        previous_metrics_file = OUTPUT_CONFIG.get("metrics_file")
+        OUTPUT_CONFIG["metrics_file"] = None
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output_file = os.path.join(tmp_dir, "resume_dialogues.jsonl")
+                checkpoint_file = checkpoint_path_for(output_file)
+                run(output_file, resume=False)
+                
+                # Simulate a crash: 12 dialogues written, the 13th cut off mid-record,
+                # and 3 more that only got through the query stage
+                with open(output_file, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+                events = list(read_records(checkpoint_file))
+                done = [tuple(event["key"]) for event in events if event["stage"] == "done"]
+                queries = {tuple(event["key"]): event for event in events if event["stage"] == "queries"}
+                with open(output_file, "w", encoding="utf-8") as f:
+                    f.writelines(lines[:12])
+                    f.write(lines[12][:len(lines[12]) // 2])
+                with open(checkpoint_file, "w", encoding="utf-8") as f:
+                    for key in done[:12]:
+                        f.write(json.dumps(queries[key], ensure_ascii=False) + "\n")
+                        f.write(json.dumps({"key": list(key), "stage": "done"}) + "\n")
+                    for key in done[13:16]:
+                        f.write(json.dumps(queries[key], ensure_ascii=False) + "\n")
+                
+                generator = run(output_file, resume=True)
+                records = list(read_records(output_file))
+        finally:
+            OUTPUT_CONFIG["metrics_file"] = previous_metrics_file
+            server.shutdown()
+        
+        labels = [(record["category"], record.get("sample_id", 0)) for record in records]
+        if len(labels) != len(set(labels)) or set(labels) != expected:
+            print(f"❌ Resumed output has duplicates or gaps: {len(labels)} records, "
+                  f"{len(set(labels))} distinct of {len(expected)}")
+            return False
+        calls = {stage: stats["calls"] for stage, stats in generator.metrics.snapshot()["by_stage"].items()}
+        remaining = len(expected) - 12
+        if calls.get("query") != remaining - 3 or calls.get("response") != remaining:
+            print(f"❌ Resume made {calls} calls, expected {remaining - 3} query and {remaining} response calls")
+            return False
+        
+        print(f"✓ Resumed {remaining} dialogues ({calls['query']} query calls, 3 from checkpointed queries)")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Checkpoint resume test failed: {e}")
+        return False
+
+
+CRASH_SCRIPT = """
+import os
+import sys
+import batch_run
+from config import FILE_PATHS, OUTPUT_CONFIG
+from dialogue_generator import DialogueGenerator
+from endpoints import EndpointPool
+
+base_url, output_file, crash_after = sys.argv[1], sys.argv[2], int(sys.argv[3])
+OUTPUT_CONFIG.update(metrics_file=None, fsync_interval=5)
+write = batch_run.BatchRun.write
+
+def write_then_crash(self, item, dialogue):
+    write(self, item, dialogue)
+    if self.writer.count == crash_after:
+        os._exit(1)  # Nothing is flushed or closed, like a killed process
+
+batch_run.BatchRun.write = write_then_crash
+generator = DialogueGenerator(base_url=base_url, api_key="sk-mock", model="mock")
+generator.cache = None
+data = generator.load_data(FILE_PATHS["data"])
+data["categories"] = dict(list(data["categories"].items())[:2])
+generator.batch_generate(data, generator.load_prompt_template(FILE_PATHS["query_prompt"]),
+                         generator.load_prompt_template(FILE_PATHS["response_prompt"]), output_file)
+"""
+
+
+def test_checkpoint_crash():
+    """Test resuming a run killed mid-way, with the checkpoint left as the crash left it"""
+    print("\n=== Testing Checkpoint Crash Recovery ===")
+    
+    try:
+        server = start_mock_server(config=MockServerConfig(latency=0.01, seed=7))
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        data = DialogueGenerator.load_data(None, FILE_PATHS["data"])
+        data["categories"] = dict(list(data["categories"].items())[:2])
+        expected = {(f"{category} - {scenario}", 0)
+                    for category, category_data in data["categories"].items()
+                    for scenario in category_data["scenarios"]}
+        
+        previous_metrics_file = OUTPUT_CONFIG.get("metrics_file")
+        OUTPUT_CONFIG["metrics_file"] = None
+        try:
+            for name in ("crash_dialogues.jsonl", "crash_dialogues.jsonl.gz"):
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    output_file = os.path.join(tmp_dir, name)
+                    crashed = subprocess.run(
+                        [sys.executable, "-c", CRASH_SCRIPT, base_url, output_file, "7"],
+                        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+                    )
+                    if crashed.returncode != 1:
+                        print(f"❌ Crash run of {name} exited with {crashed.returncode}: {crashed.stderr[-500:]}")
+                        return False
+                    
+                    # Every dialogue the checkpoint calls done must have reached the disk
+                    done = {(f"{event['key'][0]} - {event['key'][1]}", event["key"][2])
+                            for event in read_records(checkpoint_path_for(output_file))
+                            if event["stage"] == "done"}
+                    on_disk = {(record["category"], 0) for record in read_records(output_file)}
+                    if not done <= on_disk:
+                        print(f"❌ {name}: checkpoint marks {len(done - on_disk)} dialogues done "
+                              f"that are not in the output ({len(done)} done, {len(on_disk)} on disk)")
+                        return False
+                    
+                    generator = DialogueGenerator(base_url=base_url, api_key="sk-mock", model="mock")
+                    generator.cache = None
+                    generator.batch_generate(
+                        data,
+                        generator.load_prompt_template(FILE_PATHS["query_prompt"]),
+                        generator.load_prompt_template(FILE_PATHS["response_prompt"]),
+                        output_file,
+                        resume=True
+                    )
+                    generator.endpoints.close()
+                    labels = [(record["category"], 0) for record in read_records(output_file)]
+                    if len(labels) != len(set(labels)) or set(labels) != expected:
+                        print(f"❌ {name}: resumed output has duplicates or gaps: {len(labels)} records, "
+                              f"{len(set(labels))} distinct of {len(expected)}")
+                        return False
+                    print(f"✓ {name}: {len(done)} checkpointed as done, {len(on_disk)} on disk after the crash, "
+                          f"{len(labels)} after resume")
+        finally:
+            OUTPUT_CONFIG["metrics_file"] = previous_metrics_file
+            server.shutdown()
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Checkpoint crash test failed: {e}")
+        return False
+
+
 def main():
     """Main test function"""
     print("Starting tests for simplified dialogue generation...")
     
     tests = [
         test_config_loading,
+        test_legacy_config,
         test_data_structure,
+        test_response_cache,
+        test_extraction,
+        test_template_registry,
+        test_dedup_index,
+        test_validators,
+        test_scenario_stream,
+        test_sharding,
+        test_columnar_export,
+        test_batch_io_round_trip,
+        test_quota_scheduler,
+        test_rate_control,
+        test_metrics_recorder,
+        test_n_fallback,
+        test_streaming_validation,
+        test_prefix_order,
+        test_planner,
+        test_mock_server_generation,
+        test_token_budget,
+        test_endpoint_pool,
+        test_two_stage_pipeline,
+        test_finalize_json,
+        test_checkpoint_resume,
+        test_checkpoint_crash,
+        test_generation_service,
         test_dialogue_generator
     ]
     
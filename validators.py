@@ -0,0 +1,274 @@
+"""
+Quality checks on generated dialogues.
+
+A validator takes a dialogue record and the VALIDATION_CONFIG settings and
+returns a reason string when the record is unusable, or None. The built-in
+validators are registered by name in ``VALIDATORS``; other ones are named
+``"module:function"`` and imported where they run.
+
+``ValidationPool`` runs the configured validators on a process pool so the
+checks never hold up the threads that wait on the API. Batch generation
+submits every finished dialogue and gets the reasons back in a callback,
+which writes the dialogue to the output or to the reject file.
+"""
+
+import importlib
+import multiprocessing
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from records import turn_count
+
+Validator = Callable[[Dict, Dict], Optional[str]]
+
+# Fallback texts older versions wrote when generation failed, and template
+# examples copied verbatim
+PLACEHOLDER_PATTERNS = [
+    re.compile(r"^(Question|Response) \d+ about "),
+    re.compile(r"^<(turn|response|query)\d*>$"),
+    re.compile(r"^\.\.\.$"),
+]
+
+# Closing quotes, brackets and emphasis that may follow a sentence's final mark
+_TRAILING = "\"')]}*_ \n\t”’」』）"
+
+
+def reject_path_for(stream_file: str) -> str:
+    """Return the reject file path for an output stream"""
+    root = stream_file
+    for suffix in (".gz", ".jsonl"):
+        if root.endswith(suffix):
+            root = root[:-len(suffix)]
+    return f"{root}.rejects.jsonl"
+
+
+def validated_output_path(path: str) -> str:
+    """Default output of the validate command, e.g. out.json -> out.valid.json"""
+    for suffix in (".jsonl.gz", ".jsonl", ".json"):
+        if path.endswith(suffix):
+            return f"{path[:-len(suffix)]}.valid{suffix}"
+    return f"{path}.valid"
+
+
+def check_alignment(record: Dict, settings: Dict) -> Optional[str]:
+    """Every query has exactly one response, and turns (unless compact) pair them up"""
+    queries = record.get("queries") or []
+    responses = record.get("responses") or []
+    if len(queries) != len(responses):
+        return f"{len(queries)} queries but {len(responses)} responses"
+    if "turns" in record and len(record["turns"] or []) != len(queries):
+        return f"{len(record['turns'] or [])} turns for {len(queries)} queries"
+    return None
+
+
+def check_placeholders(record: Dict, settings: Dict) -> Optional[str]:
+    """No empty turns and no fallback or template placeholder texts"""
+    for field in ("queries", "responses"):
+        for index, text in enumerate(record.get(field) or []):
+            if not isinstance(text, str) or not text.strip():
+                return f"empty {field[:-1] if field == 'responses' else 'query'} {index + 1}"
+            if any(pattern.match(text.strip()) for pattern in PLACEHOLDER_PATTERNS):
+                return f"placeholder text in {field} {index + 1}: {text.strip()[:40]!r}"
+    return None
+
+
+def check_turn_count(record: Dict, settings: Dict) -> Optional[str]:
+    """The dialogue has min_turns to max_turns turns"""
+    turns = turn_count(record)
+    low, high = settings.get("min_turns", 6), settings.get("max_turns", 8)
+    if not low <= turns <= high:
+        return f"{turns} turns, expected {low}-{high}"
+    return None
+
+
+def ends_with_question(text: str) -> bool:
+    """Whether the last sentence of text is a question"""
+    return text.rstrip(_TRAILING).endswith(("?", "？"))
+
+
+def check_follow_up_questions(record: Dict, settings: Dict) -> Optional[str]:
+    """At most max_follow_up_questions responses end by asking the user a question"""
+    asking = [index + 1 for index, response in enumerate(record.get("responses") or [])
+              if isinstance(response, str) and ends_with_question(response)]
+    if len(asking) > settings.get("max_follow_up_questions", 0):
+        return f"follow-up questions in responses {', '.join(map(str, asking))}"
+    return None
+
+
+VALIDATORS: Dict[str, Validator] = {
+    "alignment": check_alignment,
+    "placeholders": check_placeholders,
+    "turn_count": check_turn_count,
+    "follow_up_questions": check_follow_up_questions,
+}
+
+
+@lru_cache(maxsize=None)
+def resolve_validator(name: str) -> Validator:
+    """A built-in validator by name, or a "module:function" one by import"""
+    if name in VALIDATORS:
+        return VALIDATORS[name]
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"unknown validator {name!r} (use one of {', '.join(VALIDATORS)} "
+                         "or module:function)")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def validate_record(record: Dict, validators: Tuple[str, ...], settings: Dict) -> List[str]:
+    """Reasons the record fails the named validators (empty when it passes)"""
+    reasons = []
+    for name in validators:
+        reason = resolve_validator(name)(record, settings)
+        if reason:
+            reasons.append(f"{name}: {reason}")
+    return reasons
+
+
+def _validate_chunk(records: List[Dict], validators: Tuple[str, ...],
+                    settings: Dict) -> List[List[str]]:
+    return [validate_record(record, validators, settings) for record in records]
+
+
+class ValidationPool:
+    """Validate records on worker processes, or inline with workers=0"""
+
+    def __init__(self, validators: Iterable[str], settings: Optional[Dict] = None,
+                 workers: int = 0, max_pending: int = 256):
+        """
+        Resolve the validators and start the workers.
+
+        At most max_pending records are queued for validation; submit blocks
+        beyond that so a slow pool cannot buffer a whole run in memory.
+        """
+        self.validators = tuple(validators)
+        for name in self.validators:
+            resolve_validator(name)
+        self.settings = dict(settings or {})
+        self.workers = max(0, workers)
+        self.passed = 0
+        self.rejected = 0
+        self.reasons: Counter = Counter()
+        self._executor = None
+        if self.workers:
+            # Spawned workers do not inherit the generator's threads or sockets
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._idle = threading.Condition()
+        self._pending = 0
+        # Callbacks write output files, so they never run concurrently
+        self._callback_lock = threading.Lock()
+
+    def _count(self, reasons: List[str]):
+        if reasons:
+            self.rejected += 1
+            self.reasons.update(reason.split(":", 1)[0] for reason in reasons)
+        else:
+            self.passed += 1
+
+    def _finish(self, reasons: List[str], callback: Callable[[List[str]], None],
+                on_error: Optional[Callable[[Exception], None]]):
+        with self._callback_lock:
+            self._count(reasons)
+            try:
+                callback(reasons)
+            except Exception as e:
+                if on_error is None:
+                    print(f"❌ Failed to handle a validated dialogue: {e}")
+                    return
+                try:
+                    on_error(e)
+                except Exception as handler_error:
+                    print(f"❌ Failed to handle a validated dialogue: {e} ({handler_error})")
+
+    def _done(self, future, callback: Callable[[List[str]], None],
+              on_error: Optional[Callable[[Exception], None]]):
+        try:
+            try:
+                reasons = future.result()
+            except Exception as e:
+                reasons = [f"error: {e}"]
+            self._finish(reasons, callback, on_error)
+        finally:
+            self._slots.release()
+            with self._idle:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def submit(self, record: Dict, callback: Callable[[List[str]], None],
+               on_error: Optional[Callable[[Exception], None]] = None):
+        """
+        Validate record and call callback with its reasons once the checks finish.
+
+        An exception raised by callback is passed to on_error, if given.
+        """
+        if self._executor is None:
+            self._finish(validate_record(record, self.validators, self.settings), callback, on_error)
+            return
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(validate_record, record, self.validators, self.settings)
+        except BaseException:
+            # A broken pool must not hold a slot that drain would wait on
+            self._slots.release()
+            raise
+        with self._idle:
+            self._pending += 1
+        future.add_done_callback(lambda done: self._done(done, callback, on_error))
+
+    def drain(self):
+        """Wait until every submitted record has been handled"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def map(self, records: Iterable[Dict], chunksize: int = 64) -> Iterator[Tuple[Dict, List[str]]]:
+        """Yield (record, reasons) in input order, validating chunks of records in parallel"""
+        if self._executor is None:
+            for record in records:
+                reasons = validate_record(record, self.validators, self.settings)
+                self._count(reasons)
+                yield record, reasons
+            return
+
+        def chunks() -> Iterator[List[Dict]]:
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) >= chunksize:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        # Keep a bounded number of chunks in flight, two per worker
+        in_flight = []
+        for chunk in chunks():
+            in_flight.append((chunk, self._executor.submit(_validate_chunk, chunk,
+                                                           self.validators, self.settings)))
+            if len(in_flight) >= 2 * self.workers:
+                yield from self._collect(*in_flight.pop(0))
+        for chunk, future in in_flight:
+            yield from self._collect(chunk, future)
+
+    def _collect(self, chunk: List[Dict], future) -> Iterator[Tuple[Dict, List[str]]]:
+        for record, reasons in zip(chunk, future.result()):
+            self._count(reasons)
+            yield record, reasons
+
+    def close(self):
+        """Wait for pending records and stop the workers"""
+        self.drain()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
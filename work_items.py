@@ -0,0 +1,47 @@
+"""
+Work items for batch generation.
+
+A work item is one dialogue to generate, identified by its
+``(category, scenario, sample_id)`` key.
+"""
+
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+
+class WorkItem(NamedTuple):
+    """One dialogue to generate"""
+
+    category: str
+    scenario: str
+    flow_type: str
+    sample_id: int = 0
+
+    @property
+    def key(self) -> Tuple[str, str, int]:
+        """Stable identity of the dialogue across runs"""
+        return (self.category, self.scenario, self.sample_id)
+
+    @property
+    def context(self) -> str:
+        """The "category - scenario" label stored in output records"""
+        return f"{self.category} - {self.scenario}"
+
+
+def iter_work_items(data: Dict, samples_per_scenario: int = 1) -> Iterator[WorkItem]:
+    """
+    Yield samples_per_scenario work items per scenario in category order.
+    
+    data is the JSON data dict or a scenario_loader.ScenarioStream, which
+    yields its work items lazily in file order.
+    """
+    if not isinstance(data, dict):
+        return data.iter_work_items(samples_per_scenario)
+    return _iter_dict_work_items(data, samples_per_scenario)
+
+
+def _iter_dict_work_items(data: Dict, samples_per_scenario: int) -> Iterator[WorkItem]:
+    for category_name, category_data in data.get("categories", {}).items():
+        flow_type = category_data.get("flow_type", "")
+        for scenario in category_data.get("scenarios", []):
+            for sample_id in range(max(1, samples_per_scenario)):
+                yield WorkItem(category_name, scenario, flow_type, sample_id)